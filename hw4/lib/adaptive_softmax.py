@@ -0,0 +1,156 @@
+"""Adaptive softmax output layer (Grave et al., 2017, arXiv:1609.04309).
+
+Token ids are sorted by frequency (see data_utils.create_vocabulary), so the
+clusters are ranges of ids split at cutoffs: the head is a softmax over the
+cutoffs[0] most frequent words and one token per tail cluster, and tail
+cluster i is a softmax over ids [cutoffs[i], cutoffs[i + 1]), computed from
+the decoder output projected to size // 4**(i + 1) units. A head word has
+the probability of the head, a tail word that of its cluster token times
+its probability in the cluster.
+
+Training computes each tail only for the targets that fall in it; inference
+computes the log-probabilities of the whole vocabulary, which stand in for
+the logits of a full output projection.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from lib import data_utils
+
+
+def frequency_cutoffs(counts, shares=(0.8, 0.95)):
+  """Cutoffs of the clusters holding the given shares of the token counts.
+
+  Args:
+    counts: count of every id, as data_utils.load_vocabulary_counts.
+    shares: increasing shares of all tokens covered by the head and by the
+      head and each tail but the last, which ends the vocabulary.
+
+  Returns:
+    The increasing list of cutoffs, ending with len(counts).
+  """
+  coverage = np.cumsum(counts, dtype=np.float64) / max(np.sum(counts), 1)
+  cutoffs = []
+  for share in shares:
+    cutoff = int(np.searchsorted(coverage, share)) + 1
+    cutoff = max(cutoff, len(data_utils._START_VOCAB) + 1, cutoffs[-1] + 1 if cutoffs else 0)
+    if cutoff >= len(counts):
+      break
+    cutoffs.append(cutoff)
+  return cutoffs + [len(counts)]
+
+
+def load_cutoffs(args, counts=None):
+  """The cutoffs of --adaptive_softmax, or None for the sampled softmax.
+
+  'auto' takes them from the counts saved with the vocabulary, or the given
+  counts; otherwise the flag lists the cutoffs before args.vocab_size.
+  """
+  if not args.adaptive_softmax:
+    return None
+  if args.adaptive_softmax == 'auto':
+    if counts is None:
+      vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+      counts = data_utils.load_vocabulary_counts(vocab_path)
+    if counts is None:
+      raise ValueError("--adaptive_softmax auto needs the counts saved with the vocabulary,"
+                       " give the cutoffs instead")
+    padded = np.zeros(args.vocab_size, dtype=np.int64)
+    padded[:min(len(counts), args.vocab_size)] = counts[:args.vocab_size]
+    return frequency_cutoffs(padded)
+  cutoffs = [int(c) for c in args.adaptive_softmax.split(",")] + [args.vocab_size]
+  if cutoffs[0] <= len(data_utils._START_VOCAB) or any(
+      a >= b for a, b in zip(cutoffs[:-1], cutoffs[1:])):
+    raise ValueError("--adaptive_softmax cutoffs must increase from above %d to below %d, got %s"
+                     % (len(data_utils._START_VOCAB), args.vocab_size, args.adaptive_softmax))
+  return cutoffs
+
+
+class AdaptiveSoftmax(object):
+  """The output layer of a decoder of input_size units over cutoffs[-1] words.
+
+  It takes the place of the (W, B) output projection: called on decoder
+  outputs it gives their log-probabilities, the logits of decoding, and
+  loss is the softmax_loss_function of training. Variables are float32.
+  """
+
+  def __init__(self, input_size, cutoffs, reduction=4, scope=None):
+    """Create the variables of the head and of every tail cluster.
+
+    Args:
+      input_size: size of the decoder outputs.
+      cutoffs: increasing ends of the head and of each tail cluster, the
+        last one the vocabulary size.
+      reduction: each tail has reduction times fewer units than the one
+        before it, the first reduction times fewer than input_size.
+      scope: VariableScope of the variables; defaults to "adaptive_softmax".
+    """
+    self.cutoffs = list(cutoffs)
+    self.vocab_size = self.cutoffs[-1]
+    head_size = self.cutoffs[0] + len(self.cutoffs) - 1
+    with tf.variable_scope(scope or "adaptive_softmax"):
+      self.head_w = tf.get_variable("head_w", [input_size, head_size], dtype=tf.float32)
+      self.head_b = tf.get_variable("head_b", [head_size], dtype=tf.float32,
+                                    initializer=tf.zeros_initializer())
+      self.tails = []
+      for i in xrange(len(self.cutoffs) - 1):
+        tail_units = max(input_size // reduction ** (i + 1), 1)
+        tail_size = self.cutoffs[i + 1] - self.cutoffs[i]
+        with tf.variable_scope("tail_%d" % i):
+          self.tails.append((
+              tf.get_variable("proj", [input_size, tail_units], dtype=tf.float32),
+              tf.get_variable("w", [tail_units, tail_size], dtype=tf.float32),
+              tf.get_variable("b", [tail_size], dtype=tf.float32,
+                              initializer=tf.zeros_initializer())))
+
+  def _head_logits(self, inputs):
+    return tf.matmul(inputs, self.head_w) + self.head_b
+
+  def _tail_logits(self, i, inputs):
+    proj, w, b = self.tails[i]
+    return tf.matmul(tf.matmul(inputs, proj), w) + b
+
+  def __call__(self, inputs):
+    """Log-probabilities [batch_size x vocab_size] of the 2D inputs."""
+    inputs = tf.cast(inputs, tf.float32)
+    head = tf.nn.log_softmax(self._head_logits(inputs))
+    log_probs = [head[:, :self.cutoffs[0]]]
+    for i in xrange(len(self.tails)):
+      cluster = self.cutoffs[0] + i
+      log_probs.append(tf.nn.log_softmax(self._tail_logits(i, inputs)) +
+                       head[:, cluster:cluster + 1])
+    return tf.concat(log_probs, 1)
+
+  def loss(self, labels, inputs, dtype=None):
+    """-log P(labels) of the 2D inputs, as a softmax_loss_function.
+
+    Each tail is computed for the rows whose label is in it only.
+    """
+    dtype = dtype or inputs.dtype
+    labels = tf.reshape(labels, [-1])
+    inputs = tf.cast(inputs, tf.float32)
+    head_labels = labels
+    tail_losses = tf.zeros(tf.shape(labels), dtype=tf.float32)
+    for i in xrange(len(self.tails)):
+      start, end = self.cutoffs[i], self.cutoffs[i + 1]
+      in_cluster = tf.logical_and(labels >= start, labels < end)
+      # The head predicts the cluster token, the tail the word within it.
+      head_labels = tf.where(in_cluster, tf.fill(tf.shape(labels), self.cutoffs[0] + i),
+                             head_labels)
+      rows = tf.where(in_cluster)
+      tail_losses += tf.scatter_nd(
+          rows,
+          tf.nn.sparse_softmax_cross_entropy_with_logits(
+              labels=tf.gather_nd(labels, rows) - start,
+              logits=self._tail_logits(i, tf.gather_nd(inputs, rows))),
+          tf.cast(tf.shape(labels), tf.int64))
+    head_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=head_labels, logits=self._head_logits(inputs))
+    return tf.cast(head_losses + tail_losses, dtype)
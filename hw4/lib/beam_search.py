@@ -0,0 +1,146 @@
+"""Beam search in log space.
+
+Only numpy is needed here, the model is reached through the log-probability
+matrices handed to Beam.advance (or through step_fn in beam_search), so any
+step-wise decoder can use it, e.g. the hw2 caption decoder.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def top_k(scores, k):
+  """Flat indices of the k largest entries of scores, best first.
+
+  np.argpartition selects them in linear time; only those k are sorted.
+  """
+  scores = scores.ravel()
+  k = min(k, scores.size)
+  best = np.argpartition(-scores, k - 1)[:k]
+  return best[np.argsort(-scores[best], kind='mergesort')]
+
+
+def length_penalty(length, alpha):
+  """Length normalisation of Wu et al. (2016), ((5 + length) / 6) ** alpha."""
+  return ((5. + length) / 6.) ** alpha
+
+
+class Beam(object):
+  """Beam search state for a single source sequence.
+
+  Scores are accumulated log-probabilities. Hypotheses that emit eos_id move
+  to the finished set and are ranked by their length-normalised score.
+  """
+
+  def __init__(self, beam_size, eos_id, alpha=0.):
+    """Create the beam.
+
+    Args:
+      beam_size: number of live and of finished hypotheses to keep.
+      eos_id: token id that finishes a hypothesis.
+      alpha: length normalisation strength, 0 ranks by raw log-probability.
+    """
+    self.beam_size = beam_size
+    self.eos_id = eos_id
+    self.alpha = alpha
+    self.tokens = [[]]
+    self.scores = np.zeros(1)
+    self.components = {}
+    self.finished = []
+
+  @property
+  def done(self):
+    return not self.tokens or len(self.finished) >= self.beam_size
+
+  def last_tokens(self):
+    """The latest token of every live hypothesis, as an int32 vector."""
+    return np.array([t[-1] for t in self.tokens], dtype=np.int32)
+
+  def advance(self, log_probs, token_ids=None, **components):
+    """Extend the live hypotheses by one token.
+
+    Args:
+      log_probs: [n_live x vocab_size] scores to add to the live hypotheses.
+      token_ids: token id of each column of log_probs, if they are not the
+        column indices, e.g. when decoding over a shortlist.
+      **components: other [n_live x vocab_size] matrices to accumulate along
+        the selected paths, e.g. the terms log_probs is combined from.
+
+    Returns:
+      The parents: for each surviving hypothesis the row it extends, to
+      reorder per-hypothesis decoder state with.
+    """
+    scores = self.scores[:, None] + log_probs
+    # Twice the beam, so the beam stays full when some expansions finish.
+    best = top_k(scores, 2 * self.beam_size)
+    parents, columns = np.unravel_index(best, scores.shape)
+    tokens = columns if token_ids is None else np.asarray(token_ids)[columns]
+
+    keep = []
+    for i, (p, c, t) in enumerate(zip(parents, columns, tokens)):
+      if t == self.eos_id:
+        if len(self.finished) < self.beam_size:
+          self.finished.append(self._hypothesis(
+              self.tokens[p] + [t], scores[p, c],
+              dict((k, self._component(k, p) + v[p, c]) for k, v in components.items())))
+      elif len(keep) < self.beam_size:
+        keep.append(i)
+
+    parents, columns, tokens = parents[keep], columns[keep], tokens[keep]
+    self.tokens = [self.tokens[p] + [t] for p, t in zip(parents, tokens)]
+    self.scores = scores[parents, columns]
+    for k, v in components.items():
+      self.components[k] = self._component(k, parents) + v[parents, columns]
+    return parents
+
+  def _component(self, name, rows):
+    value = self.components.get(name, 0.)
+    return value if np.isscalar(value) else value[rows]
+
+  def _hypothesis(self, tokens, score, components):
+    hyp = dict(components)
+    hyp.update({'tokens': tokens, 'score': score,
+                'norm_score': score / length_penalty(len(tokens), self.alpha)})
+    return hyp
+
+  def results(self):
+    """Finished hypotheses best first, topped up with live ones if needed."""
+    hyps = list(self.finished)
+    if len(hyps) < self.beam_size:
+      hyps += [self._hypothesis(tokens, self.scores[i],
+                                dict((k, self._component(k, i)) for k in self.components))
+               for i, tokens in enumerate(self.tokens)]
+    hyps.sort(key=lambda hyp: hyp['norm_score'], reverse=True)
+    return hyps[:self.beam_size]
+
+
+def beam_search(step_fn, initial_state, go_id, eos_id, beam_size, max_len,
+                alpha=0.):
+  """Run a Beam to completion for a step-wise decoder.
+
+  Args:
+    step_fn: function (tokens, state, step) -> (log_probs, state) where tokens
+      is an int32 vector with one entry per live hypothesis, state the decoder
+      state for those rows and log_probs a [n_live x vocab_size] matrix.
+    initial_state: decoder state for a single row, a list of arrays.
+    go_id: token fed at the first step.
+    eos_id: token that finishes a hypothesis.
+    beam_size: beam width.
+    max_len: maximum number of decoding steps.
+    alpha: length normalisation strength.
+
+  Returns:
+    A list of up to beam_size dicts with 'tokens', 'score' and 'norm_score'.
+  """
+  beam = Beam(beam_size, eos_id, alpha)
+  tokens, state = np.array([go_id], dtype=np.int32), initial_state
+  for step in range(max_len):
+    log_probs, state = step_fn(tokens, state, step)
+    parents = beam.advance(log_probs)
+    if beam.done:
+      break
+    state = [s[parents] for s in state]
+    tokens = beam.last_tokens()
+  return beam.results()
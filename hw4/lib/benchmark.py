@@ -0,0 +1,846 @@
+import filecmp
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lib import data_utils
+from lib.adaptive_softmax import frequency_cutoffs, load_cutoffs
+from lib.cells import CELL_IMPLS
+from lib.beam_search import top_k
+from lib.export import export_frozen_graph
+from lib.get_batch_test import loop_get_batch, random_bucket
+from lib import seq2seq as seq2seq_tf
+from lib import seq2seq_model_bi
+from lib import seq2seq_model_dynamic
+from lib.seq2seq_model_utils import create_model, greedy_decode, greedy_decode_all, beam_decode
+from lib.seq2seq_model_utils import evaluation_pairs, perplexity
+from lib.sampled_softmax import NEGATIVE_SAMPLERS, load_unigram_counts
+from lib.shortlist import load_shortlist
+from lib.train import train_distributed
+
+
+def _timeit(fn, repeats):
+  fn()  # warm up
+  start_time = time.time()
+  for _ in range(repeats):
+    fn()
+  return (time.time() - start_time) / repeats
+
+
+def bench_incremental_decode(args):
+  """Latency of decoding one hypothesis over a whole bucket.
+
+  The full path re-runs the encoder and the decoder prefix for every decoder
+  position, as beam search did before; the incremental path runs the encoder
+  once and then advances the decoder one token at a time.
+  """
+  with tf.Session() as sess:
+    args.batch_size = 1
+    model = create_model(sess, args, predict_or_train=True)
+
+    for bucket_id, (encoder_size, decoder_size) in enumerate(args.buckets):
+      tokens = list(np.random.randint(4, args.vocab_size, encoder_size - 2))
+      feed_data = {bucket_id: [(tokens + [data_utils.EOS_ID], [])]}
+      encoder_inputs, decoder_inputs, target_weights = model.get_batch(feed_data, bucket_id)
+      n_steps = decoder_size - 1
+
+      def full():
+        for _ in range(n_steps):
+          model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id,
+                     forward_only=True, force_dec_input=True)
+
+      def incremental():
+        attention_memory, state = model.encode(sess, encoder_inputs, bucket_id)
+        for dptr in range(n_steps):
+          _, state = model.decode_step(sess, decoder_inputs[dptr], state, attention_memory,
+                                       first_step=(dptr == 0))
+
+      full_time = _timeit(full, args.bench_repeats)
+      incremental_time = _timeit(incremental, args.bench_repeats)
+      print("bucket %d %s: full %.2f ms, incremental %.2f ms, speedup %.1fx" %
+            (bucket_id, args.buckets[bucket_id], full_time * 1000, incremental_time * 1000,
+             full_time / incremental_time))
+
+
+def bench_beam_select(args):
+  """Per-step beam selection time against vocabulary size.
+
+  Compares a full argsort of every hypothesis row with one partial top-k
+  over the [beam_size x vocab_size] score matrix.
+  """
+  k = max(args.beam_size, 2)
+  for vocab_size in sorted(set([1000, 10000, 100000, args.vocab_size])):
+    scores = np.log(np.random.dirichlet(np.ones(vocab_size), k))
+
+    def argsort_rows():
+      return [np.argsort(row)[::-1][:k] for row in scores]
+
+    def partial_top_k():
+      return top_k(scores, 2 * k)
+
+    argsort_time = _timeit(argsort_rows, args.bench_repeats)
+    top_k_time = _timeit(partial_top_k, args.bench_repeats)
+    print("vocab %d beam %d: argsort %.3f ms, argpartition %.3f ms, speedup %.1fx" %
+          (vocab_size, k, argsort_time * 1000, top_k_time * 1000, argsort_time / top_k_time))
+
+
+def bench_get_batch(args):
+  """Per-batch cost of the per-example loop against the padded matrices.
+
+  get_batch_test checks that both build the same batches.
+  """
+  bucket_size = args.buckets[-1]
+  bucket = random_bucket(bucket_size, args.vocab_size, 10000)
+  padded = data_utils.pad_data([bucket], [bucket_size])[0]
+
+  for batch_size in [64, 128, 256, 512, 1024]:
+    batch_indices = np.random.randint(len(bucket), size=batch_size)
+    loop_time = _timeit(lambda: loop_get_batch(bucket, bucket_size, batch_indices), args.bench_repeats)
+    padded_time = _timeit(lambda: data_utils.get_batch(padded, bucket_size, batch_size, batch_indices),
+                          args.bench_repeats)
+    print("batch %d %s: loop %.3f ms, padded %.3f ms, speedup %.1fx" %
+          (batch_size, bucket_size, loop_time * 1000, padded_time * 1000, loop_time / padded_time))
+
+
+def bench_preprocess(args):
+  """Vocabulary and token-ids build time against the number of workers.
+
+  Runs on chat.in of the data dir if present, else on a generated corpus.
+  Every parallel build is checked to be byte-identical to the serial one,
+  whose saved word counts must be those of its token-ids.
+  """
+  work_dir = tempfile.mkdtemp()
+  try:
+    data_path = os.path.join(args.data_dir, "chat.in")
+    if not os.path.exists(data_path):
+      data_path = os.path.join(work_dir, "chat.in")
+      words = ["w%d" % i for i in range(args.vocab_size)] + list(".,!?") + ["19", "2017"]
+      with open(data_path, "w") as f:
+        for _ in range(200000):
+          f.write(" ".join(random.choice(words) for _ in range(random.randint(1, 20))) + "\n")
+
+    def serial():
+      vocab_path, ids_path = os.path.join(work_dir, "vocab.serial"), os.path.join(work_dir, "ids.serial")
+      data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size)
+      data_utils.data_to_token_ids(data_path, ids_path, vocab_path)
+      return vocab_path, ids_path, data_utils.vocabulary_counts_path(vocab_path)
+
+    def parallel(num_workers):
+      vocab_path = os.path.join(work_dir, "vocab.%d" % num_workers)
+      ids_path = os.path.join(work_dir, "ids.%d" % num_workers)
+      data_utils.parallel_data_to_token_ids(data_path, ids_path, vocab_path, args.vocab_size, num_workers)
+      return vocab_path, ids_path, data_utils.vocabulary_counts_path(vocab_path)
+
+    start_time = time.time()
+    expected = serial()
+    serial_time = time.time() - start_time
+    print("serial: %.2fs" % serial_time)
+    with open(expected[1]) as f:
+      ids = np.array([int(t) for line in f for t in line.split()], dtype=np.int64)
+    counts = data_utils.load_vocabulary_counts(expected[0])
+    assert np.array_equal(np.bincount(ids, minlength=len(counts)), counts)
+    num_workers = 1
+    while num_workers <= max(multiprocessing.cpu_count(), 2):
+      start_time = time.time()
+      paths = parallel(num_workers)
+      parallel_time = time.time() - start_time
+      assert all(filecmp.cmp(e, p, shallow=False) for e, p in zip(expected, paths))
+      print("%d workers: %.2fs, speedup %.1fx" % (num_workers, parallel_time, serial_time / parallel_time))
+      num_workers *= 2
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def bench_tokenize(args):
+  """Per-request tokenization latency of chat mode.
+
+  Compares sentence_to_token_ids with a data_utils.Tokenizer of the same
+  vocabulary, after checking both give the same ids.
+  """
+  vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+  if os.path.exists(vocab_path):
+    vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+  else:
+    rev_vocab = data_utils._START_VOCAB + [b"w%d" % i for i in range(args.vocab_size)]
+    vocab = dict((w, i) for i, w in enumerate(rev_vocab))
+  words = [w.decode("utf8", "ignore").capitalize() for w in rev_vocab[4:]] + \
+      ["It's", "(ok)", "1999", "\u4f60\u597d", "yes!!", "Dr.Who"]
+  sentences = [" ".join(random.choice(words) for _ in range(random.randint(1, 15)))
+               for _ in range(1000)]
+  tokenizer = data_utils.Tokenizer(vocab)
+  for sentence in sentences:
+    assert tokenizer.encode(sentence) == data_utils.sentence_to_token_ids(sentence, vocab)
+    assert tokenizer.encode(sentence.encode()) == data_utils.sentence_to_token_ids(sentence.encode(), vocab)
+
+  def serial():
+    for sentence in sentences:
+      data_utils.sentence_to_token_ids(sentence, vocab)
+
+  def cached():
+    for sentence in sentences:
+      tokenizer.encode(sentence)
+
+  serial_time = _timeit(serial, args.bench_repeats) / len(sentences)
+  cached_time = _timeit(cached, args.bench_repeats) / len(sentences)
+  print("per sentence: sentence_to_token_ids %.1f us, Tokenizer %.1f us, speedup %.1fx" %
+        (serial_time * 1e6, cached_time * 1e6, serial_time / cached_time))
+
+
+def _build_model(args, model_module, predict_or_train, decode_mode=None, **kwargs):
+  return model_module.Seq2SeqModel(
+      source_vocab_size=args.vocab_size,
+      target_vocab_size=args.vocab_size,
+      buckets=args.buckets,
+      size=args.size,
+      num_layers=args.num_layers,
+      max_gradient_norm=args.max_gradient_norm,
+      batch_size=args.batch_size,
+      learning_rate=args.learning_rate,
+      learning_rate_decay_factor=args.learning_rate_decay_factor,
+      predict_or_train=predict_or_train,
+      decode_mode=decode_mode,
+      **kwargs)
+
+
+def _startup_cost(args, model_module, predict_or_train):
+  """Build and initialise a model in a fresh graph; run in a child process."""
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start_time = time.time()
+  with tf.Graph().as_default() as graph:
+    _build_model(args, model_module, predict_or_train)
+    build_time = time.time() - start_time
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      init_time = time.time() - start_time - build_time
+    graph_def_size = graph.as_graph_def().ByteSize()
+    n_ops = len(graph.get_operations())
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+  return build_time, init_time, n_ops, graph_def_size, rss
+
+
+def bench_startup(args):
+  """Graph size and startup cost of the bucketed and the dynamic model.
+
+  The dynamic model is first checked to restore a checkpoint of the bucketed
+  one and to give the same teacher-forced logits and greedy outputs on random
+  inputs of every bucket. Each model is then built in its own process, for
+  training and for prediction; peak RSS growth is in MB (ru_maxrss, Linux).
+  """
+  args.batch_size = 16
+  work_dir = tempfile.mkdtemp()
+  try:
+    checkpoint_path = os.path.join(work_dir, "model.ckpt")
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = _build_model(args, seq2seq_model_bi, True)
+      sess.run(tf.global_variables_initializer())
+      model.saver.save(sess, checkpoint_path)
+      bucketed = [], []
+      for bucket_id, (encoder_size, decoder_size) in enumerate(args.buckets):
+        data = {bucket_id: [(list(np.random.randint(4, args.vocab_size, np.random.randint(1, encoder_size))),
+                             list(np.random.randint(4, args.vocab_size, np.random.randint(1, decoder_size - 1))))
+                            for _ in range(args.batch_size)]}
+        batch = model.get_batch(data, bucket_id, range(args.batch_size))
+        _, _, logits = model.step(sess, batch[0], batch[1], batch[2], bucket_id,
+                                  forward_only=True, force_dec_input=True)
+        inputs = [pair[0] + [data_utils.EOS_ID] for pair in data[bucket_id]]
+        bucketed[0].append((batch, logits))
+        bucketed[1].append((inputs, greedy_decode(model, sess, bucket_id, inputs)))
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = _build_model(args, seq2seq_model_dynamic, True)
+      model.saver.restore(sess, checkpoint_path)
+      for bucket_id, ((batch, expected), (inputs, outputs)) in enumerate(zip(*bucketed)):
+        _, _, logits = model.step(sess, batch[0], batch[1], batch[2], bucket_id,
+                                  forward_only=True, force_dec_input=True)
+        weights = np.array(batch[2])[:, :, None]
+        assert np.allclose(np.array(expected) * weights, np.array(logits) * weights, atol=1e-4)
+        assert greedy_decode(model, sess, bucket_id, inputs) == outputs
+  finally:
+    shutil.rmtree(work_dir)
+  print("dynamic model restored the bucketed checkpoint with the same outputs")
+
+  for mode, predict_or_train in [("train", False), ("predict", True)]:
+    for name, model_module in [("bucketed", seq2seq_model_bi), ("dynamic", seq2seq_model_dynamic)]:
+      pool = multiprocessing.Pool(1)
+      build_time, init_time, n_ops, graph_def_size, rss = pool.apply(
+          _startup_cost, (args, model_module, predict_or_train))
+      pool.close()
+      pool.join()
+      print("%s %s, %d buckets: build %.2fs, init %.2fs, %d ops, GraphDef %.1f MB, peak RSS +%.0f MB" %
+            (mode, name, len(args.buckets), build_time, init_time, n_ops,
+             graph_def_size / 2.**20, rss / 1024.))
+
+
+def _cold_start(args, inputs):
+  """Time to a first decode in a fresh graph; run in a child process."""
+  start_time = time.time()
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model = create_model(sess, args, predict_or_train=True)
+    load_time = time.time() - start_time
+    if args.beam_size == 1:
+      outputs = greedy_decode(model, sess, 0, inputs)
+    else:
+      outputs = [[[int(t) for t in hyp['tokens']] for hyp in hyps]
+                 for hyps in beam_decode(args, model, sess, 0, inputs)]
+    first_time = time.time() - start_time - load_time
+  return load_time, first_time, outputs
+
+
+def bench_cold_start(args):
+  """Cold start of test/chat mode: building the model against a frozen graph.
+
+  Each path runs in its own process (tensorflow already imported) from the
+  checkpoint in the model dir, or a fresh one if there is none, and both must
+  decode the same input of the first bucket alike.
+  """
+  args.batch_size, args.frozen_graph = 1, None
+  work_dir = tempfile.mkdtemp()
+  try:
+    if not tf.train.get_checkpoint_state(args.model_dir):
+      args.model_dir = work_dir
+      with tf.Graph().as_default(), tf.Session() as sess:
+        model = create_model(sess, args, predict_or_train=True)
+        model.saver.save(sess, os.path.join(work_dir, "model.ckpt"))
+    frozen_graph = os.path.join(work_dir, "frozen.pb")
+    start_time = time.time()
+    export_frozen_graph(args, frozen_graph)
+    print("export: %.2fs, %.1f MB" % (time.time() - start_time, os.path.getsize(frozen_graph) / 2.**20))
+
+    inputs = [list(np.random.randint(4, args.vocab_size, args.buckets[0][0] - 2)) + [data_utils.EOS_ID]]
+    results = {}
+    for name, path in [("checkpoint", None), ("frozen", frozen_graph)]:
+      args.frozen_graph = path
+      pool = multiprocessing.Pool(1)
+      results[name] = pool.apply(_cold_start, (args, inputs))
+      pool.close()
+      pool.join()
+      load_time, first_time, _ = results[name]
+      print("%s: load %.2fs, first decode %.3fs, total %.2fs" %
+            (name, load_time, first_time, load_time + first_time))
+    assert results["checkpoint"][2] == results["frozen"][2]
+    print("speedup %.1fx" % (sum(results["checkpoint"][:2]) / sum(results["frozen"][:2])))
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def bench_decode_modes(args):
+  """Graph size and step latency of the cond graph against static decode modes.
+
+  A checkpoint of the cond graph is restored into models built with
+  decode_mode 'infer_greedy' and 'infer_forced', whose logits must be equal
+  to those of the cond graph fed the matching force_dec_input.
+  """
+  args.batch_size = 16
+  work_dir = tempfile.mkdtemp()
+  try:
+    checkpoint_path = os.path.join(work_dir, "model.ckpt")
+    batches = []
+    for bucket_id, (encoder_size, decoder_size) in enumerate(args.buckets):
+      data = {bucket_id: [(list(np.random.randint(4, args.vocab_size, np.random.randint(1, encoder_size))),
+                           list(np.random.randint(4, args.vocab_size, np.random.randint(1, decoder_size - 1))))
+                          for _ in range(args.batch_size)]}
+      batches.append(data_utils.get_batch(data[bucket_id], args.buckets[bucket_id], args.batch_size,
+                                          range(args.batch_size)))
+
+    expected = {}
+    for decode_mode in [None, 'infer_greedy', 'infer_forced']:
+      with tf.Graph().as_default() as graph, tf.Session() as sess:
+        start_time = time.time()
+        model = _build_model(args, seq2seq_model_bi, True, decode_mode)
+        build_time = time.time() - start_time
+        if decode_mode is None:
+          sess.run(tf.global_variables_initializer())
+          model.saver.save(sess, checkpoint_path)
+        else:
+          model.saver.restore(sess, checkpoint_path)
+        forces = [decode_mode == 'infer_forced'] if decode_mode else [False, True]
+        step_times = []
+        for force_dec_input in forces:
+          for bucket_id, batch in enumerate(batches):
+            def step():
+              return model.step(sess, batch[0], batch[1], batch[2], bucket_id,
+                                forward_only=True, force_dec_input=force_dec_input)[2]
+            logits = step()
+            if decode_mode is None:
+              expected[force_dec_input, bucket_id] = logits
+            else:
+              assert all(np.array_equal(e, l) for e, l in zip(expected[force_dec_input, bucket_id], logits))
+            step_times.append(_timeit(step, args.bench_repeats))
+        print("%s: build %.2fs, %d ops, mean step %.2f ms" %
+              (decode_mode or "cond", build_time, len(graph.get_operations()),
+               np.mean(step_times) * 1000))
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def bench_rl(args):
+  """Reinforcement-learning throughput against the number of episodes per step.
+
+  One step_rf_batch call rolls out and trains on a batch of episodes, at
+  least two since their advantages are relative to each other.
+  """
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model = _build_model(args, seq2seq_model_bi, False)
+    sess.run(tf.global_variables_initializer())
+    encoder_size = args.buckets[1][0]
+    pairs = [(list(np.random.randint(4, args.vocab_size, np.random.randint(4, encoder_size))), [])
+             for _ in range(max(args.batch_size, 64))]
+    for batch_size in [2, 8, 32, 64]:
+      batch_bucket_id, batch = model._pairs_batch([(a + [data_utils.EOS_ID], b) for a, b in pairs[:batch_size]])
+      step_time = _timeit(lambda: model.step_rf_batch(args, sess, batch[0], batch[1], batch[2], batch_bucket_id,
+                                                      max_turns=args.rl_max_turns),
+                          args.bench_repeats)
+      print("%d episodes per step: %.3fs per step, %.1f episodes/sec" %
+            (batch_size, step_time, batch_size / step_time))
+
+
+def _logits_log_prob(model, sess, pairs):
+  """log_prob from the logits step() fetches, scored in numpy."""
+  bucket_id, (encoder_inputs, decoder_inputs, target_weights) = model._pairs_batch(pairs)
+  _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs, target_weights,
+                                   bucket_id, forward_only=True, force_dec_input=True)
+  rows = np.arange(len(pairs))
+  scores = np.zeros(len(pairs))
+  # Output l predicts decoder input l + 1, weighted while that is not PAD.
+  for l, logits in enumerate(output_logits[:-1]):
+    top = np.max(logits, axis=1)
+    log_norm = top + np.log(np.sum(np.exp(logits - top[:, None]), axis=1))
+    scores += target_weights[l] * (logits[rows, decoder_inputs[l + 1]] - log_norm)
+  return scores / np.maximum(np.sum(target_weights, axis=0), 1)
+
+
+def bench_log_prob(args):
+  """Pairs scored per second by log_prob against a logits step per pair.
+
+  log_prob must give the scores computed in numpy from the fetched logits,
+  for the bucketed and the dynamic model restored from the same checkpoint.
+  """
+  n_pairs = 4096
+  pairs = []
+  for _ in range(n_pairs):
+    encoder_size, decoder_size = random.choice(args.buckets)
+    pairs.append((list(np.random.randint(4, args.vocab_size, np.random.randint(1, encoder_size - 1))) +
+                  [data_utils.EOS_ID],
+                  list(np.random.randint(4, args.vocab_size, np.random.randint(1, decoder_size - 2))) +
+                  [data_utils.EOS_ID]))
+  work_dir = tempfile.mkdtemp()
+  try:
+    checkpoint_path = os.path.join(work_dir, "model.ckpt")
+    for name, model_module in [("bucketed", seq2seq_model_bi), ("dynamic", seq2seq_model_dynamic)]:
+      with tf.Graph().as_default(), tf.Session() as sess:
+        model = _build_model(args, model_module, False)
+        if model_module is seq2seq_model_bi:
+          sess.run(tf.global_variables_initializer())
+          model.saver.save(sess, checkpoint_path)
+        else:
+          model.saver.restore(sess, checkpoint_path)
+        for start in range(0, 256, 32):
+          expected = _logits_log_prob(model, sess, pairs[start:start + 32])
+          assert np.allclose(model.log_prob(sess, pairs[start:start + 32]), expected, atol=1e-4)
+
+        n_loop = 64
+        loop_time = _timeit(lambda: [_logits_log_prob(model, sess, [pair])
+                                     for pair in pairs[:n_loop]], 1) / n_loop
+        graph_time = _timeit(lambda: model.log_prob(sess, pairs), 1) / n_pairs
+        print("%s: logits steps %.1f pairs/sec, log_prob %.1f pairs/sec, speedup %.1fx" %
+              (name, 1 / loop_time, 1 / graph_time, loop_time / graph_time))
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def _dtype_run(args, pairs):
+  """Score and greedily decode the pairs with args.dtype; run in a child process."""
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start_time = time.time()
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model = create_model(sess, args, predict_or_train=True)
+    load_time = time.time() - start_time
+    variable_bytes = sum(v.get_shape().num_elements() * np.dtype(v.dtype.base_dtype.as_numpy_dtype).itemsize
+                         for v in model.checkpoint_variables.values())
+    log_probs = model.log_prob(sess, pairs, batch_size=args.batch_size)
+    start_time = time.time()
+    outputs = greedy_decode_all(args, model, sess, [a for a, _ in pairs])
+    decode_time = time.time() - start_time
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+  return load_time, variable_bytes, rss, log_probs, outputs, decode_time
+
+
+def bench_dtype(args):
+  """Accuracy drift, memory and latency of --dtype float16 against float32.
+
+  Both load the checkpoint in the model dir, or a fresh float32 one if there
+  is none, each in its own process, and score and greedily decode up to
+  1000 pairs of the dev set (random pairs if it has not been prepared).
+  Drift is reported as the change in dev perplexity, the mean and largest
+  change of log P(b|a) / len(b), and the share of identical greedy outputs.
+  """
+  args.batch_size, args.frozen_graph, args.decode_mode, args.quantized = 16, None, '', None
+  pairs, source = evaluation_pairs(args)
+  print("%d pairs of %s" % (len(pairs), source))
+
+  work_dir = tempfile.mkdtemp()
+  try:
+    if not tf.train.get_checkpoint_state(args.model_dir):
+      args.model_dir = work_dir
+      with tf.Graph().as_default(), tf.Session() as sess:
+        args.dtype = 'float32'
+        model = create_model(sess, args, predict_or_train=True)
+        model.saver.save(sess, os.path.join(work_dir, "model.ckpt"))
+    results = {}
+    for dtype in ['float32', 'float16']:
+      args.dtype = dtype
+      pool = multiprocessing.Pool(1)
+      results[dtype] = pool.apply(_dtype_run, (args, pairs))
+      pool.close()
+      pool.join()
+      load_time, variable_bytes, rss, log_probs, _, decode_time = results[dtype]
+      print("%s: load %.2fs, variables %.1f MB, peak RSS +%.0f MB, dev perplexity %.3f, "
+            "greedy decode %.2f ms per sentence" %
+            (dtype, load_time, variable_bytes / 2.**20, rss / 1024., perplexity(log_probs, pairs),
+             decode_time / len(pairs) * 1000))
+  finally:
+    shutil.rmtree(work_dir)
+
+  full, half = results['float32'], results['float16']
+  drift = np.abs(half[3] - full[3])
+  same = np.mean([a == b for a, b in zip(full[4], half[4])])
+  print("drift: log-likelihood per token mean %.2e, max %.2e; identical greedy outputs %.1f%%" %
+        (np.mean(drift), np.max(drift), same * 100))
+  print("float16 / float32: variables %.2fx, decode latency %.2fx" %
+        (half[1] / float(full[1]), half[5] / full[5]))
+
+
+def bench_shortlist(args):
+  """Greedy decoding over --shortlist candidates against the full vocabulary.
+
+  Up to 1000 pairs of the dev set (random pairs if it has not been prepared)
+  are decoded one at a time, the usual chat and serve case, with the full
+  output projection and with shortlists of a few sizes. Reported per size:
+  the mean shortlist size, the share of reference response tokens it covers,
+  the share of greedy outputs identical to the full decode and the latency.
+  """
+  args.batch_size, args.frozen_graph, args.decode_mode = 1, None, ''
+  pairs, source = evaluation_pairs(args)
+  inputs = [a for a, _ in pairs]
+  print("%d pairs of %s" % (len(pairs), source))
+
+  with tf.Graph().as_default(), tf.Session() as sess:
+    args.shortlist = 0
+    model = create_model(sess, args, predict_or_train=True)
+    start_time = time.time()
+    full = greedy_decode_all(args, model, sess, inputs)
+    full_time = (time.time() - start_time) / len(pairs)
+    print("full vocabulary (%d): %.2f ms per sentence" % (args.vocab_size, full_time * 1000))
+
+    for n_frequent in [1000, 5000, 20000]:
+      if n_frequent >= args.vocab_size:
+        continue
+      args.shortlist = n_frequent
+      model.shortlist = load_shortlist(args)
+      candidates = [model.shortlist.candidates([a]) for a in inputs]
+      covered = sum(np.sum(np.in1d(b, c)) for (_, b), c in zip(pairs, candidates))
+      start_time = time.time()
+      outputs = greedy_decode_all(args, model, sess, inputs)
+      decode_time = (time.time() - start_time) / len(pairs)
+      same = np.mean([a == b for a, b in zip(full, outputs)])
+      print("shortlist %d: mean size %.0f, reference tokens covered %.1f%%, "
+            "identical greedy outputs %.1f%%, %.2f ms per sentence (%.2fx)" %
+            (n_frequent, np.mean([len(c) for c in candidates]),
+             100. * covered / sum(len(b) for _, b in pairs), same * 100,
+             decode_time * 1000, full_time / decode_time))
+
+
+def bench_distributed(args):
+  """Training steps/sec of train --workers 1, 2, 4 and 8 on this machine.
+
+  Each trains fresh variables in a temporary model dir on random pairs of
+  every bucket, for 10 * bench_repeats steps per worker; the first step of
+  each worker is not timed. Throughput is summed over the workers; with
+  asynchronous updates a step of any worker is one update of the variables.
+  """
+  train_set = data_utils.pad_data(
+      [[[list(np.random.randint(4, args.vocab_size, np.random.randint(1, encoder_size - 1))) + [data_utils.EOS_ID],
+         list(np.random.randint(4, args.vocab_size, np.random.randint(1, decoder_size - 2))) + [data_utils.EOS_ID]]
+        for _ in range(1000)]
+       for encoder_size, decoder_size in args.buckets], args.buckets)
+  args.reinforce_learn, args.seed = 0, None
+  steps_per_worker = 10 * args.bench_repeats
+  args.steps_per_checkpoint = steps_per_worker + 1  # No evals or checkpoints on the way.
+  ps_port = args.ps_port
+
+  base_rate = None
+  for i, workers in enumerate([1, 2, 4, 8]):
+    work_dir = tempfile.mkdtemp()
+    try:
+      args.workers, args.model_dir, args.max_steps = workers, work_dir, workers * steps_per_worker
+      args.ps_port = ps_port + 10 * i  # Servers of the previous run may hold their ports a while.
+      start_time = time.time()
+      per_worker = train_distributed(args, train_set, train_set)
+      wall_time = time.time() - start_time
+    finally:
+      shutil.rmtree(work_dir)
+    rate = sum(steps / seconds for steps, seconds in per_worker)
+    base_rate = base_rate or rate
+    print("%d workers: %.2f steps/sec, %.0f pairs/sec, %.2fx speedup, %.0f%% efficiency, %.1fs with startup" %
+          (workers, rate, rate * args.batch_size, rate / base_rate, 100. * rate / base_rate / workers, wall_time))
+
+
+def bench_cell_impl(args):
+  """Training steps/sec of --cell_impl basic, block and fused on this CPU.
+
+  For GRU and for LSTM cells, fresh basic variables are saved and restored
+  into the block and fused models, which must reproduce the forward losses
+  of the basic one on a random batch of every bucket; each model then trains
+  on those batches.
+  """
+  work_dir = tempfile.mkdtemp()
+  try:
+    for use_lstm in [False, True]:
+      checkpoint_path = os.path.join(work_dir, "model.ckpt")
+      data = [[[list(np.random.randint(4, args.vocab_size, encoder_size - 2)) + [data_utils.EOS_ID],
+                list(np.random.randint(4, args.vocab_size, decoder_size - 2)) + [data_utils.EOS_ID]]
+               for _ in range(args.batch_size)]
+              for encoder_size, decoder_size in args.buckets]
+      expected, base_time = None, None
+      for cell_impl in CELL_IMPLS:
+        with tf.Graph().as_default(), tf.Session() as sess:
+          model = _build_model(args, seq2seq_model_bi, False, use_lstm=use_lstm, cell_impl=cell_impl)
+          if expected is None:
+            sess.run(tf.global_variables_initializer())
+            model.saver.save(sess, checkpoint_path)
+          else:
+            model.saver.restore(sess, checkpoint_path)
+          batches = [model.get_batch(data, bucket_id, range(args.batch_size))
+                     for bucket_id in range(len(args.buckets))]
+          losses = np.array([model.step(sess, batch[0], batch[1], batch[2], bucket_id,
+                                        forward_only=True, force_dec_input=True)[1]
+                             for bucket_id, batch in enumerate(batches)])
+          if expected is None:
+            expected = losses
+          step_times = []
+          for bucket_id, batch in enumerate(batches):
+            step_times.append(_timeit(lambda: model.step(sess, batch[0], batch[1], batch[2], bucket_id,
+                                                         forward_only=False, force_dec_input=True),
+                                      args.bench_repeats))
+        step_time = np.mean(step_times)
+        base_time = base_time or step_time
+        print("%s %s: %.2f steps/sec, %.2fx, loss difference to basic %.2e" %
+              ("LSTM" if use_lstm else "GRU", cell_impl, 1 / step_time, base_time / step_time,
+               np.max(np.abs(losses - expected))))
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def _conv_attention(query, attention_states, num_heads=1):
+  """The attention() closure attention_decoder had, on the same variables."""
+  attn_length = tf.shape(attention_states)[1]
+  attn_size = attention_states.get_shape()[2].value
+  hidden = tf.reshape(attention_states, [-1, attn_length, 1, attn_size])
+  ds = []
+  for a in range(num_heads):
+    k = tf.get_variable("AttnW_%d" % a, [1, 1, attn_size, attn_size])
+    hidden_features = tf.nn.conv2d(hidden, k, [1, 1, 1, 1], "SAME")
+    v = tf.get_variable("AttnV_%d" % a, [attn_size])
+    with tf.variable_scope("Attention_%d" % a):
+      y = seq2seq_tf.linear(query, attn_size, True)
+      y = tf.reshape(y, [-1, 1, 1, attn_size])
+      s = tf.reduce_sum(v * tf.tanh(hidden_features + y), [2, 3])
+      mask = tf.nn.softmax(s)
+      d = tf.reduce_sum(tf.reshape(mask, [-1, attn_length, 1, 1]) * hidden, [1, 2])
+      ds.append(tf.reshape(d, [-1, attn_size]))
+  return ds
+
+
+def bench_attention(args):
+  """Per-step attention latency against the encoder length.
+
+  Compares the 1-by-1 convolution closure attention_decoder used with the
+  batched-matmul attention_read, recomputing the keys at every step as the
+  step graph did and with the keys cached by encode(). The reads must match.
+  """
+  num_heads = 2
+  with tf.Graph().as_default(), tf.Session() as sess:
+    attention_states = tf.placeholder(tf.float32, [None, None, args.size])
+    query = tf.placeholder(tf.float32, [None, args.size])
+    with tf.variable_scope("attention_decoder"):
+      keys = seq2seq_tf.project_attention_keys(attention_states, num_heads)
+      batched = seq2seq_tf.attention_read(query, attention_states, keys)
+      cached_keys = [tf.placeholder(tf.float32, [None, None, args.size]) for _ in keys]
+      cached = seq2seq_tf.attention_read(query, attention_states, cached_keys)
+    with tf.variable_scope("attention_decoder", reuse=True):
+      conv = _conv_attention(query, attention_states, num_heads)
+    sess.run(tf.global_variables_initializer())
+
+    for attn_length in [5, 10, 20, 40, 80, 160]:
+      feed = {attention_states: np.random.randn(args.batch_size, attn_length, args.size),
+              query: np.random.randn(args.batch_size, args.size)}
+      conv_reads = sess.run(conv, feed)
+      batched_reads = sess.run(batched, feed)
+      cached_feed = dict(feed)
+      cached_feed.update(zip(cached_keys, sess.run(keys, feed)))
+      cached_reads = sess.run(cached, cached_feed)
+      difference = max(np.max(np.abs(np.array(r) - np.array(conv_reads)))
+                       for r in [batched_reads, cached_reads])
+      assert difference < 1e-4, difference
+
+      conv_time = _timeit(lambda: sess.run(conv, feed), args.bench_repeats)
+      batched_time = _timeit(lambda: sess.run(batched, feed), args.bench_repeats)
+      cached_time = _timeit(lambda: sess.run(cached, cached_feed), args.bench_repeats)
+      print("length %d: conv %.3f ms, batched %.3f ms, cached keys %.3f ms, speedup %.1fx, "
+            "max difference %.1e" % (attn_length, conv_time * 1000, batched_time * 1000,
+                                     cached_time * 1000, conv_time / cached_time, difference))
+
+
+def _zipf_tokens(args, n):
+  """n random token ids and EOS; ids are Zipfian, like in vocab%d.in order."""
+  ids = np.random.zipf(1.3, n) % (args.vocab_size - 4) + 4
+  return list(ids) + [data_utils.EOS_ID]
+
+
+def _training_pairs(args):
+  """Training set, held-out pairs and the counts of the target words.
+
+  They come from the training set, or from random pairs of Zipfian ids if it
+  has not been prepared.
+  """
+  train_path = data_utils.get_dialog_train_set_path(args.data_dir) + ".ids%d.in" % args.vocab_size
+  if os.path.exists(train_path):
+    train_set = data_utils.read_data(train_path, args.buckets, args.max_train_data_size or 100000)
+    train_set = data_utils.pad_data(train_set, args.buckets)
+    pairs, source = evaluation_pairs(args)
+    unigram_counts = load_unigram_counts(args)
+  else:
+    train_set = [[(_zipf_tokens(args, np.random.randint(1, encoder_size - 1)),
+                   _zipf_tokens(args, np.random.randint(1, decoder_size - 2)))
+                  for _ in range(5000)]
+                 for encoder_size, decoder_size in args.buckets]
+    pairs = [pair for bucket in train_set for pair in bucket[:250]]
+    train_set = [bucket[250:] for bucket in train_set]
+    source = "random Zipfian pairs (no training set at %s)" % train_path
+    unigram_counts = np.bincount(np.concatenate([response for bucket in train_set for _, response in bucket]),
+                                 minlength=args.vocab_size)
+  print("%d held-out pairs of %s" % (len(pairs), source))
+  return train_set, pairs, unigram_counts
+
+
+def _train_for(args, sess, model, train_set):
+  """Train model for --bench_seconds; returns steps, target tokens and seconds."""
+  bucket_sizes = np.array([len(bucket) for bucket in train_set], dtype=np.float64)
+
+  def train_step():
+    bucket_id = np.random.choice(len(bucket_sizes), p=bucket_sizes / bucket_sizes.sum())
+    encoder_inputs, decoder_inputs, target_weights = model.get_batch(train_set, bucket_id)
+    model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id,
+               forward_only=False, force_dec_input=True)
+    return np.sum(target_weights)
+
+  train_step()  # warm up
+  steps, tokens, start_time = 0, 0, time.time()
+  while time.time() - start_time < args.bench_seconds:
+    tokens += train_step()
+    steps += 1
+  return steps, tokens, time.time() - start_time
+
+
+def bench_negative_sampler(args):
+  """Training throughput and perplexity of every --negative_sampler at equal wall-clock.
+
+  Each sampler trains the bucketed model from the same initial variables for
+  --bench_seconds on the training set, or on random pairs of Zipfian ids if
+  it has not been prepared; perplexity is that of the full softmax on
+  held-out pairs.
+  """
+  train_set, pairs, unigram_counts = _training_pairs(args)
+  work_dir = tempfile.mkdtemp()
+  try:
+    checkpoint_path = os.path.join(work_dir, "model.ckpt")
+    for i, negative_sampler in enumerate(NEGATIVE_SAMPLERS):
+      with tf.Graph().as_default(), tf.Session() as sess:
+        model = _build_model(args, seq2seq_model_bi, False, negative_sampler=negative_sampler,
+                             unigram_counts=unigram_counts)
+        if i == 0:
+          sess.run(tf.global_variables_initializer())
+          model.saver.save(sess, checkpoint_path)
+        else:
+          model.saver.restore(sess, checkpoint_path)
+        steps, tokens, train_time = _train_for(args, sess, model, train_set)
+        log_probs = model.log_prob(sess, pairs, batch_size=args.batch_size)
+      print("%s: %d steps, %.2f steps/sec, %.0f target tokens/sec, perplexity %.2f" %
+            (negative_sampler, steps, steps / train_time, tokens / train_time, perplexity(log_probs, pairs)))
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def bench_adaptive_softmax(args):
+  """Sampled softmax against the adaptive softmax output layer.
+
+  Both train the bucketed model for --bench_seconds from fresh variables on
+  the data of bench_negative_sampler, with the cutoffs of --adaptive_softmax
+  or those covering 80% and 95% of the target words. Reports training
+  throughput, full-distribution perplexity on held-out pairs and the latency
+  of the output layer over the whole vocabulary for a batch of outputs, and
+  checks that the adaptive loss is -log of its full distribution.
+  """
+  train_set, pairs, unigram_counts = _training_pairs(args)
+  if args.adaptive_softmax and args.adaptive_softmax != 'auto':
+    cutoffs = load_cutoffs(args)
+  else:
+    cutoffs = frequency_cutoffs(unigram_counts)
+  outputs = np.random.randn(args.batch_size, args.size).astype(np.float32)
+  labels = np.random.randint(args.vocab_size, size=args.batch_size).astype(np.int32)
+  for name, output_layer in (("sampled softmax", {}),
+                             ("adaptive softmax %s" % cutoffs, {'adaptive_cutoffs': cutoffs})):
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = _build_model(args, seq2seq_model_bi, False, **output_layer)
+      sess.run(tf.global_variables_initializer())
+      steps, tokens, train_time = _train_for(args, sess, model, train_set)
+      log_probs = model.log_prob(sess, pairs, batch_size=args.batch_size)
+
+      x = tf.placeholder(tf.float32, shape=[None, args.size])
+      logits = seq2seq_model_bi.project(x, model.output_projection)
+      feed = {x: outputs}
+      layer_time = _timeit(lambda: sess.run(logits, feed), args.bench_repeats)
+      if output_layer:
+        full, loss = sess.run([logits, model.output_projection.loss(labels, x)], feed)
+        normalisation = np.max(np.abs(np.log(np.sum(np.exp(full), axis=1))))
+        difference = np.max(np.abs(loss + full[np.arange(len(labels)), labels]))
+        assert normalisation < 1e-4 and difference < 1e-4, (normalisation, difference)
+    print("%s: %d steps, %.2f steps/sec, %.0f target tokens/sec, perplexity %.2f, "
+          "full output layer %.3f ms per batch" %
+          (name, steps, steps / train_time, tokens / train_time, perplexity(log_probs, pairs),
+           layer_time * 1000))
+
+
+BENCHMARKS = {
+  'incremental_decode': bench_incremental_decode,
+  'beam_select': bench_beam_select,
+  'get_batch': bench_get_batch,
+  'preprocess': bench_preprocess,
+  'tokenize': bench_tokenize,
+  'startup': bench_startup,
+  'cold_start': bench_cold_start,
+  'decode_modes': bench_decode_modes,
+  'rl': bench_rl,
+  'log_prob': bench_log_prob,
+  'dtype': bench_dtype,
+  'shortlist': bench_shortlist,
+  'distributed': bench_distributed,
+  'cell_impl': bench_cell_impl,
+  'attention': bench_attention,
+  'negative_sampler': bench_negative_sampler,
+  'adaptive_softmax': bench_adaptive_softmax,
+}
+
+
+def benchmark(args):
+  if args.bench not in BENCHMARKS:
+    raise ValueError("Unknown benchmark %s, choose from %s" % (args.bench, sorted(BENCHMARKS)))
+  print("[bench] %s @ %s" % (args.bench, time.ctime()))
+  BENCHMARKS[args.bench](args)
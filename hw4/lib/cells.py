@@ -0,0 +1,202 @@
+"""Recurrent cells of the seq2seq_bi stacks, by implementation.
+
+basic: core_rnn_cell.GRUCell or BasicLSTMCell, a chain of small matmul,
+  split and sigmoid ops per step.
+block: the same cells as a single GRUBlockCell or LSTMBlockCell kernel per
+  step.
+fused: block cells, except that every LSTM encoder layer runs over the whole
+  sequence as one LSTMBlockFusedCell op (fused_encoder); there is no fused
+  GRU kernel, so GRU models use block cells.
+
+Block and fused cells create their variables with the names, shapes and
+layouts of the basic ones, so a checkpoint restores with any of them. The
+kernels are those of tf.contrib.rnn: the copies in tf11_contrib_rnn register
+the same gradients again and cannot be imported next to it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensorflow.contrib.rnn.python.ops import gru_ops
+from tensorflow.contrib.rnn.python.ops import lstm_ops
+
+from lib import quantized_rows
+from lib.tf11_contrib_rnn import core_rnn_cell
+from lib.tf11_contrib_rnn import core_rnn_cell_impl
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import init_ops
+from tensorflow.python.ops import variable_scope as vs
+
+CELL_IMPLS = ("basic", "block", "fused")
+
+# BasicLSTMCell does not clip the cell state; the kernels clip at 3 by default.
+_NO_CELL_CLIP = -1.
+
+
+class GRUBlockCell(core_rnn_cell.RNNCell):
+  """GRUCell computed by one gru_block_cell kernel, with the same variables."""
+
+  def __init__(self, num_units):
+    self._num_units = num_units
+
+  @property
+  def state_size(self):
+    return self._num_units
+
+  @property
+  def output_size(self):
+    return self._num_units
+
+  def __call__(self, inputs, state, scope=None):
+    with vs.variable_scope(scope or "gru_cell"):
+      input_size = inputs.get_shape().with_rank(2)[1].value
+      with vs.variable_scope("gates"):
+        w_ru = vs.get_variable("weights", [input_size + self._num_units, 2 * self._num_units])
+        b_ru = vs.get_variable("biases", [2 * self._num_units],
+                               initializer=init_ops.constant_initializer(1.0))
+      with vs.variable_scope("candidate"):
+        w_c = vs.get_variable("weights", [input_size + self._num_units, self._num_units])
+        b_c = vs.get_variable("biases", [self._num_units],
+                              initializer=init_ops.constant_initializer(0.0))
+      _, _, _, new_h = gru_ops.gen_gru_ops.gru_block_cell(
+          x=inputs, h_prev=state, w_ru=w_ru, w_c=w_c, b_ru=b_ru, b_c=b_c)
+    return new_h, new_h
+
+
+class LSTMBlockCell(core_rnn_cell.RNNCell):
+  """BasicLSTMCell computed by one lstm_block_cell kernel, with the same variables."""
+
+  def __init__(self, num_units, forget_bias=1.0):
+    self._num_units = num_units
+    self._forget_bias = forget_bias
+
+  @property
+  def state_size(self):
+    return core_rnn_cell.LSTMStateTuple(self._num_units, self._num_units)
+
+  @property
+  def output_size(self):
+    return self._num_units
+
+  def __call__(self, inputs, state, scope=None):
+    with vs.variable_scope(scope or "basic_lstm_cell"):
+      input_size = inputs.get_shape().with_rank(2)[1].value
+      w = vs.get_variable("weights", [input_size + self._num_units, 4 * self._num_units])
+      b = vs.get_variable("biases", [4 * self._num_units],
+                          initializer=init_ops.constant_initializer(0.0))
+      peephole = array_ops.zeros([self._num_units], dtype=inputs.dtype)
+      c, h = state
+      # Gates are laid out [i, j, f, o] like in BasicLSTMCell.
+      _, new_c, _, _, _, _, new_h = lstm_ops._lstm_block_cell(  # pylint: disable=protected-access
+          inputs, c, h, w, b, wci=peephole, wcf=peephole, wco=peephole,
+          forget_bias=self._forget_bias, cell_clip=_NO_CELL_CLIP, use_peephole=False)
+    return new_h, core_rnn_cell.LSTMStateTuple(new_c, new_h)
+
+
+def single_cell(size, use_lstm, cell_impl="basic", residual=False):
+  """One layer of the stacks, wrapped with a residual connection if asked."""
+  if cell_impl not in CELL_IMPLS:
+    raise ValueError("Unknown cell implementation %s, choose from %s" % (cell_impl, CELL_IMPLS))
+  if cell_impl == "basic":
+    cell = core_rnn_cell.BasicLSTMCell(size) if use_lstm else core_rnn_cell.GRUCell(size)
+  else:
+    cell = LSTMBlockCell(size) if use_lstm else GRUBlockCell(size)
+  if residual:
+    return core_rnn_cell.ResidualWrapper(cell)
+  return cell
+
+
+def _reverse(inputs):
+  if isinstance(inputs, list):
+    return inputs[::-1]
+  return array_ops.reverse(inputs, [0])
+
+
+def _embedding(num_symbols, embedding_size, dtype, initializer=None):
+  """The embedding variable of EmbeddingWrapper, in the current scope."""
+  initializer = initializer or vs.get_variable_scope().initializer
+  if not initializer:
+    sqrt3 = math.sqrt(3)  # Uniform(-sqrt(3), sqrt(3)) has variance=1.
+    initializer = init_ops.random_uniform_initializer(-sqrt3, sqrt3)
+  return vs.get_variable("embedding", [num_symbols, embedding_size],
+                         initializer=initializer, dtype=dtype)
+
+
+class EmbeddingWrapper(core_rnn_cell.EmbeddingWrapper):
+  """core_rnn_cell.EmbeddingWrapper reading quantised rows, see quantized_rows."""
+
+  def __call__(self, inputs, state, scope=None):
+    """Run the cell on embedded inputs."""
+    with core_rnn_cell_impl._checked_scope(  # pylint: disable=protected-access
+        self, scope or "embedding_wrapper", reuse=self._reuse):
+      with ops.device("/cpu:0"):
+        dtype = state[0].dtype if type(state) is tuple else state.dtype
+        embedding = _embedding(self._embedding_classes, self._embedding_size, dtype,
+                               self._initializer)
+        embedded = quantized_rows.embedding_lookup(embedding, array_ops.reshape(inputs, [-1]))
+    return self._cell(embedded, state)
+
+
+def _embed(inputs, num_symbols, embedding_size, dtype):
+  """The lookups of EmbeddingWrapper, with its variable, for a whole sequence."""
+  with vs.variable_scope("embedding_wrapper"):
+    with ops.device("/cpu:0"):
+      embedding = _embedding(num_symbols, embedding_size, dtype)
+      if isinstance(inputs, list):
+        return [quantized_rows.embedding_lookup(embedding, i) for i in inputs]
+      return quantized_rows.embedding_lookup(embedding, inputs)
+
+
+def _fused_layer(inputs, size, dtype):
+  cell = lstm_ops.LSTMBlockFusedCell(size, cell_clip=_NO_CELL_CLIP)
+  return cell(inputs, dtype=dtype, scope="basic_lstm_cell")
+
+
+def fused_encoder(encoder_inputs, num_encoder_symbols, embedding_size,
+                  num_layers, dtype):
+  """The LSTM encoder of seq2seq_bi with one fused op per layer and direction.
+
+  The variables are those static_bidirectional_rnn and static_rnn (or
+  dynamic_rnn) create for the EmbeddingWrapper, MultiRNNCell and
+  ResidualWrapper cells of the basic encoder.
+
+  Args:
+    encoder_inputs: list of 1D int32 Tensors, or a 2D int32 Tensor
+      [max_time x batch_size].
+
+  Returns:
+    A pair (outputs, encoder_state): the outputs of the top layer, a list or
+    a 3D time-major Tensor like encoder_inputs, and a tuple with the state of
+    the forward layer and of every layer of the stack.
+  """
+  with vs.variable_scope("bidirectional_rnn"):
+    with vs.variable_scope("fw"):
+      output_fw, state_fw = _fused_layer(
+          _embed(encoder_inputs, num_encoder_symbols, embedding_size, dtype),
+          embedding_size, dtype)
+    with vs.variable_scope("bw"):
+      output_bw, _ = _fused_layer(
+          _embed(_reverse(encoder_inputs), num_encoder_symbols, embedding_size, dtype),
+          embedding_size, dtype)
+  if isinstance(output_fw, list):
+    inputs = [array_ops.concat([fw, bw], 1) for fw, bw in zip(output_fw, _reverse(output_bw))]
+  else:
+    inputs = array_ops.concat([output_fw, _reverse(output_bw)], 2)
+
+  states = []
+  with vs.variable_scope("rnn"), vs.variable_scope("multi_rnn_cell"):
+    for l in xrange(num_layers - 1):
+      with vs.variable_scope("cell_%d" % l):
+        outputs, state = _fused_layer(inputs, embedding_size, dtype)
+      if l > 0:  # Layers after the first are residual.
+        if isinstance(outputs, list):
+          outputs = [o + i for o, i in zip(outputs, inputs)]
+        else:
+          outputs += inputs
+      inputs = outputs
+      states.append(state)
+  return outputs, (state_fw, ) + tuple(states)
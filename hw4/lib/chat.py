@@ -16,6 +16,7 @@ def chat(args):
     # Load vocabularies.
     vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
     vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+    tokenizer = data_utils.Tokenizer(vocab)
 
     # Decode from standard input.
     sys.stdout.write("> ")
@@ -23,7 +24,7 @@ def chat(args):
     sentence = sys.stdin.readline()
 
     while sentence:
-        predicted_sentence = get_predicted_sentence(args, sentence, vocab, rev_vocab, model, sess)
+        predicted_sentence = get_predicted_sentence(args, sentence, vocab, rev_vocab, model, sess, tokenizer=tokenizer)
         # print(predicted_sentence)
         if isinstance(predicted_sentence, list):
             for sent in predicted_sentence:
@@ -2,8 +2,9 @@ import argparse
 
 def params_setup(cmdline=None):
   parser = argparse.ArgumentParser()
-  parser.add_argument('--mode', type=str, required=True, help='work mode: train/test/chat')
+  parser.add_argument('--mode', type=str, required=True, help='work mode: train/test/chat/serve/export/quantize/bench')
   parser.add_argument('--bi', type=bool, default=True, help='use bidirectional model')
+  parser.add_argument('--dynamic', type=int, default=0, help='1 for the bidirectional model as one dynamic-length graph instead of one per bucket')
 
   # path ctrl
   parser.add_argument('--model_name', type=str, default='movie_subtitles_en', help='model name, affects data, model, result save path')
@@ -19,24 +20,52 @@ def params_setup(cmdline=None):
   parser.add_argument('--vocab_size', type=int, default=100000, help='Dialog vocabulary size.')
   parser.add_argument('--size', type=int, default=256, help='Size of each model layer.')
   parser.add_argument('--num_layers', type=int, default=3, help='Number of layers in the model.')
+  parser.add_argument('--use_lstm', type=int, default=0, help='1 for LSTM cells instead of GRU cells in the bidirectional model')
+  parser.add_argument('--cell_impl', type=str, default='basic', choices=['basic', 'block', 'fused'], help='bidirectional model cells: basic ops, one block kernel per step, or fused LSTM encoder layers; all share checkpoints')
 
   parser.add_argument('--max_train_data_size', type=int, default=0, help='Limit on the size of training data (0: no limit)')
   parser.add_argument('--steps_per_checkpoint', type=int, default=1000, help='How many training steps to do per checkpoint')
+  parser.add_argument('--negative_sampler', type=str, default='per_step', choices=['per_step', 'log_uniform', 'unigram', 'in_batch'], help='sampled softmax negatives: drawn for every decoder step, or one pool per batch shared by all steps, drawn log-uniformly, by training word counts, or from the targets of the batch')
+  parser.add_argument('--adaptive_softmax', type=str, default='', help='output layer: empty for the output projection with sampled softmax, or an adaptive softmax with clusters cut at the given comma-separated ids, e.g. 2000,10000, or auto for the ids covering 80%% and 95%% of the training words; decode with the same value')
+  parser.add_argument('--batch_sampler', type=str, default='random', choices=['random', 'epoch'], help='random: batches of random pairs of a random bucket; epoch: every pair once per epoch, shuffled within buckets, resumable from checkpoints')
+  parser.add_argument('--prefetch_batches', type=int, default=8, help='training batches assembled ahead of the steps, 0 to assemble them synchronously')
+  parser.add_argument('--prefetch_threads', type=int, default=1, help='threads assembling training batches')
+  parser.add_argument('--preprocess_workers', type=int, default=1, help='processes building vocabulary and token ids, 0 for one per CPU')
+  parser.add_argument('--max_steps', type=int, default=0, help='train mode: stop at this global step, 0 to train until interrupted')
+  parser.add_argument('--workers', type=int, default=0, help='train mode: local data-parallel worker processes sharing the variables through a parameter-server process, 0 to train in this process')
+  parser.add_argument('--ps_port', type=int, default=2222, help='train mode with --workers: port of the parameter server, the workers take the ones after it')
+  parser.add_argument('--seed', type=int, default=None, help='random seed of batch sampling and initialisation, unset for a random run')
 
   # predicting params
   parser.add_argument('--beam_size', type=int, default=1, help='beam search size')
   parser.add_argument('--antilm', type=float, default=0, help='anti-language model weight')
+  parser.add_argument('--length_penalty', type=float, default=0.0, help='beam search length normalisation strength, 0 to disable')
   parser.add_argument('--n_bonus', type=int, default=0, help='bonus with sentence length')
   parser.add_argument('--simple_output', type=bool, default=True, help='simple output')
+  parser.add_argument('--predict_batch_size', type=int, default=1, help='sentences decoded together in test mode, grouped by bucket')
+  parser.add_argument('--decode_mode', type=str, default='', choices=['', 'infer_greedy', 'infer_forced'], help='test/chat/serve modes: build only the greedy or the forced-input decoder, without conds')
+  parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='test/chat/serve modes: float16 casts the float32 checkpoint to half precision, except the output projection')
+  parser.add_argument('--quantized', type=str, default=None, help='int8 matrices from quantize mode to decode with in test/chat/serve modes; quantize mode writes them here')
+  parser.add_argument('--shortlist', type=int, default=0, help='test/chat/serve modes: decode over the this many most frequent words plus words aligned to the input, 0 for the full vocabulary')
+  parser.add_argument('--shortlist_aligned', type=int, default=20, help='words aligned to each input token added to the shortlist')
+  parser.add_argument('--frozen_graph', type=str, default=None, help='frozen graph from export mode to decode with in test/chat/serve modes; export mode writes it here')
+  parser.add_argument('--serve_host', type=str, default='127.0.0.1', help='serve mode: address to listen on')
+  parser.add_argument('--serve_port', type=int, default=8000, help='serve mode: port to listen on')
+  parser.add_argument('--batch_window_ms', type=float, default=10, help='serve mode: time requests wait to be batched with others')
+  parser.add_argument('--serve_max_batch', type=int, default=32, help='serve mode: maximum requests decoded together')
 
   # environment params
   parser.add_argument('--gpu_usage', type=float, default=1.0, help='tensorflow gpu memory fraction used')
   parser.add_argument('--rev_model', type=int, default=0, help='reverse Q-A pair, for bi-direction model')
   parser.add_argument('--reinforce_learn', type=int, default=0, help='1 to enable reinforcement learning mode')
+  parser.add_argument('--rl_max_turns', type=int, default=10, help='reinforcement learning: maximum turns of an episode')
   parser.add_argument('--scheduled_sampling', type=bool, default=False, help='enable scheduled sampling mode')
   parser.add_argument('--en_tfboard', type=int, default=0, help='Enable writing out tensorboard meta data')
   parser.add_argument('--test_dataset_path', type=str, default='sample_input', help='test_dataset_path')
   parser.add_argument('--results_dir', type=str, default='sample_output', help='results_dir')
+  parser.add_argument('--bench', type=str, default='incremental_decode', help='benchmark to run in bench mode')
+  parser.add_argument('--bench_repeats', type=int, default=10, help='timed repeats per benchmark case')
+  parser.add_argument('--bench_seconds', type=float, default=60, help='training time per case of training benchmarks')
   # parser.add_argument('--version', type=str, default='S2S', help='version')
 
 
@@ -18,9 +18,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import sys, os, re, gzip, tarfile
+import sys, os, re, gzip, tarfile, random, shutil
+import multiprocessing
+from functools import lru_cache
+from array import array
+
+import numpy as np
 
 from six.moves import urllib
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensorflow.python.platform import gfile
 import tensorflow as tf
@@ -165,15 +171,33 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
             vocab[word] += 1
           else:
             vocab[word] = 1
-      vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-      if len(vocab_list) > max_vocabulary_size:
-        vocab_list = vocab_list[:max_vocabulary_size]
-      with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-        for w in vocab_list:
-          vocab_file.write(w + b"\n")
+      _write_vocabulary(vocabulary_path, vocab, max_vocabulary_size)
+
+
+def vocabulary_counts_path(vocabulary_path):
+  return vocabulary_path + ".counts.npy"
 
 
-def initialize_vocabulary(vocabulary_path):
+def _write_vocabulary(vocabulary_path, vocab, max_vocabulary_size):
+  """Write the most frequent words of vocab, a word-to-count dict.
+
+  The sort is stable, so words of equal count keep the order of vocab. Their
+  counts are saved next to the vocabulary, see vocabulary_counts_path.
+  """
+  vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+  if len(vocab_list) > max_vocabulary_size:
+    vocab_list = vocab_list[:max_vocabulary_size]
+  # Token-ids of the data have the counts of the words, and UNK those of the
+  # words left out.
+  counts = np.array([vocab.get(w, 0) for w in vocab_list], dtype=np.int64)
+  counts[UNK_ID] += sum(vocab.values()) - counts[len(_START_VOCAB):].sum()
+  _save_npy(vocabulary_counts_path(vocabulary_path), counts)
+  with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+    for w in vocab_list:
+      vocab_file.write(w + b"\n")
+
+
+def initialize_vocabulary(vocabulary_path, with_counts=False):
   """Initialize vocabulary from file.
 
   We assume the vocabulary is stored one-item-per-line, so a file:
@@ -184,10 +208,12 @@ def initialize_vocabulary(vocabulary_path):
 
   Args:
     vocabulary_path: path to the file containing the vocabulary.
+    with_counts: Boolean; if true, also return the word counts.
 
   Returns:
     a pair: the vocabulary (a dictionary mapping string to integers), and
-    the reversed vocabulary (a list, which reverses the vocabulary mapping).
+    the reversed vocabulary (a list, which reverses the vocabulary mapping);
+    with_counts adds a third element, the int64 array of load_vocabulary_counts.
 
   Raises:
     ValueError: if the provided vocabulary_path does not exist.
@@ -198,11 +224,30 @@ def initialize_vocabulary(vocabulary_path):
       rev_vocab.extend(f.readlines())
     rev_vocab = [tf.compat.as_bytes(line.strip()) for line in rev_vocab]
     vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
+    if with_counts:
+      return vocab, rev_vocab, load_vocabulary_counts(vocabulary_path)
     return vocab, rev_vocab
   else:
     raise ValueError("Vocabulary file %s not found.", vocabulary_path)
 
 
+def load_vocabulary_counts(vocabulary_path):
+  """Occurrences of every word of a vocabulary in the data it was built from.
+
+  counts[i] is the number of times id i occurs in the token-ids of that data:
+  UNK counts every word left out of the vocabulary, the other special
+  symbols are 0.
+
+  Returns:
+    an int64 array with one count per line of vocabulary_path, or None for
+    vocabularies created before the counts were saved.
+  """
+  counts_path = vocabulary_counts_path(vocabulary_path)
+  if not gfile.Exists(counts_path):
+    return None
+  return np.load(counts_path)
+
+
 def sentence_to_token_ids(sentence, vocabulary,
                           tokenizer=None, normalize_digits=True):
   """Convert a string to list of integers representing token-ids.
@@ -232,6 +277,51 @@ def sentence_to_token_ids(sentence, vocabulary,
   return [vocabulary.get(_DIGIT_RE.sub(b"0", w), UNK_ID) for w in words]
 
 
+class Tokenizer(object):
+  """sentence_to_token_ids with basic_tokenizer, built once for a vocabulary.
+
+  Lowercasing and digit normalization are one bytes.translate, the word
+  splitting one precompiled findall over each whitespace-separated fragment,
+  and the ids of recent fragments are kept in an LRU cache, so frequent
+  words skip all of it. Ids are the same as sentence_to_token_ids gives.
+  """
+
+  def __init__(self, vocabulary, normalize_digits=True, cache_size=100000):
+    """Create the tokenizer.
+
+    Args:
+      vocabulary: a dictionary mapping tokens to integers.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      cache_size: number of fragments whose ids are cached.
+    """
+    self.vocabulary = vocabulary
+    table = bytearray(range(256))
+    table[ord("A"):ord("Z") + 1] = b"abcdefghijklmnopqrstuvwxyz"
+    if normalize_digits:
+      table[ord("0"):ord("9") + 1] = b"0" * 10
+    self._table = bytes(table)
+    # The fragments _WORD_SPLIT.split gives, without the empty ones.
+    self._word_re = re.compile(b"[.,!?\"':;)(]|[^.,!?\"':;)(]+")
+    self._fragment_ids = lru_cache(maxsize=cache_size)(self._uncached_fragment_ids)
+
+  def _uncached_fragment_ids(self, fragment):
+    if isinstance(fragment, str):
+      fragment = fragment.encode()
+    words = self._word_re.findall(fragment.translate(self._table))
+    return tuple(self.vocabulary.get(w, UNK_ID) for w in words)
+
+  def encode(self, sentence):
+    """Token-ids of a sentence, in bytes or str format."""
+    token_ids = []
+    for fragment in sentence.split():
+      token_ids.extend(self._fragment_ids(fragment))
+    return token_ids
+
+  def encode_many(self, sentences):
+    """Token-ids of each of a list of sentences."""
+    return [self.encode(sentence) for sentence in sentences]
+
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
                       tokenizer=None, normalize_digits=True):
   """Tokenize data file and turn into token-ids using given vocabulary file.
@@ -268,6 +358,321 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
           tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
 
 
+def _shard_boundaries(data_path, num_shards):
+  """Byte offsets splitting data_path into num_shards runs of whole lines."""
+  size = os.path.getsize(data_path)
+  boundaries = [0]
+  with open(data_path, "rb") as f:
+    for i in xrange(1, num_shards):
+      # A shard starts after the first newline at or past its share.
+      f.seek(max(size * i // num_shards - 1, boundaries[-1]))
+      f.readline()
+      boundaries.append(max(f.tell(), boundaries[-1]))
+  boundaries.append(size)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _tokenize_shard(shard):
+  """Tokenize the lines of one byte range, counting the words.
+
+  The normalized words are written to tokens_path one line per line, space
+  separated, so turning them into ids does not tokenize again.
+
+  Returns:
+    a dict from word to count, in order of first occurrence.
+  """
+  data_path, start, end, tokens_path, tokenizer, normalize_digits = shard
+  counts = {}
+  with open(data_path, "rb") as data_file, open(tokens_path, "wb") as tokens_file:
+    data_file.seek(start)
+    position = start
+    while position < end:
+      line = data_file.readline()
+      if not line:
+        break
+      position += len(line)
+      words = tokenizer(line) if tokenizer else basic_tokenizer(line)
+      if normalize_digits:
+        words = [_DIGIT_RE.sub(b"0", w) for w in words]
+      for w in words:
+        counts[w] = counts.get(w, 0) + 1
+      tokens_file.write(b" ".join(words) + b"\n")
+  return counts
+
+
+def _token_ids_shard(shard):
+  """Look up the words written by _tokenize_shard, one ids line per line."""
+  tokens_path, ids_path, vocabulary_path = shard
+  vocab, _ = initialize_vocabulary(vocabulary_path)
+  with open(tokens_path, "rb") as tokens_file, open(ids_path, "w") as ids_file:
+    for line in tokens_file:
+      ids_file.write(" ".join([str(vocab.get(w, UNK_ID)) for w in line.split()]) + "\n")
+
+
+def parallel_data_to_token_ids(data_path, target_path, vocabulary_path,
+                               max_vocabulary_size=None, num_workers=None,
+                               tokenizer=None, normalize_digits=True):
+  """Parallel create_vocabulary and data_to_token_ids, tokenizing once.
+
+  data_path is split into num_workers byte ranges of whole lines, which a
+  process pool tokenizes. The per-shard word counts are merged in shard
+  order, so words of equal count rank as in create_vocabulary, and the
+  vocabulary and token-ids files are byte-identical to the serial ones.
+
+  Args:
+    data_path: path to the data file in one-sentence-per-line format.
+    target_path: path where the file with token-ids will be created.
+    vocabulary_path: path to the vocabulary file, created from data_path if
+      it does not exist yet.
+    max_vocabulary_size: limit on the size of a created vocabulary.
+    num_workers: number of processes, the number of CPUs if None.
+    tokenizer: a module-level function to use to tokenize each sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+  """
+  create_vocab = not gfile.Exists(vocabulary_path)
+  if not create_vocab and gfile.Exists(target_path):
+    return
+  num_workers = num_workers or multiprocessing.cpu_count()
+  print("Tokenizing data in %s with %d workers" % (data_path, num_workers))
+  shards = _shard_boundaries(data_path, num_workers)
+  tokens_paths = ["%s.tokens%d.tmp" % (target_path, i) for i in xrange(len(shards))]
+  ids_paths = ["%s.ids%d.tmp" % (target_path, i) for i in xrange(len(shards))]
+
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    shard_counts = pool.map(_tokenize_shard, [
+        (data_path, start, end, tokens_path, tokenizer, normalize_digits)
+        for (start, end), tokens_path in zip(shards, tokens_paths)])
+    if create_vocab:
+      print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
+      vocab = {}
+      for counts in shard_counts:
+        for w, count in counts.items():
+          vocab[w] = vocab.get(w, 0) + count
+      _write_vocabulary(vocabulary_path, vocab, max_vocabulary_size)
+    if not gfile.Exists(target_path):
+      pool.map(_token_ids_shard, zip(tokens_paths, ids_paths,
+                                     [vocabulary_path] * len(shards)))
+      with open(target_path, "wb") as target_file:
+        for ids_path in ids_paths:
+          with open(ids_path, "rb") as ids_file:
+            shutil.copyfileobj(ids_file, target_file)
+  finally:
+    pool.close()
+    pool.join()
+    for path in tokens_paths + ids_paths:
+      if os.path.exists(path):
+        os.remove(path)
+
+
+def _binary_paths(ids_path):
+  return ids_path + ".tokens.npy", ids_path + ".offsets.npy"
+
+
+def _bucket_index_path(ids_path, buckets, reversed=False):
+  key = "_".join("%dx%d" % (s, t) for s, t in buckets)
+  return ids_path + (".buckets%s%s.npy" % (key, ".rev" if reversed else ""))
+
+
+def _save_npy(path, value):
+  # Write then rename, so concurrent readers never map a partial file.
+  tmp_path = path + ".tmp%d" % os.getpid()
+  with open(tmp_path, "wb") as f:
+    np.save(f, value)
+  os.rename(tmp_path, path)
+
+
+def token_ids_to_binary(ids_path, buckets=None):
+  """Convert a token-ids file to the binary format read_data memory-maps.
+
+  Two arrays are written next to ids_path: ids_path.tokens.npy, all token-ids
+  of the file as one flat int32 array, and ids_path.offsets.npy, where line i
+  is tokens[offsets[i]:offsets[i + 1]]. If buckets are given the per-bucket
+  index arrays are written as well (see bucket_index).
+
+  Args:
+    ids_path: path to the file with token-ids, one sentence per line.
+    buckets: optional list of (source_size, target_size) pairs.
+  """
+  tokens_path, offsets_path = _binary_paths(ids_path)
+  if not (gfile.Exists(tokens_path) and gfile.Exists(offsets_path)):
+    print("Writing binary token-ids of %s" % ids_path)
+    tokens, offsets = array("i"), array("q", [0])
+    with gfile.GFile(ids_path, mode="r") as fh:
+      counter = 0
+      for line in fh:
+        counter += 1
+        if counter % 100000 == 0:
+          print("  converting line %d" % counter)
+        tokens.extend(int(x) for x in line.split())
+        offsets.append(len(tokens))
+    _save_npy(tokens_path, np.frombuffer(tokens, dtype=np.int32))
+    _save_npy(offsets_path, np.array(offsets, dtype=np.int64))
+  if buckets:
+    offsets = np.load(offsets_path, mmap_mode="r")
+    for rev in (False, True):
+      bucket_index(ids_path, offsets, buckets, reversed=rev)
+
+
+def bucket_index(ids_path, offsets, buckets, max_size=None, reversed=False):
+  """Pair indices of each bucket, cached on disk next to ids_path.
+
+  Pair p is lines 2p (source) and 2p + 1 (target), swapped if reversed. It
+  goes to the first bucket both sentences fit into, EOS included, the same
+  rule read_data applies to text files.
+
+  Returns:
+    a list of len(buckets) int64 arrays of pair indices.
+  """
+  index_path = _bucket_index_path(ids_path, buckets, reversed)
+  if gfile.Exists(index_path):
+    pair_bucket = np.load(index_path, mmap_mode="r")
+  else:
+    lengths = np.diff(offsets) + 1  # EOS
+    n_pairs = len(lengths) // 2
+    source_len, target_len = lengths[0:2 * n_pairs:2], lengths[1:2 * n_pairs:2]
+    if reversed:
+      source_len, target_len = target_len, source_len
+    # len(buckets) marks pairs that fit no bucket.
+    pair_bucket = np.full(n_pairs, len(buckets), dtype=np.int8)
+    for bucket_id in xrange(len(buckets) - 1, -1, -1):
+      source_size, target_size = buckets[bucket_id]
+      pair_bucket[(source_len < source_size) & (target_len < target_size)] = bucket_id
+    _save_npy(index_path, pair_bucket)
+  if max_size:
+    pair_bucket = pair_bucket[:max_size]
+  return [np.flatnonzero(pair_bucket == bucket_id) for bucket_id in xrange(len(buckets))]
+
+
+class BucketData(object):
+  """Read-only list of the [source_ids, target_ids] pairs of one bucket.
+
+  Sentences are sliced out of the memory-mapped token array on access, EOS
+  appended, so only the pairs actually batched are turned into lists.
+  """
+
+  def __init__(self, tokens, offsets, pair_ids, reversed=False):
+    self.tokens = tokens
+    self.offsets = offsets
+    self.pair_ids = pair_ids
+    self.reversed = reversed
+
+  def __len__(self):
+    return len(self.pair_ids)
+
+  def _sentence(self, line):
+    ids = self.tokens[self.offsets[line]:self.offsets[line + 1]].tolist()
+    ids.append(EOS_ID)
+    return ids
+
+  def __getitem__(self, i):
+    line = 2 * int(self.pair_ids[i])
+    source_ids, target_ids = self._sentence(line), self._sentence(line + 1)
+    if self.reversed:
+      source_ids, target_ids = target_ids, source_ids
+    return [source_ids, target_ids]
+
+  def _padded(self, lines, size, offset):
+    starts, lengths = self.offsets[lines], self.offsets[lines + 1] - self.offsets[lines]
+    columns = np.arange(size - offset)
+    fill = columns < lengths[:, None]
+    matrix = np.full((len(lines), size), PAD_ID, dtype=np.int32)
+    matrix[:, offset:][fill] = self.tokens[(starts[:, None] + columns)[fill]]
+    matrix[np.arange(len(lines)), offset + lengths] = EOS_ID
+    return matrix
+
+  def padded(self, indices, encoder_size, decoder_size):
+    """Padded matrices of the given pairs, see pad_pairs."""
+    source_lines = 2 * np.asarray(self.pair_ids)[np.asarray(indices, dtype=np.int64)]
+    target_lines = source_lines + 1
+    if self.reversed:
+      source_lines, target_lines = target_lines, source_lines
+    decoder = self._padded(target_lines, decoder_size, 1)
+    decoder[:, 0] = GO_ID
+    return self._padded(source_lines, encoder_size, 0), decoder
+
+
+class PaddedBucket(object):
+  """The pairs of one bucket as padded int32 matrices, see pad_pairs."""
+
+  def __init__(self, encoder, decoder):
+    self.encoder = encoder
+    self.decoder = decoder
+
+  def __len__(self):
+    return len(self.encoder)
+
+  def padded(self, indices, encoder_size, decoder_size):
+    return self.encoder[indices], self.decoder[indices]
+
+
+def pad_pairs(pairs, encoder_size, decoder_size):
+  """Pad [source_ids, target_ids] pairs into batch-major int32 matrices.
+
+  Sources are PAD-padded to encoder_size, targets get a GO symbol in front and
+  are PAD-padded to decoder_size. Overlong sentences are cut the way the
+  time-major batch used to be: sources keep their last encoder_size tokens,
+  targets their first decoder_size - 1.
+
+  Returns:
+    a pair of [len(pairs) x encoder_size] and [len(pairs) x decoder_size]
+    matrices.
+  """
+  encoder = np.full((len(pairs), encoder_size), PAD_ID, dtype=np.int32)
+  decoder = np.full((len(pairs), decoder_size), PAD_ID, dtype=np.int32)
+  decoder[:, 0] = GO_ID
+  for i, (source_ids, target_ids) in enumerate(pairs):
+    source_ids, target_ids = source_ids[-encoder_size:], target_ids[:decoder_size - 1]
+    encoder[i, :len(source_ids)] = source_ids
+    decoder[i, 1:len(target_ids) + 1] = target_ids
+  return encoder, decoder
+
+
+def pad_data(data_set, buckets):
+  """Pre-pad the buckets of read_data, so batches are sliced out of matrices.
+
+  Memory-mapped buckets are kept as they are, they pad on access.
+  """
+  return [bucket if hasattr(bucket, "padded") else PaddedBucket(*pad_pairs(bucket, *size))
+          for bucket, size in zip(data_set, buckets)]
+
+
+def get_batch(bucket, bucket_size, batch_size, batch_indices=None):
+  """Time-major batch of the given pairs of one bucket, as fed to step().
+
+  Args:
+    bucket: list of [source_ids, target_ids] pairs, or a PaddedBucket or
+      BucketData.
+    bucket_size: the (encoder_size, decoder_size) of the bucket.
+    batch_size: number of random pairs to draw if batch_indices is None.
+    batch_indices: optional indices into bucket of the pairs to batch.
+
+  Returns:
+    The triple (encoder_inputs, decoder_inputs, target_weights): lists of
+    encoder_size and decoder_size batch vectors, encoder inputs reversed.
+  """
+  encoder_size, decoder_size = bucket_size
+  if batch_indices is None:
+    # One randrange per pair, the draws random.choice makes.
+    batch_indices = [random.randrange(len(bucket)) for _ in xrange(batch_size)]
+
+  if hasattr(bucket, "padded"):
+    encoder, decoder = bucket.padded(batch_indices, encoder_size, decoder_size)
+  else:
+    encoder, decoder = pad_pairs([bucket[i] for i in batch_indices], encoder_size, decoder_size)
+
+  # Targets are the decoder inputs shifted by one, the last one is never a
+  # target; weights are 0 where the target is a PAD symbol.
+  weights = np.zeros(decoder.shape, dtype=np.float32)
+  weights[:, :-1] = decoder[:, 1:] != PAD_ID
+
+  # Rows of the transposed matrices are the time-major batch vectors.
+  return (list(np.ascontiguousarray(np.flip(encoder, axis=1).T)),
+          list(np.ascontiguousarray(decoder.T)),
+          list(np.ascontiguousarray(weights.T)))
+
+
 def prepare_wmt_data(data_dir, en_vocabulary_size, fr_vocabulary_size, tokenizer=None):
   """Get WMT data into data_dir, create vocabularies and tokenize data.
 
@@ -347,12 +752,19 @@ def prepare_data(data_dir, from_train_path, to_train_path, from_dev_path, to_dev
 
 
 
-def prepare_dialog_data(data_dir, vocabulary_size):
+def prepare_dialog_data(data_dir, vocabulary_size, buckets=None, num_workers=1):
   """Get dialog data into data_dir, create vocabularies and tokenize data.
 
+  The token-ids files are also written in the binary format of
+  token_ids_to_binary, which read_data memory-maps when it is present.
+
   Args:
     data_dir: directory in which the data sets will be stored.
     vocabulary_size: size of the English vocabulary to create and use.
+    buckets: optional list of (source_size, target_size) pairs to write the
+      per-bucket index arrays for.
+    num_workers: number of processes tokenizing the data, see
+      parallel_data_to_token_ids; 1 tokenizes serially.
 
   Returns:
     A tuple of 3 elements:
@@ -364,17 +776,27 @@ def prepare_dialog_data(data_dir, vocabulary_size):
   train_path = get_dialog_train_set_path(data_dir)
   dev_path = get_dialog_dev_set_path(data_dir)
 
-  # Create vocabularies of the appropriate sizes.
   vocab_path = os.path.join(data_dir, "vocab%d.in" % vocabulary_size)
-  create_vocabulary(vocab_path, train_path + ".in", vocabulary_size)
-
-  # Create token ids for the training data.
   train_ids_path = train_path + (".ids%d.in" % vocabulary_size)
-  data_to_token_ids(train_path + ".in", train_ids_path, vocab_path)
-
-  # Create token ids for the development data.
   dev_ids_path = dev_path + (".ids%d.in" % vocabulary_size)
-  data_to_token_ids(dev_path + ".in", dev_ids_path, vocab_path)
+  if num_workers != 1:
+    # Vocabulary and token ids of the training data from one tokenization.
+    parallel_data_to_token_ids(train_path + ".in", train_ids_path, vocab_path,
+                               vocabulary_size, num_workers)
+    parallel_data_to_token_ids(dev_path + ".in", dev_ids_path, vocab_path,
+                               num_workers=num_workers)
+  else:
+    # Create vocabularies of the appropriate sizes.
+    create_vocabulary(vocab_path, train_path + ".in", vocabulary_size)
+
+    # Create token ids for the training data.
+    data_to_token_ids(train_path + ".in", train_ids_path, vocab_path)
+
+    # Create token ids for the development data.
+    data_to_token_ids(dev_path + ".in", dev_ids_path, vocab_path)
+
+  token_ids_to_binary(train_ids_path, buckets)
+  token_ids_to_binary(dev_ids_path, buckets)
 
   return (train_ids_path, dev_ids_path, vocab_path)
 
@@ -382,6 +804,9 @@ def prepare_dialog_data(data_dir, vocabulary_size):
 def read_data(tokenized_dialog_path, buckets, max_size=None, reversed=False):
   """Read data from source file and put into buckets.
 
+  If the binary format of token_ids_to_binary exists next to the file it is
+  memory-mapped instead of parsed, and each bucket is a BucketData.
+
   Args:
     source_path: path to the files with token-ids.
     max_size: maximum number of lines to read, all other will be ignored;
@@ -393,12 +818,17 @@ def read_data(tokenized_dialog_path, buckets, max_size=None, reversed=False):
       into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
       len(target) < _buckets[n][1]; source and target are lists of token-ids.
   """
+  tokens_path, offsets_path = _binary_paths(tokenized_dialog_path)
+  if gfile.Exists(tokens_path) and gfile.Exists(offsets_path):
+    tokens = np.load(tokens_path, mmap_mode="r")
+    offsets = np.load(offsets_path, mmap_mode="r")
+    return [BucketData(tokens, offsets, pair_ids, reversed)
+            for pair_ids in bucket_index(tokenized_dialog_path, offsets, buckets, max_size, reversed)]
+
   data_set = [[] for _ in buckets]
 
   with gfile.GFile(tokenized_dialog_path, mode="r") as fh:
       source, target = fh.readline(), fh.readline()
-      if reversed:
-        source, target = target, source  # reverse Q-A pair, for bi-direction model
       counter = 0
       while source and target and (not max_size or counter < max_size):
         counter += 1
@@ -410,6 +840,8 @@ def read_data(tokenized_dialog_path, buckets, max_size=None, reversed=False):
         source_ids.append(EOS_ID)
         target_ids = [int(x) for x in target.split()]
         target_ids.append(EOS_ID)
+        if reversed:
+          source_ids, target_ids = target_ids, source_ids  # reverse Q-A pair, for bi-direction model
 
         for bucket_id, (source_size, target_size) in enumerate(buckets):
           if len(source_ids) < source_size and len(target_ids) < target_size:
@@ -0,0 +1,74 @@
+"""Data-parallel training in local processes.
+
+The cluster is one parameter server and n workers on this machine, each a
+process with its own tf.train.Server. Every worker builds the whole model
+with tf.train.replica_device_setter, which places its variables on the
+parameter server, draws its own batches and applies its gradients to them
+asynchronously. Variable names are those of a single-process model, so the
+checkpoints the chief writes with model.saver load in every mode.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+
+import tensorflow as tf
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from lib import seq2seq_model_utils
+
+
+def local_cluster(n_workers, port):
+  """ClusterSpec of a parameter server at port and n_workers after it."""
+  return tf.train.ClusterSpec({
+    "ps": ["localhost:%d" % port],
+    "worker": ["localhost:%d" % (port + 1 + i) for i in xrange(n_workers)],
+  })
+
+
+def _session_config(cluster, job_name, task):
+  # The CPUs are shared out between the workers, and each process only
+  # connects to the parameter server and itself.
+  threads = max(1, multiprocessing.cpu_count() // cluster.num_tasks("worker"))
+  return tf.ConfigProto(intra_op_parallelism_threads=threads,
+                        inter_op_parallelism_threads=threads,
+                        device_filters=["/job:ps", "/job:%s/task:%d" % (job_name, task)])
+
+
+def _parameter_server(cluster):
+  server = tf.train.Server(cluster, job_name="ps", task_index=0,
+                           config=_session_config(cluster, "ps", 0))
+  server.join()
+
+
+def start_parameter_server(cluster):
+  """Start the parameter server of cluster in a process; terminate it to stop."""
+  ps = multiprocessing.Process(target=_parameter_server, args=(cluster,))
+  ps.daemon = True
+  ps.start()
+  return ps
+
+
+def replica_session(args, cluster, task):
+  """Server, model replica and session of worker task of cluster.
+
+  Worker 0, the chief, restores the latest checkpoint of args.model_dir or
+  initialises the variables; the other workers wait until it has.
+
+  Returns:
+    A triple (session, model, supervisor); stop the supervisor when done.
+  """
+  config = _session_config(cluster, "worker", task)
+  server = tf.train.Server(cluster, job_name="worker", task_index=task, config=config)
+  with tf.device(tf.train.replica_device_setter(
+      worker_device="/job:worker/task:%d" % task, cluster=cluster)):
+    model = seq2seq_model_utils.build_model(args, predict_or_train=False)
+  # Checkpoints are written by the training loop, not by supervisor threads.
+  supervisor = tf.train.Supervisor(is_chief=(task == 0), logdir=args.model_dir,
+                                   saver=model.saver, global_step=model.global_step,
+                                   summary_op=None, summary_writer=None,
+                                   save_model_secs=0, recovery_wait_secs=1)
+  session = supervisor.prepare_or_wait_for_session(server.target, config=config,
+                                                   start_standard_services=False)
+  return session, model, supervisor
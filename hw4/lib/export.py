@@ -0,0 +1,167 @@
+"""Export of frozen inference graphs for the test, chat and serve modes.
+
+export(args) builds the inference model without conds (decode_mode
+'infer_greedy'), restores its checkpoint and writes only what the decode mode
+of args.beam_size needs as a GraphDef: variables become constants, constant
+subexpressions are evaluated once, and everything else is dropped. A JSON signature next to the
+graph names the tensors to feed and fetch. frozen_model.FrozenModel loads
+both and decodes like the model it was exported from, without building or
+restoring it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import json
+import os
+import time
+
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+from tensorflow.python.framework import op_def_registry
+from tensorflow.python.framework import tensor_util
+from tensorflow.python.util import nest
+
+from lib.frozen_model import signature_path
+from lib.seq2seq_model_utils import create_model
+
+# Control flow has to run in its frame; it is never folded.
+_CONTROL_FLOW_OPS = set(["Switch", "RefSwitch", "Merge", "RefMerge", "Enter",
+                         "RefEnter", "Exit", "RefExit", "NextIteration",
+                         "RefNextIteration", "LoopCond", "ControlTrigger"])
+
+
+def _decode_mode(args):
+  return 'greedy' if args.beam_size == 1 else 'beam'
+
+
+def _names(tensors):
+  return [t.name for t in tensors]
+
+
+def _signature(args, model):
+  """Names of the tensors the decode mode feeds and fetches."""
+  decode_mode = _decode_mode(args)
+  signature = {
+    'decode_mode'     : decode_mode,
+    'buckets'         : args.buckets,
+    'encoder_inputs'  : _names(model.encoder_inputs),
+  }
+  if decode_mode == 'greedy':
+    signature['decoder_inputs'] = _names(model.decoder_inputs[:args.buckets[-1][1]])
+    signature['outputs'] = [_names(outputs) for outputs in model.outputs]
+  else:
+    signature['attention_memory'] = _names(model.attention_memory)
+    signature['initial_decoder_state'] = [_names(s) for s in model.initial_decoder_state]
+    signature['step_decoder_input'] = model.step_decoder_input.name
+    signature['step_attention_memory'] = model.step_attention_memory.name
+    signature['step_decoder_state'] = _names(model.step_decoder_state)
+    signature['step_logits'] = _names(model.step_logits)
+    signature['step_next_state'] = [_names(s) for s in model.step_next_state]
+  return signature
+
+
+def _fetched_nodes(signature):
+  names = []
+  for key in ('outputs', 'attention_memory', 'initial_decoder_state', 'step_logits',
+              'step_next_state'):
+    names.extend(nest.flatten(signature.get(key, [])))
+  return sorted(set(name.split(":")[0] for name in names))
+
+
+def _fold_constants(graph_def, output_nodes):
+  """Evaluate the stateless nodes computed from constants alone.
+
+  Their outputs that are read by other nodes become constants, e.g. the
+  transposed output projection, and the nodes computing them are dropped.
+  """
+  ops = op_def_registry.get_registered_ops()
+  nodes = dict((node.name, node) for node in graph_def.node)
+  # Nodes are in creation order, so inputs come first except for loop
+  # back edges, which enter through Merge and are never folded.
+  foldable = {}
+  for node in graph_def.node:
+    foldable[node.name] = node.op == "Const" or (
+        node.op not in _CONTROL_FLOW_OPS and not ops[node.op].is_stateful and
+        bool(node.input) and not any(i.startswith("^") for i in node.input) and
+        all(foldable.get(i.split(":")[0], False) for i in node.input))
+
+  # Tensors of folded nodes read by nodes that are not folded.
+  frontier = set()
+  for node in graph_def.node:
+    if foldable[node.name]:
+      continue
+    for i in node.input:
+      name = i.split(":")[0]
+      if not i.startswith("^") and nodes[name].op != "Const" and foldable[name]:
+        frontier.add(i if ":" in i else i + ":0")
+  if not frontier:
+    return graph_def
+  frontier = sorted(frontier)
+
+  with tf.Graph().as_default() as graph:
+    tf.import_graph_def(graph_def, name="")
+    with tf.Session(graph=graph) as sess:
+      values = sess.run(frontier)
+
+  folded = tf.GraphDef()
+  folded.CopyFrom(graph_def)
+  replacements = {}
+  for tensor_name, value in zip(frontier, values):
+    name, index = tensor_name.split(":")
+    const = folded.node.add()
+    const.name = "%s/folded_%s" % (name, index)
+    const.op = "Const"
+    const.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+    const.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    replacements[tensor_name] = const.name
+    if index == "0":
+      replacements[name] = const.name
+  for node in folded.node:
+    for j, i in enumerate(node.input):
+      if i in replacements and not foldable[node.name]:
+        node.input[j] = replacements[i]
+  return graph_util.extract_sub_graph(folded, output_nodes)
+
+
+def export_frozen_graph(args, path):
+  """Write the frozen graph of args' model and decode mode to path.
+
+  Returns:
+    The signature written next to it.
+  """
+  if args.dynamic:
+    raise ValueError("export supports the bucketed model (--dynamic 0)")
+  model_args = copy.copy(args)
+  model_args.frozen_graph = None  # Build the model, not the graph at path.
+  # Only the greedy decoder, without conds; beam search uses none of them.
+  model_args.decode_mode = 'infer_greedy'
+  with tf.Graph().as_default() as graph, tf.Session() as sess:
+    model = create_model(sess, model_args, predict_or_train=True)
+    signature = _signature(args, model)
+    output_nodes = _fetched_nodes(signature)
+    graph_def = graph_util.convert_variables_to_constants(
+        sess, graph.as_graph_def(), output_nodes)
+  graph_def = _fold_constants(graph_def, output_nodes)
+
+  with tf.gfile.GFile(path, "wb") as f:
+    f.write(graph_def.SerializeToString())
+  with open(signature_path(path), "w") as f:
+    json.dump(signature, f)
+  return signature
+
+
+def frozen_graph_path(args):
+  """--frozen_graph, or frozen_<decode mode>.pb in the model dir."""
+  if args.frozen_graph:
+    return args.frozen_graph
+  return os.path.join(args.model_dir, "frozen_%s.pb" % _decode_mode(args))
+
+
+def export(args):
+  path = frozen_graph_path(args)
+  start_time = time.time()
+  export_frozen_graph(args, path)
+  print("[export] %s graph written in %s (%.1f MB, %.2fs)" %
+        (_decode_mode(args), path, os.path.getsize(path) / 2.**20, time.time() - start_time))
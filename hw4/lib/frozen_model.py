@@ -0,0 +1,104 @@
+"""Decoding from a frozen inference graph written by export."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import tensorflow as tf
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from lib import cells  # pylint: disable=unused-import; registers the block-cell kernels
+from lib import data_utils
+
+
+def signature_path(path):
+  """The JSON signature of the frozen graph at path."""
+  return path + ".json"
+
+
+class FrozenModel(object):
+  """Decodes from a graph written by export.export, in place of Seq2SeqModel.
+
+  get_batch, encode and decode_step work as in seq2seq_model_bi; step only
+  runs the greedy forward pass of a greedy graph and returns no loss.
+  """
+
+  def __init__(self, path, batch_size=1):
+    """Import the graph at path into the default graph."""
+    with open(signature_path(path)) as f:
+      signature = json.load(f)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+      graph_def.ParseFromString(f.read())
+    tf.import_graph_def(graph_def, name="frozen")
+    graph = tf.get_default_graph()
+
+    def tensors(names):
+      if isinstance(names, list):
+        return [tensors(name) for name in names]
+      return graph.get_tensor_by_name("frozen/" + names)
+
+    self.decode_mode = signature['decode_mode']
+    self.buckets = [tuple(b) for b in signature['buckets']]
+    self.batch_size = batch_size
+    self.shortlist = None  # Logits are always over the whole vocabulary.
+    self.encoder_inputs = tensors(signature['encoder_inputs'])
+    if self.decode_mode == 'greedy':
+      self.decoder_inputs = tensors(signature['decoder_inputs'])
+      self.outputs = tensors(signature['outputs'])
+    else:
+      # Graphs exported before the attention keys were cached name the
+      # encoder outputs alone; both are fed back to decode_step as they come.
+      self.attention_memory = tensors(signature.get('attention_memory', signature.get('attention_states')))
+      self.initial_decoder_state = tensors(signature['initial_decoder_state'])
+      self.step_decoder_input = tensors(signature['step_decoder_input'])
+      self.step_attention_memory = tensors(signature.get('step_attention_memory',
+                                                         signature.get('step_attention_states')))
+      self.step_decoder_state = tensors(signature['step_decoder_state'])
+      self.step_logits = tensors(signature['step_logits'])
+      self.step_next_state = tensors(signature['step_next_state'])
+
+  def get_batch(self, data, bucket_id, batch_indices=None):
+    return data_utils.get_batch(data[bucket_id], self.buckets[bucket_id],
+                                self.batch_size, batch_indices)
+
+  def step(self, session, encoder_inputs, decoder_inputs, target_weights,
+           bucket_id, forward_only, force_dec_input=False, advantage=None, ScheduledSampling=False,
+           example_weights=None):
+    """Greedy outputs of a bucket, as (None, None, outputs)."""
+    if self.decode_mode != 'greedy':
+      raise ValueError("A beam frozen graph decodes with encode and decode_step")
+    if not forward_only or force_dec_input:
+      raise ValueError("A greedy frozen graph only runs the greedy forward pass")
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    input_feed = {}
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l]] = encoder_inputs[l]
+    for l in xrange(decoder_size):
+      input_feed[self.decoder_inputs[l]] = decoder_inputs[l]
+    return None, None, session.run(self.outputs[bucket_id], input_feed)
+
+  def encode(self, session, encoder_inputs, bucket_id):
+    if self.decode_mode != 'beam':
+      raise ValueError("A greedy frozen graph has no incremental decoder")
+    input_feed = {}
+    for l in xrange(self.buckets[bucket_id][0]):
+      input_feed[self.encoder_inputs[l]] = encoder_inputs[l]
+    outputs = session.run([self.attention_memory[bucket_id]] +
+                          self.initial_decoder_state[bucket_id], input_feed)
+    return outputs[0], outputs[1:]
+
+  def decode_step(self, session, decoder_input, decoder_state, attention_memory,
+                  first_step=False, shortlist=None):
+    if shortlist is not None:
+      raise ValueError("A frozen graph decodes over the whole vocabulary")
+    step = 0 if first_step else 1
+    input_feed = {
+      self.step_decoder_input:     decoder_input,
+      self.step_attention_memory:  attention_memory,
+    }
+    for placeholder, value in zip(self.step_decoder_state, decoder_state):
+      input_feed[placeholder] = value
+    outputs = session.run([self.step_logits[step]] + self.step_next_state[step], input_feed)
+    return outputs[0], outputs[1:]
@@ -0,0 +1,94 @@
+"""Tests that data_utils.get_batch builds the batches of the per-example loop.
+
+Run from hw4/ with python -m unittest lib.get_batch_test.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import unittest
+
+import numpy as np
+
+from lib import data_utils
+
+
+def loop_get_batch(bucket, bucket_size, batch_indices):
+  """The per-example loop get_batch used to build batches with."""
+  encoder_size, decoder_size = bucket_size
+  encoder_inputs, decoder_inputs = [], []
+  for encoder_input, decoder_input in [bucket[i] for i in batch_indices]:
+    encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
+    encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+    decoder_pad_size = decoder_size - len(decoder_input) - 1
+    decoder_inputs.append([data_utils.GO_ID] + decoder_input +
+                          [data_utils.PAD_ID] * decoder_pad_size)
+
+  batch_size = len(batch_indices)
+  batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
+  for length_idx in range(encoder_size):
+    batch_encoder_inputs.append(
+        np.array([encoder_inputs[batch_idx][length_idx]
+                  for batch_idx in range(batch_size)], dtype=np.int32))
+  for length_idx in range(decoder_size):
+    batch_decoder_inputs.append(
+        np.array([decoder_inputs[batch_idx][length_idx]
+                  for batch_idx in range(batch_size)], dtype=np.int32))
+    batch_weight = np.ones(batch_size, dtype=np.float32)
+    for batch_idx in range(batch_size):
+      if length_idx < decoder_size - 1:
+        target = decoder_inputs[batch_idx][length_idx + 1]
+      if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
+        batch_weight[batch_idx] = 0.0
+    batch_weights.append(batch_weight)
+  return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+
+
+def random_bucket(bucket_size, vocab_size, n, rng=np.random):
+  """n random pairs that fit bucket_size, empty ones included."""
+  encoder_size, decoder_size = bucket_size
+  return [[list(rng.randint(4, vocab_size, rng.randint(encoder_size))),
+           list(rng.randint(4, vocab_size, rng.randint(decoder_size - 1)))]
+          for _ in range(n)]
+
+
+class GetBatchTest(unittest.TestCase):
+
+  bucket_size = (10, 15)
+
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.bucket = random_bucket(self.bucket_size, 1000, 500, rng)
+    self.padded = data_utils.pad_data([self.bucket], [self.bucket_size])[0]
+    self.batch_indices = rng.randint(len(self.bucket), size=64)
+
+  def assertBatchEqual(self, expected_batch, batch):
+    for expected, actual in zip(expected_batch, batch):
+      self.assertEqual(len(expected), len(actual))
+      for e, a in zip(expected, actual):
+        np.testing.assert_array_equal(e, a)
+        self.assertEqual(e.dtype, a.dtype)
+
+  def testIndexedPairs(self):
+    self.assertBatchEqual(
+        loop_get_batch(self.bucket, self.bucket_size, self.batch_indices),
+        data_utils.get_batch(self.bucket, self.bucket_size, 64, self.batch_indices))
+
+  def testIndexedPaddedBucket(self):
+    self.assertBatchEqual(
+        loop_get_batch(self.bucket, self.bucket_size, self.batch_indices),
+        data_utils.get_batch(self.padded, self.bucket_size, 64, self.batch_indices))
+
+  def testRandomDraws(self):
+    # Unindexed batches draw the indices random.choice(bucket) would.
+    random.seed(1)
+    drawn_indices = [random.choice(range(len(self.bucket))) for _ in range(64)]
+    random.seed(1)
+    self.assertBatchEqual(
+        loop_get_batch(self.bucket, self.bucket_size, drawn_indices),
+        data_utils.get_batch(self.padded, self.bucket_size, 64))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,10 +1,11 @@
 import os
+import time
 
 import tensorflow as tf
 from datetime import datetime
 
 from lib import data_utils
-from lib.seq2seq_model_utils import create_model, get_predicted_sentence
+from lib.seq2seq_model_utils import create_model, get_predicted_sentence, get_bucket_id, decode_batch
 
 
 def predict(args, debug=False):
@@ -13,6 +14,24 @@ def predict(args, debug=False):
             test_sentences = [s.strip() for s in test_fh.readlines()]
         return test_sentences
 
+    def _write_result(sentence, predicted_sentence):
+        if isinstance(predicted_sentence, list):
+            print("%s : (%s)" % (sentence, datetime.now()))
+            if not args.simple_output:
+                results_fh.write("%s : (%s)\n" % (sentence, datetime.now()))
+            for sent in predicted_sentence:
+                print("  (%s) -> %s" % (sent['prob'], sent['dec_inp']))
+                if not args.simple_output:
+                    results_fh.write("  (%f) -> %s\n" % (sent['prob'], sent['dec_inp']))
+                else:
+                    results_fh.write("%s\n" % (sent['dec_inp']))
+        else:
+            print(sentence, ' -> ', predicted_sentence)
+            if not args.simple_output:
+                results_fh.write("%s -> %s\n" % (sentence, predicted_sentence))
+            else:
+                results_fh.write("%s\n" % (predicted_sentence))
+
     # results_filename = '_'.join(['results', str(args.num_layers), str(args.size), str(args.vocab_size)])
     results_path = args.results_dir # os.path.join(args.results_dir, results_filename+'.txt')
 
@@ -27,26 +46,44 @@ def predict(args, debug=False):
 
         test_dataset = _get_test_dataset()
 
-        for sentence in test_dataset:
-            # Get token-ids for the input sentence.
-            predicted_sentence = get_predicted_sentence(args, sentence, vocab, rev_vocab, model, sess, debug=debug)
-            if isinstance(predicted_sentence, list):
-                print("%s : (%s)" % (sentence, datetime.now()))
-                if not args.simple_output:
-                    results_fh.write("%s : (%s)\n" % (sentence, datetime.now()))
-                for sent in predicted_sentence:
-                    print("  (%s) -> %s" % (sent['prob'], sent['dec_inp']))
-                    if not args.simple_output:
-                        results_fh.write("  (%f) -> %s\n" % (sent['prob'], sent['dec_inp']))
-                    else:
-                        results_fh.write("%s\n" % (sent['dec_inp']))
-            else:
-                print(sentence, ' -> ', predicted_sentence)
-                if not args.simple_output:
-                    results_fh.write("%s -> %s\n" % (sentence, predicted_sentence))
-                else:
-                    results_fh.write("%s\n" % (predicted_sentence))
-            # break
+        if args.predict_batch_size > 1:
+            predicted_sentences = predict_batched(args, test_dataset, vocab, rev_vocab, model, sess)
+            for sentence, predicted_sentence in zip(test_dataset, predicted_sentences):
+                _write_result(sentence, predicted_sentence)
+        else:
+            for sentence in test_dataset:
+                # Get token-ids for the input sentence.
+                predicted_sentence = get_predicted_sentence(args, sentence, vocab, rev_vocab, model, sess, debug=debug)
+                _write_result(sentence, predicted_sentence)
+                # break
 
     results_fh.close()
     print("results written in %s" % results_path)
+
+
+def predict_batched(args, sentences, vocab, rev_vocab, model, sess):
+    """Decode sentences predict_batch_size at a time, grouped by bucket.
+
+    Returns:
+      The predictions of get_predicted_sentence, in input order.
+    """
+    bucket_inputs = [[] for _ in args.buckets]  # (input index, token ids)
+    for i, input_token_ids in enumerate(data_utils.Tokenizer(vocab).encode_many(sentences)):
+        input_token_ids.append(data_utils.EOS_ID)
+        bucket_id, input_token_ids = get_bucket_id(args.buckets, input_token_ids)
+        bucket_inputs[bucket_id].append((i, input_token_ids))
+
+    predicted_sentences = [None] * len(sentences)
+    for bucket_id, batch_inputs in enumerate(bucket_inputs):
+        if not batch_inputs:
+            continue
+        start_time = time.time()
+        for start in range(0, len(batch_inputs), args.predict_batch_size):
+            indices, inputs = zip(*batch_inputs[start:start + args.predict_batch_size])
+            predictions = decode_batch(args, model, sess, bucket_id, list(inputs), rev_vocab)
+            for i, prediction in zip(indices, predictions):
+                predicted_sentences[i] = prediction
+        elapsed = time.time() - start_time
+        print("[throughput] bucket %d %s: %d sentences in %.2fs, %.1f sentences/sec" %
+              (bucket_id, args.buckets[bucket_id], len(batch_inputs), elapsed, len(batch_inputs) / elapsed))
+    return predicted_sentences
@@ -0,0 +1,215 @@
+"""Background batch assembly for the training loop."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+import numpy as np
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+
+class EpochSampler(object):
+  """Batches covering every pair of the buckets once per epoch.
+
+  An epoch shuffles the pairs within each bucket, cuts every bucket into
+  batches of batch_size, the last one possibly smaller, and shuffles the
+  batches of all buckets together. Epoch e is drawn from RandomState(seed +
+  e), so the batch at a position of the run depends on the seed and that
+  position only, and a run resumes from them.
+
+  With num_shards > 1, shard s takes the positions s, s + num_shards, ... of
+  the sequence; position p of the shard is batch p * num_shards + s.
+  """
+
+  def __init__(self, bucket_sizes, batch_size, seed, num_shards=1, shard=0):
+    self.bucket_sizes = list(bucket_sizes)
+    self.batch_size = batch_size
+    self.seed = seed
+    self.num_shards = num_shards
+    self.shard = shard
+    self.batches_per_epoch = sum(-(-n // batch_size) for n in self.bucket_sizes)
+    self._epochs = {}
+    self._lock = threading.Lock()
+
+  def _epoch(self, epoch):
+    with self._lock:
+      if epoch not in self._epochs:
+        rng = np.random.RandomState(self.seed + epoch)
+        batches = []
+        for bucket_id, n in enumerate(self.bucket_sizes):
+          order = rng.permutation(n)
+          batches.extend((bucket_id, order[i:i + self.batch_size]) for i in xrange(0, n, self.batch_size))
+        self._epochs[epoch] = [batches[i] for i in rng.permutation(len(batches))]
+        # Producer threads are at most an epoch apart.
+        for old in [e for e in self._epochs if e < epoch - 1]:
+          del self._epochs[old]
+      return self._epochs[epoch]
+
+  def batch(self, position):
+    """(bucket_id, batch_indices) of the batch at position of this shard."""
+    epoch, i = divmod(position * self.num_shards + self.shard, self.batches_per_epoch)
+    return self._epoch(epoch)[i]
+
+  def epochs(self, position):
+    """Epochs of the whole run covered when this shard reaches position."""
+    return position * self.num_shards / float(self.batches_per_epoch)
+
+
+def sampler_state_path(checkpoint_path):
+  return checkpoint_path + ".sampler"
+
+
+def load_sampler_state(checkpoint_path, seed=None):
+  """The {"seed", "batches"} saved with checkpoint_path, or a new state.
+
+  batches counts the batches of the whole run drawn before the checkpoint.
+  A new state starts at 0 with seed, or a random one if seed is None.
+  """
+  if checkpoint_path:
+    try:
+      with open(sampler_state_path(checkpoint_path)) as f:
+        return json.load(f)
+    except IOError:
+      pass
+  if seed is None:
+    seed = np.random.randint(2 ** 31 - 1)
+  return {"seed": seed, "batches": 0}
+
+
+def save_sampler_state(checkpoint_path, state):
+  with open(sampler_state_path(checkpoint_path), "w") as f:
+    json.dump(state, f)
+
+
+class BatchPrefetcher(object):
+  """Assembles training batches ahead of model.step in producer threads.
+
+  A batch is drawn the way the training loop draws it: a bucket is picked
+  with probability proportional to its size through train_buckets_scale, then
+  batch_size random pairs of that bucket are batched by get_batch.
+
+  Producer i draws from its own RandomState(seed + i) and fills its own
+  bounded queue; batches are taken from the queues in turn, so for a given
+  seed and number of threads the batch sequence does not depend on thread
+  scheduling.
+
+  Given an EpochSampler, batches are its batches from position start on
+  instead, producer i assembling positions start + i, start + i +
+  num_threads, ...; position is that of the next batch get() returns.
+  """
+
+  def __init__(self, get_batch, data_set, buckets_scale, batch_size,
+               capacity=8, num_threads=1, seed=None, sampler=None, start=0):
+    """Create the prefetcher and start its threads.
+
+    Args:
+      get_batch: function (data_set, bucket_id, batch_indices) returning a
+        batch, e.g. model.get_batch.
+      data_set: the buckets to draw from.
+      buckets_scale: increasing bucket boundaries in [0, 1], as
+        train_buckets_scale in train.py.
+      batch_size: number of pairs per batch.
+      capacity: number of batches kept ready; 0 assembles every batch in
+        get() on the caller's thread.
+      num_threads: number of producer threads.
+      seed: optional integer seed of the bucket and pair draws.
+      sampler: optional EpochSampler the batches are taken from.
+      start: position of the first batch in sampler.
+    """
+    self.get_batch = get_batch
+    self.data_set = data_set
+    self.buckets_scale = np.asarray(buckets_scale)
+    self.batch_size = batch_size
+    self.num_threads = max(num_threads, 1) if capacity else 0
+    self.sampler = sampler
+    self.position = start
+    self._rngs = [np.random.RandomState(None if seed is None else seed + i)
+                  for i in xrange(max(self.num_threads, 1))]
+    self._queues = [queue.Queue(maxsize=max(capacity // self.num_threads, 1))
+                    for _ in xrange(self.num_threads)]
+    self._next = 0
+    self._stop = threading.Event()
+    self._error = None
+    self.reset_stats()
+
+    # Start positions are fixed here: get() advances self.position meanwhile.
+    self._threads = [threading.Thread(target=self._produce, args=(i, start + i))
+                     for i in xrange(self.num_threads)]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def _draw(self, rng):
+    bucket_id = int(np.searchsorted(self.buckets_scale, rng.random_sample(), side="right"))
+    batch_indices = rng.randint(len(self.data_set[bucket_id]), size=self.batch_size)
+    return bucket_id, self.get_batch(self.data_set, bucket_id, batch_indices)
+
+  def _assemble(self, position):
+    bucket_id, batch_indices = self.sampler.batch(position)
+    return bucket_id, self.get_batch(self.data_set, bucket_id, batch_indices)
+
+  def _produce(self, i, position):
+    try:
+      while not self._stop.is_set():
+        if self.sampler is None:
+          batch = self._draw(self._rngs[i])
+        else:
+          batch = self._assemble(position)
+          position += self.num_threads
+        while not self._stop.is_set():
+          try:
+            self._queues[i].put(batch, timeout=0.1)
+            break
+          except queue.Full:
+            pass
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+      self._stop.set()
+
+  def get(self):
+    """Next (bucket_id, (encoder_inputs, decoder_inputs, target_weights))."""
+    self.batches += 1
+    self.position += 1
+    if not self._threads:
+      if self.sampler is not None:
+        return self._assemble(self.position - 1)
+      return self._draw(self._rngs[0])
+
+    q = self._queues[self._next]
+    self._next = (self._next + 1) % self.num_threads
+    try:
+      return q.get_nowait()
+    except queue.Empty:
+      pass
+    # Starved: the step waits for a batch to be assembled.
+    self.starved += 1
+    start_time = time.time()
+    while True:
+      if self._error is not None:
+        raise self._error
+      try:
+        batch = q.get(timeout=0.1)
+        break
+      except queue.Empty:
+        pass
+    self.starved_time += time.time() - start_time
+    return batch
+
+  def reset_stats(self):
+    self.batches, self.starved, self.starved_time = 0, 0, 0.0
+
+  def stats(self):
+    """Log fragment of the starvation counters since the last reset_stats."""
+    stats = "prefetch-starved %d/%d (%.2fs)" % (self.starved, self.batches, self.starved_time)
+    if self.sampler is not None:
+      stats += " epoch %.2f" % self.sampler.epochs(self.position)
+    return stats
+
+  def stop(self):
+    self._stop.set()
+    for thread in self._threads:
+      thread.join()
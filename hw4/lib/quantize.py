@@ -0,0 +1,99 @@
+"""Post-training int8 quantisation of the output projection and embeddings.
+
+quantize(args) reads the checkpoint in the model dir and writes the matrices
+that dominate its size, proj_w and the encoder and decoder embeddings, as
+int8 rows with a float32 scale per row (see quantized_rows), to
+quantized_int8.npz next to it or to --quantized. Test, chat and serve modes
+decode with them given --quantized; the other variables still come from the
+checkpoint. It then reports the perplexity and greedy outputs on the dev set
+against the float model.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from lib import data_utils
+from lib import quantized_rows
+from lib.seq2seq_model_utils import create_model, dict_lookup, evaluation_pairs
+from lib.seq2seq_model_utils import greedy_decode_all, perplexity
+
+
+def _quantized(name, shape):
+  return len(shape) == 2 and name.split("/")[-1] in ("proj_w", "embedding")
+
+
+def quantize_checkpoint(checkpoint_path, path):
+  """Write the int8 rows and scales of the checkpoint's matrices to path.
+
+  Returns:
+    A triple (float32 bytes, bytes, largest absolute error) over the
+    quantised matrices.
+  """
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  arrays, float_bytes, int8_bytes, max_error = {}, 0, 0, 0.
+  for name, shape in sorted(reader.get_variable_to_shape_map().items()):
+    if not _quantized(name, shape):
+      continue
+    matrix = reader.get_tensor(name).astype(np.float32)
+    values, scales = quantized_rows.quantize_rows(matrix)
+    arrays[name + "/int8"], arrays[name + "/scale"] = values, scales
+    float_bytes += matrix.nbytes
+    int8_bytes += values.nbytes + scales.nbytes
+    max_error = max(max_error, float(np.max(np.abs(
+        quantized_rows.dequantize_rows(values, scales) - matrix))))
+  with open(path, "wb") as f:
+    np.savez(f, **arrays)
+  return float_bytes, int8_bytes, max_error
+
+
+def quantized_path(args):
+  """--quantized, or quantized_int8.npz in the model dir."""
+  return args.quantized or os.path.join(args.model_dir, "quantized_int8.npz")
+
+
+def report(args, path, n_samples=10):
+  """Dev perplexity and greedy outputs of the int8 model against the float one."""
+  pairs, source = evaluation_pairs(args)
+  print("[report] %d pairs of %s" % (len(pairs), source))
+  vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+  rev_vocab = data_utils.initialize_vocabulary(vocab_path)[1] if os.path.exists(vocab_path) else None
+
+  def text(tokens):
+    tokens = [t for t in tokens if t != data_utils.EOS_ID]
+    return " ".join(dict_lookup(rev_vocab, t) if rev_vocab else str(t) for t in tokens)
+
+  results = {}
+  for name, quantized in [("float", None), ("int8", path)]:
+    model_args = copy.copy(args)
+    model_args.quantized, model_args.frozen_graph, model_args.decode_mode = quantized, None, ''
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = create_model(sess, model_args, predict_or_train=True)
+      log_probs = model.log_prob(sess, pairs, batch_size=args.batch_size)
+      outputs = greedy_decode_all(model_args, model, sess, [a for a, _ in pairs])
+    results[name] = log_probs, outputs
+    print("[report] %s: perplexity %.3f" % (name, perplexity(log_probs, pairs)))
+
+  drift = np.abs(results["int8"][0] - results["float"][0])
+  differ = [i for i, (a, b) in enumerate(zip(results["float"][1], results["int8"][1])) if a != b]
+  print("[report] log-likelihood per token drift mean %.2e, max %.2e; %d of %d greedy outputs differ" %
+        (np.mean(drift), np.max(drift), len(differ), len(pairs)))
+  for i in differ[:n_samples]:
+    print("  > %s\n    float: %s\n    int8:  %s" %
+          (text(pairs[i][0]), text(results["float"][1][i]), text(results["int8"][1][i])))
+
+
+def quantize(args):
+  ckpt = tf.train.get_checkpoint_state(args.model_dir)
+  if not (ckpt and ckpt.model_checkpoint_path):
+    raise ValueError("No checkpoint to quantise in %s" % args.model_dir)
+  path = quantized_path(args)
+  float_bytes, int8_bytes, max_error = quantize_checkpoint(ckpt.model_checkpoint_path, path)
+  print("[quantize] %s written in %s: %.1f MB float32 -> %.1f MB int8, largest error %.2e" %
+        (ckpt.model_checkpoint_path, path, float_bytes / 2.**20, int8_bytes / 2.**20, max_error))
+  report(args, path)
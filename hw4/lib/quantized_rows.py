@@ -0,0 +1,89 @@
+"""Matrices kept as int8 rows with a float32 scale per row.
+
+quantize_rows() maps each row r of a matrix to round(r / s), s = max|r| / 127.
+Under the custom getter of quantized_getter(), get_variable returns such a
+matrix dequantised instead of creating it: embedding_lookup() then gathers
+the int8 rows of the ids and dequantises only those, and other reads, e.g.
+the output projection, dequantise the whole matrix when they run. load()
+fills the int8 rows from the file quantize mode writes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.ops import embedding_ops
+
+# (dequantised matrix, int8 rows, scales) of every quantised get_variable.
+QUANTIZED_ROWS = "quantized_rows"
+
+
+def quantize_rows(matrix):
+  """int8 rows and float32 scales of a 2D numpy matrix."""
+  scales = np.max(np.abs(matrix), axis=1) / 127.
+  scales[scales == 0] = 1.
+  values = np.round(matrix / scales[:, None]).astype(np.int8)
+  return values, scales.astype(np.float32)
+
+
+def dequantize_rows(values, scales):
+  return values.astype(np.float32) * scales[:, None]
+
+
+def quantized_names(path):
+  """Names of the variables quantised in the file at path."""
+  with np.load(path) as data:
+    return set(key[:-len("/int8")] for key in data.files if key.endswith("/int8"))
+
+
+def quantized_getter(names):
+  """Custom getter reading the variables of these names from int8 rows.
+
+  The rows and scales are local variables named after the variable, with
+  "_int8" and "_scale" appended, so tf.train.Saver does not look for them in
+  checkpoints; load() fills them.
+  """
+  def quantized_get_variable(getter, name, *args, **kwargs):
+    if name not in names:
+      return getter(name, *args, **kwargs)
+    shape, dtype = kwargs["shape"], kwargs.get("dtype") or tf.float32
+    values = getter(name + "_int8", shape=shape, dtype=tf.int8,
+                    initializer=tf.zeros_initializer(), trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    reuse=kwargs.get("reuse"))
+    scales = getter(name + "_scale", shape=shape[:1], dtype=tf.float32,
+                    initializer=tf.ones_initializer(), trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    reuse=kwargs.get("reuse"))
+    rows = tf.cast(values, dtype) * tf.cast(tf.expand_dims(scales, 1), dtype)
+    tf.add_to_collection(QUANTIZED_ROWS, (rows, values, scales))
+    return rows
+  return quantized_get_variable
+
+
+def embedding_lookup(params, ids):
+  """embedding_ops.embedding_lookup, dequantising only the rows looked up.
+
+  If params is a matrix of quantized_getter, its int8 rows of ids are
+  gathered and scaled instead of gathering from the dequantised matrix.
+  """
+  for rows, values, scales in params.graph.get_collection(QUANTIZED_ROWS):
+    if rows is params:
+      return (tf.cast(embedding_ops.embedding_lookup(values, ids), rows.dtype) *
+              tf.cast(tf.expand_dims(embedding_ops.embedding_lookup(scales, ids), -1),
+                      rows.dtype))
+  return embedding_ops.embedding_lookup(params, ids)
+
+
+def load(session, path):
+  """Assign the int8 rows and scales in the file at path to the model's."""
+  with np.load(path) as data:
+    loaded = set()
+    for _, values, scales in tf.get_collection(QUANTIZED_ROWS):
+      name = values.op.name[:-len("_int8")]
+      if name not in loaded:
+        values.load(data[name + "/int8"], session)
+        scales.load(data[name + "/scale"], session)
+        loaded.add(name)
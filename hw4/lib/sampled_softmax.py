@@ -0,0 +1,142 @@
+"""Sampled softmax losses with one pool of negatives per batch.
+
+The default training loss, tf.nn.sampled_softmax_loss, draws its own
+num_samples negative classes in every call: once per decoder step of every
+bucket. shared_negatives_loss draws one pool per batch instead, projects it
+once, and scores the outputs of every step against it. The samplers are
+
+per_step: no shared pool, a sampled_softmax_loss per call.
+log_uniform: num_samples classes of the Zipfian distribution of
+  tf.nn.log_uniform_candidate_sampler, which suits ids sorted by frequency.
+unigram: num_samples classes drawn in proportion to their training counts.
+in_batch: every distinct target of the batch, whatever num_samples is.
+
+Pools are drawn with repetition, so the expected count of class k in a pool
+is num_samples * P(k) exactly; for in_batch it is the count of k in the batch.
+Logits are corrected by the log of these counts, as in sampled_softmax_loss.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import gfile
+
+from lib import data_utils
+
+NEGATIVE_SAMPLERS = ("per_step", "log_uniform", "unigram", "in_batch")
+
+# Added to the logit of a negative that is the target itself, removing it.
+_ACCIDENTAL_HIT = -1e30
+
+
+def _sample_pool(sampler, targets, target_weights, num_samples, num_classes,
+                 unigram_counts):
+  """The pool of a batch and the log expected counts of its classes.
+
+  Returns:
+    A triple (pool, pool_log_count, log_count): int32 class ids, the log of
+    their expected count in the pool, and a function of class ids giving the
+    same, or None when it is only defined for the classes of the pool.
+  """
+  no_classes = tf.zeros([1, 1], dtype=tf.int64)  # The pool ignores targets.
+  if sampler == "log_uniform":
+    pool, _, _ = tf.nn.log_uniform_candidate_sampler(
+        no_classes, 1, num_samples, unique=False, range_max=num_classes)
+
+    def log_count(classes):
+      # P(k) = (log(k + 2) - log(k + 1)) / log(num_classes + 1)
+      classes = tf.cast(classes, tf.float32)
+      return (tf.log(tf.log1p(1. / (classes + 1.))) +
+              np.log(num_samples / np.log(num_classes + 1.)).astype(np.float32))
+  elif sampler == "unigram":
+    if unigram_counts is None or len(unigram_counts) != num_classes:
+      raise ValueError("The unigram sampler needs the counts of the %d classes" % num_classes)
+    counts = np.asarray(unigram_counts, dtype=np.float64) + 1.  # Every class can be drawn.
+    pool, _, _ = tf.nn.fixed_unigram_candidate_sampler(
+        no_classes, 1, num_samples, unique=False, range_max=num_classes,
+        unigrams=counts.tolist())
+    log_counts = tf.constant(np.log(num_samples * counts / counts.sum()).astype(np.float32))
+
+    def log_count(classes):
+      return tf.gather(log_counts, classes)
+  elif sampler == "in_batch":
+    flat_targets = tf.concat([tf.reshape(t, [-1]) for t in targets], 0)
+    flat_weights = tf.concat([tf.reshape(w, [-1]) for w in target_weights], 0)
+    pool, _, counts = tf.unique_with_counts(tf.boolean_mask(flat_targets, flat_weights > 0))
+    return tf.cast(pool, tf.int32), tf.log(tf.cast(counts, tf.float32)), None
+  else:
+    raise ValueError("Unknown negative sampler %s, choose from %s" % (sampler, NEGATIVE_SAMPLERS))
+  pool = tf.cast(pool, tf.int32)
+  return pool, log_count(pool), log_count
+
+
+def shared_negatives_loss(sampler, weights_t, biases, targets, target_weights,
+                          num_samples, num_classes, dtype=tf.float32,
+                          unigram_counts=None):
+  """A softmax_loss_function scoring every call against one pool of negatives.
+
+  Args:
+    sampler: 'log_uniform', 'unigram' or 'in_batch'.
+    weights_t: the output projection [num_classes x size], float32.
+    biases: its biases [num_classes], float32.
+    targets: list of 1D int32 Tensors, the targets of all the steps the loss
+      function is called for, e.g. those of a bucket.
+    target_weights: list of 1D Tensors, their weights; in_batch pools the
+      targets of nonzero weight.
+    num_samples: size of the log_uniform and unigram pools.
+    num_classes: number of classes, the target vocabulary size.
+    dtype: dtype of the returned losses; they are computed in float32.
+    unigram_counts: for 'unigram', an array with the count of every class.
+
+  Returns:
+    A function (labels, inputs) -> losses, like sampled_loss of the models:
+    labels is a 1D int32 Tensor and inputs the [batch_size x size] outputs
+    before the projection.
+  """
+  with tf.name_scope("shared_negatives"):
+    pool, pool_log_count, log_count = _sample_pool(
+        sampler, targets, target_weights, num_samples, num_classes, unigram_counts)
+    pool_w = tf.gather(weights_t, pool)
+    pool_b = tf.gather(biases, pool) - pool_log_count
+
+  def loss(labels, inputs):
+    labels = tf.reshape(labels, [-1])
+    inputs = tf.cast(inputs, tf.float32)
+    hits = tf.cast(tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(pool, 0)), tf.float32)
+    if log_count is None:  # The label of a weighted target is in the pool.
+      true_log_count = tf.reduce_sum(hits * pool_log_count, 1)
+    else:
+      true_log_count = log_count(labels)
+    true_logits = (tf.reduce_sum(inputs * tf.gather(weights_t, labels), 1) +
+                   tf.gather(biases, labels) - true_log_count)
+    sampled_logits = (tf.matmul(inputs, pool_w, transpose_b=True) + pool_b +
+                      _ACCIDENTAL_HIT * hits)
+    logits = tf.concat([tf.expand_dims(true_logits, 1), sampled_logits], 1)
+    return tf.cast(tf.reduce_logsumexp(logits, 1) - true_logits, dtype)
+  return loss
+
+
+def load_unigram_counts(args):
+  """Counts of every token id in the training data, or None without them.
+
+  They are saved with the vocabulary; for vocabularies created before that,
+  the training token-ids are counted instead.
+  """
+  vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+  counts = data_utils.load_vocabulary_counts(vocab_path)
+  if counts is None:
+    train_ids = data_utils.get_dialog_train_set_path(args.data_dir) + ".ids%d.in" % args.vocab_size
+    if not gfile.Exists(train_ids):
+      print("No training data in %s to count the unigrams of" % train_ids)
+      return None
+    data_utils.token_ids_to_binary(train_ids)
+    tokens_path, _ = data_utils._binary_paths(train_ids)  # pylint: disable=protected-access
+    counts = np.bincount(np.load(tokens_path, mmap_mode="r"))
+  # The vocabulary may have fewer words than args.vocab_size.
+  unigram_counts = np.zeros(args.vocab_size, dtype=np.int64)
+  unigram_counts[:min(len(counts), args.vocab_size)] = counts[:args.vocab_size]
+  return unigram_counts
@@ -74,6 +74,7 @@ from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
 from tensorflow.python.util import nest
+from lib import quantized_rows
 
 # TODO(ebrevdo): Remove once _linear is fully deprecated.
 linear = core_rnn_cell_impl._linear  # pylint: disable=protected-access
@@ -87,7 +88,9 @@ def _extract_argmax_and_embed(embedding,
   Args:
     embedding: embedding tensor for symbols.
     output_projection: None or a pair (W, B). If provided, each fed previous
-      output will first be multiplied by W and added B.
+      output will first be cast to the dtype of W, multiplied by W and added B.
+      A callable output layer, like adaptive_softmax.AdaptiveSoftmax, is
+      called on it instead.
     update_embedding: Boolean; if False, the gradients will not propagate
       through the embeddings.
 
@@ -96,12 +99,15 @@ def _extract_argmax_and_embed(embedding,
   """
 
   def loop_function(prev, _):
-    if output_projection is not None:
-      prev = nn_ops.xw_plus_b(prev, output_projection[0], output_projection[1])
+    if callable(output_projection):
+      prev = output_projection(prev)
+    elif output_projection is not None:
+      prev = nn_ops.xw_plus_b(math_ops.cast(prev, output_projection[0].dtype),
+                              output_projection[0], output_projection[1])
     prev_symbol = math_ops.argmax(prev, 1)
     # Note that gradients will not propagate through the second parameter of
     # embedding_lookup.
-    emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
+    emb_prev = quantized_rows.embedding_lookup(embedding, prev_symbol)
     if not update_embedding:
       emb_prev = array_ops.stop_gradient(emb_prev)
     return emb_prev
@@ -537,6 +543,78 @@ def embedding_tied_rnn_seq2seq(encoder_inputs,
     return outputs_and_state[:outputs_len], state
 
 
+def project_attention_keys(attention_states, num_heads=1):
+  """The projected attention keys W1 * h_t of every head.
+
+  They depend on attention_states only, so a decoder run step by step over the
+  same encoder outputs can compute them once and pass them to every step of
+  attention_decoder. Call it in the scope of attention_decoder to use its
+  AttnW_* variables, which keep the shape of a 1-by-1 convolution kernel.
+
+  Args:
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    num_heads: Number of attention heads that read from attention_states.
+
+  Returns:
+    A list of num_heads 3D Tensors [batch_size x attn_length x attn_size].
+  """
+  attn_size = attention_states.get_shape()[2].value
+  flat_states = array_ops.reshape(attention_states, [-1, attn_size])
+  keys = []
+  for a in xrange(num_heads):
+    k = variable_scope.get_variable("AttnW_%d" % a,
+                                    [1, 1, attn_size, attn_size])
+    key = math_ops.matmul(flat_states,
+                          array_ops.reshape(k, [attn_size, attn_size]))
+    key = array_ops.reshape(key, array_ops.shape(attention_states))
+    key.set_shape(attention_states.get_shape())
+    keys.append(key)
+  return keys
+
+
+def attention_read(query, attention_states, attention_keys):
+  """One attention read of attention_states per head, for query.
+
+  The mask is softmax(v^T * tanh(keys + U * query)) over attn_length, and the
+  read is the mask-weighted sum of attention_states; both are batched matmuls
+  over [batch_size x attn_length x attn_size] Tensors. Call it in the scope of
+  attention_decoder to use its AttnV_* and Attention_* variables.
+
+  Args:
+    query: 2D Tensor [batch_size x query_size], or a nested tuple of them.
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    attention_keys: the list of keys of attention_states, see
+      project_attention_keys.
+
+  Returns:
+    A list with a 2D Tensor [batch_size x attn_size] per head.
+  """
+  attn_size = attention_states.get_shape()[2].value
+  batch_size = array_ops.shape(attention_states)[0]
+  attn_length = array_ops.shape(attention_states)[1]
+  if nest.is_sequence(query):  # If the query is a tuple, flatten it.
+    query_list = nest.flatten(query)
+    for q in query_list:  # Check that ndims == 2 if specified.
+      ndims = q.get_shape().ndims
+      if ndims:
+        assert ndims == 2
+    query = array_ops.concat(query_list, 1)
+  ds = []  # Results of attention reads will be stored here.
+  for a, keys in enumerate(attention_keys):
+    v = variable_scope.get_variable("AttnV_%d" % a, [attn_size])
+    with variable_scope.variable_scope("Attention_%d" % a):
+      y = linear(query, attn_size, True)
+      # Attention mask is a softmax of v^T * tanh(...).
+      hidden = math_ops.tanh(keys + array_ops.expand_dims(y, 1))
+      s = math_ops.matmul(array_ops.reshape(hidden, [-1, attn_size]),
+                          array_ops.reshape(v, [attn_size, 1]))
+      mask = nn_ops.softmax(array_ops.reshape(s, [batch_size, attn_length]))
+      # Now calculate the attention-weighted vector d.
+      d = math_ops.matmul(array_ops.expand_dims(mask, 1), attention_states)
+      ds.append(array_ops.reshape(d, [-1, attn_size]))
+  return ds
+
+
 def attention_decoder(decoder_inputs,
                       initial_state,
                       attention_states,
@@ -546,7 +624,8 @@ def attention_decoder(decoder_inputs,
                       loop_function=None,
                       dtype=None,
                       scope=None,
-                      initial_state_attention=False):
+                      initial_state_attention=False,
+                      attention_keys=None):
   """RNN decoder with attention for the sequence-to-sequence model.
 
   In this context "attention" means that, during decoding, the RNN can look up
@@ -577,6 +656,9 @@ def attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    attention_keys: None, or the num_heads keys of attention_states computed
+      by project_attention_keys in the scope of this decoder, e.g. once for
+      all the steps of an incremental decoder; if None, they are computed here.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -596,8 +678,8 @@ def attention_decoder(decoder_inputs,
 
   Raises:
     ValueError: when num_heads is not positive, there are no inputs, shapes
-      of attention_states are not set, or input size cannot be inferred
-      from the input.
+      of attention_states are not set, input size cannot be inferred
+      from the input, or attention_keys are not those of num_heads heads.
   """
   if not decoder_inputs:
     raise ValueError("Must provide at least 1 input to attention decoder.")
@@ -614,49 +696,18 @@ def attention_decoder(decoder_inputs,
     dtype = scope.dtype
 
     batch_size = array_ops.shape(decoder_inputs[0])[0]  # Needed for reshaping.
-    attn_length = attention_states.get_shape()[1].value
-    if attn_length is None:
-      attn_length = array_ops.shape(attention_states)[1]
     attn_size = attention_states.get_shape()[2].value
-
-    # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
-    hidden = array_ops.reshape(attention_states,
-                               [-1, attn_length, 1, attn_size])
-    hidden_features = []
-    v = []
-    attention_vec_size = attn_size  # Size of query vectors for attention.
-    for a in xrange(num_heads):
-      k = variable_scope.get_variable("AttnW_%d" % a,
-                                      [1, 1, attn_size, attention_vec_size])
-      hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
-      v.append(
-          variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
+    if attention_keys is None:
+      attention_keys = project_attention_keys(attention_states, num_heads)
+    elif len(attention_keys) != num_heads:
+      raise ValueError("Need the keys of %d heads, got %d." %
+                       (num_heads, len(attention_keys)))
 
     state = initial_state
 
     def attention(query):
-      """Put attention masks on hidden using hidden_features and query."""
-      ds = []  # Results of attention reads will be stored here.
-      if nest.is_sequence(query):  # If the query is a tuple, flatten it.
-        query_list = nest.flatten(query)
-        for q in query_list:  # Check that ndims == 2 if specified.
-          ndims = q.get_shape().ndims
-          if ndims:
-            assert ndims == 2
-        query = array_ops.concat(query_list, 1)
-      for a in xrange(num_heads):
-        with variable_scope.variable_scope("Attention_%d" % a):
-          y = linear(query, attention_vec_size, True)
-          y = array_ops.reshape(y, [-1, 1, 1, attention_vec_size])
-          # Attention mask is a softmax of v^T * tanh(...).
-          s = math_ops.reduce_sum(v[a] * math_ops.tanh(hidden_features[a] + y),
-                                  [2, 3])
-          a = nn_ops.softmax(s)
-          # Now calculate the attention-weighted vector d.
-          d = math_ops.reduce_sum(
-              array_ops.reshape(a, [-1, attn_length, 1, 1]) * hidden, [1, 2])
-          ds.append(array_ops.reshape(d, [-1, attn_size]))
-      return ds
+      """Put attention masks on attention_states using the keys and query."""
+      return attention_read(query, attention_states, attention_keys)
 
     outputs = []
     prev = None
@@ -713,7 +764,8 @@ def embedding_attention_decoder(decoder_inputs,
                                 update_embedding_for_previous=True,
                                 dtype=None,
                                 scope=None,
-                                initial_state_attention=False):
+                                initial_state_attention=False,
+                                attention_keys=None):
   """RNN decoder with embedding and attention and a pure-decoding option.
 
   Args:
@@ -728,7 +780,8 @@ def embedding_attention_decoder(decoder_inputs,
     output_projection: None or a pair (W, B) of output projection weights and
       biases; W has shape [output_size x num_symbols] and B has shape
       [num_symbols]; if provided and feed_previous=True, each fed previous
-      output will first be multiplied by W and added B.
+      output will first be multiplied by W and added B. It may also be a
+      callable output layer of the outputs, see _extract_argmax_and_embed.
     feed_previous: Boolean; if True, only the first of decoder_inputs will be
       used (the "GO" symbol), and all other decoder inputs will be generated by:
         next = embedding_lookup(embedding, argmax(previous_output)),
@@ -747,6 +800,8 @@ def embedding_attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    attention_keys: None, or the keys of attention_states; see
+      attention_decoder.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -760,8 +815,9 @@ def embedding_attention_decoder(decoder_inputs,
   """
   if output_size is None:
     output_size = cell.output_size
-  if output_projection is not None:
-    proj_biases = ops.convert_to_tensor(output_projection[1], dtype=dtype)
+  if output_projection is not None and not callable(output_projection):
+    # The projection may be kept in another dtype, e.g. float32 for float16.
+    proj_biases = ops.convert_to_tensor(output_projection[1])
     proj_biases.get_shape().assert_is_compatible_with([num_symbols])
 
   with variable_scope.variable_scope(
@@ -773,7 +829,7 @@ def embedding_attention_decoder(decoder_inputs,
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
     emb_inp = [
-        embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs
+        quantized_rows.embedding_lookup(embedding, i) for i in decoder_inputs
     ]
     return attention_decoder(
         emb_inp,
@@ -783,7 +839,8 @@ def embedding_attention_decoder(decoder_inputs,
         output_size=output_size,
         num_heads=num_heads,
         loop_function=loop_function,
-        initial_state_attention=initial_state_attention)
+        initial_state_attention=initial_state_attention,
+        attention_keys=attention_keys)
 
 
 def embedding_attention_seq2seq(encoder_inputs,
@@ -1163,7 +1220,8 @@ def model_with_buckets(encoder_inputs,
       agree with encoder_inputs and decoder_inputs, and returns a pair
       consisting of outputs and states (as, e.g., basic_rnn_seq2seq).
     softmax_loss_function: Function (labels-batch, inputs-batch) -> loss-batch
-      to be used instead of the standard softmax (the default if this is None).
+      to be used instead of the standard softmax (the default if this is None),
+      or a list with the function of each bucket.
     per_example_loss: Boolean. If set, the returned loss will be a batch-sized
       tensor of losses for each sequence in the batch. If unset, it will be
       a scalar with the averaged loss from all examples.
@@ -1196,6 +1254,8 @@ def model_with_buckets(encoder_inputs,
   losses = []
   outputs = []
   encoder_states = []
+  if not isinstance(softmax_loss_function, (list, tuple)):
+    softmax_loss_function = [softmax_loss_function] * len(buckets)
   with ops.name_scope(name, "model_with_buckets", all_inputs):
     for j, bucket in enumerate(buckets):
       with variable_scope.variable_scope(
@@ -1210,13 +1270,13 @@ def model_with_buckets(encoder_inputs,
                   targets[:bucket[1]],
                   outputs[-1],
                   weights[:bucket[1]],
-                  softmax_loss_function=softmax_loss_function))
+                  softmax_loss_function=softmax_loss_function[j]))
         else:
           losses.append(
               sequence_loss(
                   targets[:bucket[1]],
                   outputs[-1],
                   weights[:bucket[1]],
-                  softmax_loss_function=softmax_loss_function))
+                  softmax_loss_function=softmax_loss_function[j]))
 
   return outputs, losses, encoder_states
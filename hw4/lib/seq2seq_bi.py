@@ -63,6 +63,7 @@ from six.moves import xrange  # pylint: disable=redefined-builtin
 #from six.moves import zip  # pylint: disable=redefined-builtin
 
 #import tensorflow as tf
+from lib import cells
 from lib.tf11_contrib_rnn import core_rnn
 from lib.tf11_contrib_rnn import core_rnn_cell
 #from tensorflow.contrib.rnn.python.ops import core_rnn_cell_impl
@@ -77,6 +78,168 @@ from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import variable_scope
 from tensorflow.python.util import nest
 
+def _single_cell(size, use_lstm, residual=False, cell_impl="basic"):
+  return cells.single_cell(size, use_lstm, cell_impl, residual)
+
+
+def _encoder(encoder_inputs, use_lstm, num_encoder_symbols, embedding_size,
+             num_layers, dtype, cell_impl="basic"):
+  """Bidirectional first layer followed by a residual stack.
+
+  Returns:
+    A pair (attention_states, encoder_state), where attention_states is a 3D
+    Tensor [batch_size x len(encoder_inputs) x embedding_size] and
+    encoder_state is a tuple with one state per decoder layer.
+  """
+  if use_lstm and cell_impl == "fused":
+    encoder_outputs, encoder_state = cells.fused_encoder(
+        encoder_inputs, num_encoder_symbols, embedding_size, num_layers, dtype)
+    top_states = [
+        array_ops.reshape(e, [-1, 1, embedding_size]) for e in encoder_outputs
+    ]
+    return array_ops.concat(top_states, 1), encoder_state
+
+  encoder_fw_cell = _single_cell(embedding_size, use_lstm, cell_impl=cell_impl)
+  encoder_bw_cell = _single_cell(embedding_size, use_lstm, cell_impl=cell_impl)
+
+  encoder_fw_cell = cells.EmbeddingWrapper(
+    encoder_fw_cell, embedding_classes=num_encoder_symbols,
+    embedding_size=embedding_size)
+
+  encoder_bw_cell = cells.EmbeddingWrapper(
+    encoder_bw_cell, embedding_classes=num_encoder_symbols,
+    embedding_size=embedding_size)
+
+  bi_encoder_outputs, state_fw, state_bw = core_rnn.static_bidirectional_rnn(
+    encoder_fw_cell, encoder_bw_cell, encoder_inputs, dtype=dtype)
+
+  encoder_cell = [_single_cell(embedding_size, use_lstm, cell_impl=cell_impl)]
+  encoder_cell = encoder_cell + [_single_cell(embedding_size, use_lstm, True, cell_impl) for l in xrange(num_layers-2)]
+  encoder_cell = core_rnn_cell.MultiRNNCell(encoder_cell)
+
+  encoder_outputs, encoder_state = core_rnn.static_rnn(
+      encoder_cell, bi_encoder_outputs, dtype=dtype)
+
+  encoder_state = (state_fw, ) + encoder_state
+
+  # First calculate a concatenation of encoder outputs to put attention on.
+  top_states = [
+      array_ops.reshape(e, [-1, 1, encoder_cell.output_size]) for e in encoder_outputs
+  ]
+  attention_states = array_ops.concat(top_states, 1)
+  return attention_states, encoder_state
+
+
+def google_mt_decoder_cell(use_lstm, embedding_size, num_layers,
+                           num_decoder_symbols=None, output_projection=None,
+                           cell_impl="basic"):
+  """The decoder stack; wrapped with an output projection if none is given."""
+  decoder_cell = [_single_cell(embedding_size, use_lstm, cell_impl=cell_impl)]
+  decoder_cell = decoder_cell + [_single_cell(embedding_size, use_lstm, True, cell_impl) for l in xrange(num_layers-1)]
+  decoder_cell = core_rnn_cell.MultiRNNCell(decoder_cell)
+  if output_projection is None and num_decoder_symbols is not None:
+    decoder_cell = core_rnn_cell.OutputProjectionWrapper(decoder_cell, num_decoder_symbols)
+  return decoder_cell
+
+
+def google_mt_encoder(encoder_inputs,
+                      use_lstm,
+                      num_encoder_symbols,
+                      embedding_size,
+                      num_layers=3,
+                      dtype=None,
+                      scope=None,
+                      cell_impl="basic"):
+  """Encoder half of google_mt_seq2seq, sharing its variables.
+
+  Returns:
+    A pair (attention_states, encoder_state), see _encoder.
+  """
+  with variable_scope.variable_scope(
+      scope or "google_mt_seq2seq", dtype=dtype) as scope:
+    return _encoder(encoder_inputs, use_lstm, num_encoder_symbols,
+                    embedding_size, num_layers, scope.dtype, cell_impl)
+
+
+def google_mt_decoder_step(decoder_input,
+                           state,
+                           attention_states,
+                           use_lstm,
+                           num_decoder_symbols,
+                           embedding_size,
+                           num_layers=3,
+                           num_heads=1,
+                           output_projection=None,
+                           dtype=None,
+                           scope=None,
+                           initial_state_attention=False,
+                           cell_impl="basic",
+                           attention_keys=None):
+  """One decoder step of google_mt_seq2seq, sharing its variables.
+
+  Running this step with initial_state_attention=False from the encoder state,
+  then repeatedly with initial_state_attention=True from the returned state,
+  reproduces the unrolled decoder of google_mt_seq2seq token by token.
+
+  Args:
+    decoder_input: 1D batch-sized int32 Tensor, the current decoder input.
+    state: the decoder state, structured as the decoder cell state.
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    attention_keys: None, or the keys of attention_states for every head,
+      e.g. from split_attention_memory; if None, the step computes them.
+
+  Returns:
+    A pair (output, state) for this step.
+  """
+  with variable_scope.variable_scope(
+      scope or "google_mt_seq2seq", dtype=dtype) as scope:
+    decoder_cell = google_mt_decoder_cell(use_lstm, embedding_size, num_layers,
+                                          num_decoder_symbols, output_projection,
+                                          cell_impl)
+    output_size = num_decoder_symbols if output_projection is None else None
+    outputs, state = seq2seq_tf.embedding_attention_decoder(
+        [decoder_input],
+        state,
+        attention_states,
+        decoder_cell,
+        num_decoder_symbols,
+        embedding_size,
+        num_heads=num_heads,
+        output_size=output_size,
+        output_projection=output_projection,
+        feed_previous=False,
+        initial_state_attention=initial_state_attention,
+        attention_keys=attention_keys)
+    return outputs[0], state
+
+
+def google_mt_attention_memory(attention_states,
+                               num_heads=1,
+                               dtype=None,
+                               scope=None):
+  """attention_states and their attention keys, to cache between decoder steps.
+
+  The keys are projected with the variables of the google_mt_seq2seq decoder,
+  once per encoding instead of at every google_mt_decoder_step.
+
+  Returns:
+    A 3D Tensor [batch_size x attn_length x (num_heads + 1) * attn_size]:
+    attention_states followed by the keys of every head on the last axis.
+  """
+  with variable_scope.variable_scope(
+      scope or "google_mt_seq2seq", dtype=dtype):
+    with variable_scope.variable_scope("embedding_attention_decoder"):
+      with variable_scope.variable_scope("attention_decoder"):
+        keys = seq2seq_tf.project_attention_keys(attention_states, num_heads)
+    return array_ops.concat([attention_states] + keys, 2)
+
+
+def split_attention_memory(attention_memory, num_heads=1):
+  """The pair (attention_states, attention_keys) of google_mt_attention_memory."""
+  parts = array_ops.split(attention_memory, num_heads + 1, axis=2)
+  return parts[0], parts[1:]
+
+
 def google_mt_seq2seq(encoder_inputs,
                       decoder_inputs,
                       use_lstm,
@@ -89,59 +252,23 @@ def google_mt_seq2seq(encoder_inputs,
                       feed_previous=False,
                       dtype=None,
                       scope=None,
-                      initial_state_attention=False):
-
-  def single_cell(size, lstm, residual=False):  
-    if use_lstm:
-      cell = core_rnn_cell.BasicLSTMCell(size)
-    else:
-      cell = core_rnn_cell.GRUCell(size)
-    if residual:
-      return core_rnn_cell.ResidualWrapper(cell)
-    else:
-      return cell
-        
+                      initial_state_attention=False,
+                      cell_impl="basic"):
+
   with variable_scope.variable_scope(
       scope or "google_mt_seq2seq", dtype=dtype) as scope:
     dtype = scope.dtype
-    # Encoder.   
-    encoder_fw_cell = single_cell(embedding_size, use_lstm)
-    encoder_bw_cell = single_cell(embedding_size, use_lstm)
-    
-    encoder_fw_cell = core_rnn_cell.EmbeddingWrapper(
-      encoder_fw_cell, embedding_classes=num_encoder_symbols,
-      embedding_size=embedding_size)
-    
-    encoder_bw_cell = core_rnn_cell.EmbeddingWrapper(
-      encoder_bw_cell, embedding_classes=num_encoder_symbols,
-      embedding_size=embedding_size)
-
-    bi_encoder_outputs, state_fw, state_bw = core_rnn.static_bidirectional_rnn(
-      encoder_fw_cell, encoder_bw_cell, encoder_inputs, dtype=dtype)
-    
-    encoder_cell = [single_cell(embedding_size, use_lstm)] 
-    encoder_cell = encoder_cell + [single_cell(embedding_size, use_lstm, True) for l in xrange(num_layers-2)]
-    encoder_cell = core_rnn_cell.MultiRNNCell(encoder_cell)
-    
-    encoder_outputs, encoder_state = core_rnn.static_rnn(
-        encoder_cell, bi_encoder_outputs, dtype=dtype)
-    
-    encoder_state = (state_fw, ) + encoder_state
-
-    # First calculate a concatenation of encoder outputs to put attention on.
-    top_states = [
-        array_ops.reshape(e, [-1, 1, encoder_cell.output_size]) for e in encoder_outputs
-    ]
-    attention_states = array_ops.concat(top_states, 1)
-    
+    # Encoder.
+    attention_states, encoder_state = _encoder(
+        encoder_inputs, use_lstm, num_encoder_symbols, embedding_size,
+        num_layers, dtype, cell_impl)
+
     # Decoder.
-    decoder_cell = [single_cell(embedding_size, use_lstm)] 
-    decoder_cell = decoder_cell + [single_cell(embedding_size, use_lstm, True) for l in xrange(num_layers-1)]
-    decoder_cell = core_rnn_cell.MultiRNNCell(decoder_cell)
-      
+    decoder_cell = google_mt_decoder_cell(use_lstm, embedding_size, num_layers,
+                                          num_decoder_symbols, output_projection,
+                                          cell_impl)
     output_size = None
     if output_projection is None:
-      decoder_cell = core_rnn_cell.OutputProjectionWrapper(decoder_cell, num_decoder_symbols)
       output_size = num_decoder_symbols
 
     if isinstance(feed_previous, bool):
@@ -0,0 +1,219 @@
+"""Single-graph versions of the seq2seq_bi encoder and decoder.
+
+google_mt_seq2seq unrolls one encoder and two decoders (for both values of
+feed_previous) per bucket. The functions here build them once for any length:
+the encoder runs tf.nn.dynamic_rnn over time-major [max_time x batch_size]
+int32 Tensors, and the attention decoder is a tf.while_loop that chooses
+between the fed and the generated input at every step. Variables are created
+with the same names as in google_mt_seq2seq, so a checkpoint of the bucketed
+model restores into these graphs and back.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+from lib import cells
+from lib import data_utils
+from lib import quantized_rows
+from lib import seq2seq as seq2seq_tf
+from lib.seq2seq_bi import _single_cell
+from lib.tf11_contrib_rnn import core_rnn_cell
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import nn_ops
+from tensorflow.python.ops import rnn
+from tensorflow.python.ops import tensor_array_ops
+from tensorflow.python.ops import variable_scope
+from tensorflow.python.util import nest
+
+linear = seq2seq_tf.linear
+
+
+def dynamic_encoder(encoder_inputs, use_lstm, num_encoder_symbols,
+                    embedding_size, num_layers, dtype, cell_impl="basic"):
+  """seq2seq_bi._encoder over a [max_time x batch_size] int32 Tensor.
+
+  Padding is read like in the bucket graphs, the bidirectional layer runs over
+  all max_time steps, so the states match those of the bucket of that length.
+
+  Returns:
+    A pair (attention_states, encoder_state), where attention_states is a 3D
+    Tensor [batch_size x max_time x embedding_size] and encoder_state is a
+    tuple with one state per decoder layer.
+  """
+  if use_lstm and cell_impl == "fused":
+    encoder_outputs, encoder_state = cells.fused_encoder(
+        encoder_inputs, num_encoder_symbols, embedding_size, num_layers, dtype)
+    return array_ops.transpose(encoder_outputs, [1, 0, 2]), encoder_state
+
+  encoder_fw_cell = cells.EmbeddingWrapper(
+    _single_cell(embedding_size, use_lstm, cell_impl=cell_impl), embedding_classes=num_encoder_symbols,
+    embedding_size=embedding_size)
+  encoder_bw_cell = cells.EmbeddingWrapper(
+    _single_cell(embedding_size, use_lstm, cell_impl=cell_impl), embedding_classes=num_encoder_symbols,
+    embedding_size=embedding_size)
+
+  # dynamic_rnn takes inputs of rank 3; EmbeddingWrapper flattens the ids.
+  inputs = array_ops.expand_dims(encoder_inputs, 2)
+  with variable_scope.variable_scope("bidirectional_rnn"):
+    with variable_scope.variable_scope("fw") as fw_scope:
+      output_fw, state_fw = rnn.dynamic_rnn(
+          encoder_fw_cell, inputs, dtype=dtype, time_major=True, scope=fw_scope)
+    with variable_scope.variable_scope("bw") as bw_scope:
+      output_bw, _ = rnn.dynamic_rnn(
+          encoder_bw_cell, array_ops.reverse(inputs, [0]), dtype=dtype,
+          time_major=True, scope=bw_scope)
+  bi_encoder_outputs = array_ops.concat(
+      [output_fw, array_ops.reverse(output_bw, [0])], 2)
+
+  encoder_cell = [_single_cell(embedding_size, use_lstm, cell_impl=cell_impl)]
+  encoder_cell = encoder_cell + [_single_cell(embedding_size, use_lstm, True, cell_impl) for l in xrange(num_layers-2)]
+  encoder_cell = core_rnn_cell.MultiRNNCell(encoder_cell)
+
+  encoder_outputs, encoder_state = rnn.dynamic_rnn(
+      encoder_cell, bi_encoder_outputs, dtype=dtype, time_major=True)
+
+  encoder_state = (state_fw, ) + encoder_state
+  attention_states = array_ops.transpose(encoder_outputs, [1, 0, 2])
+  return attention_states, encoder_state
+
+
+def dynamic_attention_decoder(decoder_inputs,
+                              decoder_lengths,
+                              initial_state,
+                              attention_states,
+                              cell,
+                              num_symbols,
+                              embedding_size,
+                              feed_previous,
+                              num_heads=1,
+                              output_size=None,
+                              output_projection=None,
+                              dtype=None,
+                              scope=None):
+  """seq2seq.embedding_attention_decoder as a tf.while_loop.
+
+  Each step computes what one unrolled step of attention_decoder computes,
+  with the same variables. When feed_previous is true the argmax of the
+  previous output is embedded as the next input, without updating the
+  embedding (update_embedding_for_previous=False).
+
+  Args:
+    decoder_inputs: 2D int32 Tensor [max_time x batch_size]; with
+      feed_previous only its first row (the "GO" symbols) is used.
+    decoder_lengths: 1D int32 Tensor [batch_size], the number of outputs each
+      row needs. The loop ends at max_time, or once every row has reached its
+      length and, with feed_previous, has also generated EOS.
+    initial_state: the decoder state, structured as the cell state.
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    cell: core_rnn_cell.RNNCell defining the cell function.
+    num_symbols: Integer, how many symbols come into the embedding.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    feed_previous: scalar boolean Tensor, or a Python bool to build only the
+      decoder of that value.
+    num_heads: Number of attention heads that read from attention_states.
+    output_size: Size of the output vectors; if None, use cell.output_size.
+    output_projection: None or a pair (W, B) applied to outputs, cast to the
+      dtype of W, before the argmax when feed_previous is true.
+    dtype: The dtype to use for the decoder variables; default: tf.float32.
+    scope: VariableScope for the created subgraph; defaults to
+      "embedding_attention_decoder".
+
+  Returns:
+    A pair (outputs, state): outputs is a 3D Tensor
+    [max_time x batch_size x output_size], zero after the last step run, and
+    state is the decoder state after that step.
+  """
+  if output_size is None:
+    output_size = cell.output_size
+
+  with variable_scope.variable_scope(
+      scope or "embedding_attention_decoder", dtype=dtype) as scope:
+    dtype = scope.dtype
+    embedding = variable_scope.get_variable("embedding",
+                                            [num_symbols, embedding_size])
+
+    with variable_scope.variable_scope("attention_decoder"):
+      max_time = array_ops.shape(decoder_inputs)[0]
+      batch_size = array_ops.shape(decoder_inputs)[1]
+      attn_size = attention_states.get_shape()[2].value
+
+      # The keys do not change between steps; compute them before the loop.
+      attention_keys = seq2seq_tf.project_attention_keys(attention_states,
+                                                         num_heads)
+
+      def attention(query):
+        return seq2seq_tf.attention_read(query, attention_states,
+                                         attention_keys)
+
+      attns = [
+          array_ops.zeros(
+              array_ops.stack([batch_size, attn_size]), dtype=dtype)
+          for _ in xrange(num_heads)
+      ]
+      for a in attns:  # Ensure the second shape of attention vectors is set.
+        a.set_shape([None, attn_size])
+      inp = quantized_rows.embedding_lookup(embedding, decoder_inputs[0])
+      emitted_eos = array_ops.fill([batch_size], False)
+      outputs_ta = tensor_array_ops.TensorArray(dtype, size=0, dynamic_size=True)
+
+      def finished(time, emitted_eos):
+        done = time >= decoder_lengths
+        return math_ops.logical_and(
+            done, math_ops.logical_or(emitted_eos, math_ops.logical_not(feed_previous)))
+
+      def condition(time, inp, state, attns, emitted_eos, outputs_ta):
+        return math_ops.logical_and(
+            time < max_time,
+            math_ops.logical_not(math_ops.reduce_all(finished(time, emitted_eos))))
+
+      def body(time, inp, state, attns, emitted_eos, outputs_ta):
+        state = nest.pack_sequence_as(initial_state, state)
+        # Merge input and previous attentions into one vector of the right size.
+        x = linear([inp] + attns, embedding_size, True)
+        # Run the RNN.
+        cell_output, state = cell(x, state)
+        # Run the attention mechanism.
+        attns = attention(state)
+        with variable_scope.variable_scope("AttnOutputProjection"):
+          output = linear([cell_output] + attns, output_size, True)
+
+        def previous_output():
+          logits = output
+          if output_projection is not None:
+            logits = nn_ops.xw_plus_b(
+                math_ops.cast(output, output_projection[0].dtype),
+                output_projection[0], output_projection[1])
+          symbol = math_ops.argmax(logits, 1)
+          emb_prev = array_ops.stop_gradient(
+              quantized_rows.embedding_lookup(embedding, symbol))
+          return emb_prev, math_ops.logical_or(
+              emitted_eos, math_ops.equal(symbol, data_utils.EOS_ID))
+
+        def next_input():
+          next_time = math_ops.minimum(time + 1, max_time - 1)
+          return (quantized_rows.embedding_lookup(embedding, decoder_inputs[next_time]),
+                  emitted_eos)
+
+        if isinstance(feed_previous, bool):
+          inp, emitted_eos = previous_output() if feed_previous else next_input()
+        else:
+          inp, emitted_eos = control_flow_ops.cond(feed_previous, previous_output,
+                                                   next_input)
+        return (time + 1, inp, nest.flatten(state), attns, emitted_eos,
+                outputs_ta.write(time, output))
+
+      steps, _, state, _, _, outputs_ta = control_flow_ops.while_loop(
+          condition, body,
+          loop_vars=(0, inp, nest.flatten(initial_state), attns, emitted_eos,
+                     outputs_ta))
+
+      outputs = outputs_ta.stack()
+      outputs = array_ops.pad(outputs, [[0, max_time - steps], [0, 0], [0, 0]])
+      outputs.set_shape([None, None, output_size])
+      return outputs, nest.pack_sequence_as(initial_state, state)
+
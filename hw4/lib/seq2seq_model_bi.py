@@ -26,9 +26,25 @@ from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.util import nest
 from lib import data_utils as data_utils
 from lib import seq2seq_bi
 from lib import seq2seq as seq2seq_tf
+from lib import quantized_rows
+from lib import sampled_softmax
+from lib.adaptive_softmax import AdaptiveSoftmax
+
+
+def project(output, output_projection):
+  """Logits of a decoder output, computed in the dtype of the projection.
+
+  A callable output layer, like AdaptiveSoftmax, gives log-probabilities.
+  """
+  if callable(output_projection):
+    return output_projection(output)
+  w, b = output_projection
+  return tf.matmul(tf.cast(output, w.dtype), w) + b
+
 
 class Seq2SeqModel(object):
   """Sequence-to-sequence model with attention and for multiple buckets.
@@ -59,7 +75,12 @@ class Seq2SeqModel(object):
                num_samples=512,
                predict_or_train=False,
                scope_name='seq2seq',
-               dtype=tf.float32):
+               decode_mode=None,
+               dtype=tf.float32,
+               cell_impl='basic',
+               negative_sampler='per_step',
+               unigram_counts=None,
+               adaptive_cutoffs=None):
     """Create the model.
 
     Args:
@@ -81,8 +102,32 @@ class Seq2SeqModel(object):
       use_lstm: if true, we use LSTM cells instead of GRU cells.
       num_samples: number of samples for sampled softmax.
       forward_only: if set, we do not construct the backward pass in the model.
-      dtype: the data type to use to store internal variables.
+      decode_mode: None to build both decoders, selected by force_dec_input in
+        step(), and the backward pass unless predict_or_train; or, for
+        inference only, 'infer_greedy' or 'infer_forced' to build just the
+        decoder fed with its own outputs or with decoder_inputs.
+      dtype: the data type to use to store internal variables; the output
+        projection is always kept in float32.
+      cell_impl: 'basic', 'block' or 'fused' cells, see cells.py; all of them
+        read and write the same checkpoints.
+      negative_sampler: 'per_step' to draw the negatives of sampled softmax
+        for every decoder step, or the sampler of one pool of negatives per
+        batch shared by all steps, see sampled_softmax.py.
+      unigram_counts: count of every target word, for the 'unigram' sampler.
+      adaptive_cutoffs: if given, the cluster cutoffs of an adaptive softmax
+        output layer, see adaptive_softmax.py, used instead of the output
+        projection and sampled softmax.
     """
+    if negative_sampler not in sampled_softmax.NEGATIVE_SAMPLERS:
+      raise ValueError("Unknown negative sampler %s, choose from %s"
+                       % (negative_sampler, sampled_softmax.NEGATIVE_SAMPLERS))
+    if adaptive_cutoffs and negative_sampler != 'per_step':
+      raise ValueError("The adaptive softmax samples no negatives, got negative sampler %s"
+                       % negative_sampler)
+    if decode_mode not in (None, 'infer_greedy', 'infer_forced'):
+      raise ValueError("Unknown decode_mode %s" % decode_mode)
+    self.decode_mode = decode_mode
+    self.cell_impl = cell_impl
     self.scope_name = scope_name
     with tf.variable_scope(self.scope_name):
       self.source_vocab_size = source_vocab_size
@@ -95,15 +140,19 @@ class Seq2SeqModel(object):
           self.learning_rate * learning_rate_decay_factor)
       self.global_step = tf.Variable(0, trainable=False)
       self.dummy_dialogs = [] # [TODO] load dummy sentences 
+      self.shortlist = None  # shortlist.Shortlist to decode over, if any
 
       # If we use sampled softmax, we need an output projection.
       output_projection = None
       softmax_loss_function = None
       # Sampled softmax only makes sense if we sample less than vocabulary size.
-      if num_samples > 0 and num_samples < self.target_vocab_size:
-        w_t = tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=dtype)
+      if adaptive_cutoffs:
+        output_projection = AdaptiveSoftmax(size, adaptive_cutoffs)
+        softmax_loss_function = output_projection.loss
+      elif num_samples > 0 and num_samples < self.target_vocab_size:
+        w_t = tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=tf.float32)
         w = tf.transpose(w_t)
-        b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=dtype)
+        b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=tf.float32)
         output_projection = (w, b)
 
         def sampled_loss(labels, inputs):
@@ -123,6 +172,7 @@ class Seq2SeqModel(object):
                   num_classes=self.target_vocab_size),
               dtype)
         softmax_loss_function = sampled_loss
+      self.output_projection = output_projection
 
       # Create the internal multi-layer cell for our RNN.
       #def single_cell():
@@ -146,7 +196,8 @@ class Seq2SeqModel(object):
             num_layers=num_layers,
             output_projection=output_projection,
             feed_previous=feed_previous, #do_decode,
-            dtype=dtype)
+            dtype=dtype,
+            cell_impl=cell_impl)
 
       # Feeds for inputs.
       self.encoder_inputs = []
@@ -165,9 +216,22 @@ class Seq2SeqModel(object):
       targets = [self.decoder_inputs[i + 1]
                  for i in xrange(len(self.decoder_inputs) - 1)]
 
+      # Shared negatives are drawn once per batch, for the bucket it fills.
+      if output_projection is not None and negative_sampler != 'per_step':
+        softmax_loss_function = [
+          sampled_softmax.shared_negatives_loss(
+            negative_sampler, w_t, b, targets[:decoder_size],
+            self.target_weights[:decoder_size], num_samples,
+            self.target_vocab_size, dtype, unigram_counts)
+          for _, decoder_size in buckets]
+
       # for reinforcement learning
-      self.force_dec_input = tf.placeholder(tf.bool, name="force_dec_input")
-      self.en_output_proj = tf.placeholder(tf.bool, name="en_output_proj")
+      if decode_mode is None:
+        self.force_dec_input = tf.placeholder(tf.bool, name="force_dec_input")
+        self.en_output_proj = tf.placeholder(tf.bool, name="en_output_proj")
+        feed_previous = tf.where(self.force_dec_input, False, True) # True for feeding decoder input
+      else:
+        feed_previous = decode_mode == 'infer_greedy'
 
       # Training outputs and losses.
 #      if forward_only:
@@ -189,29 +253,74 @@ class Seq2SeqModel(object):
 #            lambda x, y: seq2seq_f(x, y, False),
 #            softmax_loss_function=softmax_loss_function)
 
-      # Training outputs and losses.
-      self.outputs, self.losses, self.encoder_state = seq2seq_tf.model_with_buckets(
+      # Training outputs and losses. Each example's log-perplexity is scaled
+      # by its example weight, one unless a policy-gradient step feeds its
+      # advantage, before averaging over the batch as sequence_loss does.
+      self.example_weights = tf.placeholder(dtype, shape=[None], name="example_weights")
+      self.outputs, example_losses, self.encoder_state = seq2seq_tf.model_with_buckets(
           self.encoder_inputs, self.decoder_inputs, targets,
           self.target_weights, buckets, 
-          lambda x, y: seq2seq_f(x, y, tf.where(self.force_dec_input, False, True)), # True for feeding decoder input
-          softmax_loss_function=softmax_loss_function
+          lambda x, y: seq2seq_f(x, y, feed_previous),
+          softmax_loss_function=softmax_loss_function,
+          per_example_loss=True
         )
+      self.losses = [
+        tf.reduce_sum(losses * self.example_weights) / tf.cast(tf.shape(losses)[0], dtype)
+        for losses in example_losses
+      ]
+      # Log-likelihood of each example's targets over their number,
+      # log P(b|a) / len(b), under the full softmax; log_prob() fetches these
+      # instead of the logits of every step.
+      if decode_mode != 'infer_greedy':
+        self.log_probs = []
+        for b in xrange(len(buckets)):
+          decoder_size = buckets[b][1]
+          logits = self.outputs[b]
+          if callable(output_projection):
+            # Its loss is already -log P of the target under the full
+            # distribution, computed from the cluster of the target only.
+            weights = [tf.cast(weight, tf.float32)
+                       for weight in self.target_weights[:decoder_size]]
+            self.log_probs.append(-seq2seq_tf.sequence_loss_by_example(
+                targets[:decoder_size], logits, weights,
+                softmax_loss_function=lambda labels, inputs: output_projection.loss(
+                    labels, inputs, tf.float32),
+                name="log_probs"))
+            continue
+          if output_projection is not None:
+            logits = [project(output, output_projection) for output in logits]
+          weights = [tf.cast(weight, logits[0].dtype)
+                     for weight in self.target_weights[:decoder_size]]
+          self.log_probs.append(-seq2seq_tf.sequence_loss_by_example(
+              targets[:decoder_size], logits, weights, name="log_probs"))
       # If we use output projection, we need to project outputs for decoding.
       # if output_projection is not None:
       for b in xrange(len(buckets)):
+        if decode_mode is not None:
+          # Inference steps always fetch projected outputs.
+          self.outputs[b] = [
+            project(output, output_projection)
+            for output in self.outputs[b]
+          ]
+          continue
         self.outputs[b] = [
           control_flow_ops.cond(
             self.en_output_proj, # 
-            lambda: tf.matmul(output, output_projection[0]) + output_projection[1], # True
-            lambda: output)
+            lambda: project(output, output_projection), # True
+            lambda: tf.cast(output, tf.float32))
           for output in self.outputs[b]
         ]
         
+      # Encoder-only and single-step decoder graphs for incremental decoding.
+      if predict_or_train:
+        self._build_incremental_decoder(use_lstm, size, num_layers,
+                                        output_projection, dtype)
+
       # Gradients and SGD update operation for training the model.
       params = tf.trainable_variables()
       self.advantage = [tf.placeholder(tf.float32, name="advantage_%i" % i) for i in xrange(len(buckets))]
 
-      if not predict_or_train:
+      if not predict_or_train and decode_mode is None:
         self.gradient_norms = []
         self.updates = []
         opt = tf.train.GradientDescentOptimizer(self.learning_rate)
@@ -226,11 +335,162 @@ class Seq2SeqModel(object):
 
       all_variables = tf.global_variables()
       all_variables = [k for k in tf.global_variables() if k.name.startswith(self.scope_name)]
-      self.saver = tf.train.Saver(all_variables, max_to_keep=0)
+      self.checkpoint_variables = dict((v.op.name, v) for v in all_variables)
+      self.saver = tf.train.Saver(self.checkpoint_variables, max_to_keep=0)
+
+
+  def _build_incremental_decoder(self, use_lstm, size, num_layers,
+                                 output_projection, dtype):
+    """Build the graphs used by encode() and decode_step().
+
+    The encoder is built once per bucket and the decoder for a single step,
+    reusing the variables of the bucket graphs, so a checkpoint restores both.
+    The decoder state is fed and fetched as a flat list of tensors, and the
+    attention keys are computed with the encoder outputs, once per encoding.
+    """
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      self.attention_states, self.initial_decoder_state = [], []
+      self.attention_memory = []
+      for encoder_size, _ in self.buckets:
+        attention_states, encoder_state = seq2seq_bi.google_mt_encoder(
+            self.encoder_inputs[:encoder_size], use_lstm,
+            num_encoder_symbols=self.source_vocab_size,
+            embedding_size=size,
+            num_layers=num_layers,
+            dtype=dtype,
+            cell_impl=self.cell_impl)
+        self.attention_states.append(attention_states)
+        self.attention_memory.append(
+            seq2seq_bi.google_mt_attention_memory(attention_states, dtype=dtype))
+        self.initial_decoder_state.append(nest.flatten(encoder_state))
+    self._build_decoder_step(use_lstm, size, num_layers, output_projection, dtype)
+
+
+  def _build_decoder_step(self, use_lstm, size, num_layers, output_projection,
+                          dtype):
+    """Build the single-step decoder of decode_step(), reusing variables.
+
+    Its logits are computed over the whole vocabulary, or over the rows of
+    step_shortlist only, gathered from the output projection; an adaptive
+    softmax computes them all and gathers the shortlist from them.
+    """
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      state_size = seq2seq_bi.google_mt_decoder_cell(
+          use_lstm, size, num_layers, cell_impl=self.cell_impl).state_size
+      self.step_decoder_input = tf.placeholder(
+          tf.int32, shape=[None], name="step_decoder_input")
+      self.step_attention_memory = tf.placeholder(
+          dtype, shape=[None, None, 2 * size], name="step_attention_memory")
+      step_attention_states, step_attention_keys = seq2seq_bi.split_attention_memory(
+          self.step_attention_memory)
+      self.step_decoder_state = [
+          tf.placeholder(dtype, shape=[None, s], name="step_decoder_state%d" % i)
+          for i, s in enumerate(nest.flatten(state_size))]
+      step_state = nest.pack_sequence_as(state_size, self.step_decoder_state)
+      self.step_shortlist = tf.placeholder(tf.int32, shape=[None], name="step_shortlist")
+      if output_projection is not None and not callable(output_projection):
+        shortlist_w_t = quantized_rows.embedding_lookup(
+            tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=tf.float32),
+            self.step_shortlist)
+        shortlist_b = tf.gather(output_projection[1], self.step_shortlist)
+
+      # The first step starts from zero attentions like the bucket graphs do;
+      # later steps recompute them from the cached state.
+      self.step_logits, self.step_shortlist_logits, self.step_next_state = [], [], []
+      for initial_state_attention in (False, True):
+        output, state = seq2seq_bi.google_mt_decoder_step(
+            self.step_decoder_input, step_state, step_attention_states,
+            use_lstm,
+            num_decoder_symbols=self.target_vocab_size,
+            embedding_size=size,
+            num_layers=num_layers,
+            output_projection=output_projection,
+            dtype=dtype,
+            initial_state_attention=initial_state_attention,
+            cell_impl=self.cell_impl,
+            attention_keys=step_attention_keys)
+        if callable(output_projection):
+          output = project(output, output_projection)
+          self.step_shortlist_logits.append(
+              tf.transpose(tf.gather(tf.transpose(output), self.step_shortlist)))
+        elif output_projection is not None:
+          self.step_shortlist_logits.append(
+              tf.matmul(tf.cast(output, tf.float32), shortlist_w_t, transpose_b=True) + shortlist_b)
+          output = project(output, output_projection)
+        else:
+          self.step_shortlist_logits.append(
+              tf.transpose(tf.gather(tf.transpose(output), self.step_shortlist)))
+        self.step_logits.append(output)
+        self.step_next_state.append(nest.flatten(state))
+
+
+  def encode(self, session, encoder_inputs, bucket_id):
+    """Run the encoder of a bucket once, for incremental decoding.
+
+    Args:
+      session: tensorflow session to use.
+      encoder_inputs: list of numpy int vectors to feed as encoder inputs.
+      bucket_id: which bucket of the model to use.
+
+    Returns:
+      A pair (attention_memory, decoder_state): the encoder outputs attended
+      over by decode_step followed by their attention keys, an array
+      [batch_size x encoder_size x 2 * size] whose rows can be selected or
+      repeated like the batch, and the initial decoder state as a list of
+      arrays.
+
+    Raises:
+      ValueError: if length of encoder_inputs disagrees with the bucket size.
+    """
+    encoder_size, _ = self.buckets[bucket_id]
+    if len(encoder_inputs) != encoder_size:
+      raise ValueError("Encoder length must be equal to the one in bucket,"
+                       " %d != %d." % (len(encoder_inputs), encoder_size))
+    input_feed = {}
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+    output_feed = [self.attention_memory[bucket_id]] + self.initial_decoder_state[bucket_id]
+    outputs = session.run(output_feed, input_feed)
+    return outputs[0], outputs[1:]
+
+
+  def decode_step(self, session, decoder_input, decoder_state, attention_memory,
+                  first_step=False, shortlist=None):
+    """Advance the decoder by one token from a cached state.
+
+    Args:
+      session: tensorflow session to use.
+      decoder_input: numpy int vector, the current decoder token per row.
+      decoder_state: list of arrays, as returned by encode() or decode_step().
+      attention_memory: array [batch_size x attn_length x 2 * size] from
+        encode().
+      first_step: whether this is the first (GO) step of the decoder.
+      shortlist: optional int32 vector of token ids to compute the logits of,
+        instead of the whole target vocabulary.
+
+    Returns:
+      A pair (logits, decoder_state): output logits over the target vocabulary
+      (or the shortlist) and the decoder state to feed to the next step.
+    """
+    step = 0 if first_step else 1
+    input_feed = {
+      self.step_decoder_input.name:     decoder_input,
+      self.step_attention_memory.name:  attention_memory,
+    }
+    for placeholder, value in zip(self.step_decoder_state, decoder_state):
+      input_feed[placeholder.name] = value
+    if shortlist is None:
+      logits = self.step_logits[step]
+    else:
+      logits = self.step_shortlist_logits[step]
+      input_feed[self.step_shortlist.name] = shortlist
+    outputs = session.run([logits] + self.step_next_state[step], input_feed)
+    return outputs[0], outputs[1:]
 
 
   def step(self, session, encoder_inputs, decoder_inputs, target_weights,
-           bucket_id, forward_only, force_dec_input=False, advantage=None, ScheduledSampling=False):
+           bucket_id, forward_only, force_dec_input=False, advantage=None, ScheduledSampling=False,
+           example_weights=None):
 
     """Run a step of the model feeding the given inputs.
 
@@ -241,6 +501,8 @@ class Seq2SeqModel(object):
       target_weights: list of numpy float vectors to feed as target weights.
       bucket_id: which bucket of the model to use.
       forward_only: whether to do the backward step or only forward.
+      example_weights: optional numpy float vector scaling the loss of each
+        example, e.g. its advantage in a policy-gradient step; ones if None.
 
     Returns:
       A triple consisting of gradient norm (or None if we did not do backward),
@@ -265,12 +527,21 @@ class Seq2SeqModel(object):
     if ScheduledSampling:
       force_dec_input = np.random.rand() > 0.25
     # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
-    input_feed = {
-      self.force_dec_input.name:  force_dec_input,
-      self.en_output_proj.name:   forward_only,
-    }
+    if self.decode_mode is None:
+      input_feed = {
+        self.force_dec_input.name:  force_dec_input,
+        self.en_output_proj.name:   forward_only,
+      }
+    elif not forward_only or force_dec_input != (self.decode_mode == 'infer_forced'):
+      raise ValueError("A model built for %s only runs forward_only steps with"
+                       " force_dec_input=%s." % (self.decode_mode, self.decode_mode == 'infer_forced'))
+    else:
+      input_feed = {}
     for l in xrange(len(self.buckets)):
       input_feed[self.advantage[l].name] = advantage[l] if advantage else 0
+    if example_weights is None:
+      example_weights = np.ones(len(encoder_inputs[0]))
+    input_feed[self.example_weights.name] = example_weights
     for l in xrange(encoder_size):
       input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
     for l in xrange(decoder_size):
@@ -279,7 +550,7 @@ class Seq2SeqModel(object):
     
     # Since our targets are decoder inputs shifted by one, we need one more.
     last_target = self.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+    input_feed[last_target] = np.zeros([len(decoder_inputs[0])], dtype=np.int32)
 
 
     # Output feed: depends on whether we do a backward step or not.
@@ -402,9 +673,6 @@ class Seq2SeqModel(object):
 
   # log(P(b|a)), the conditional likelyhood
   def logProb(self, session, buckets, tokens_a, tokens_b, deal_with_b):
-    def softmax(x):
-      return np.exp(x) / np.sum(np.exp(x), axis=0)
-
     # prepare for next dialogue
     if deal_with_b:
       tokens_b = [b[0] for b in tokens_b]
@@ -416,39 +684,7 @@ class Seq2SeqModel(object):
         eos = tokens_b.index(data_utils.EOS_ID)
         tokens_b = tokens_b[:eos]
       tokens_b.append(data_utils.EOS_ID)
-    # print('tokens_a',tokens_a, len(tokens_a))
-    # print('tokens_b',tokens_b, len(tokens_b))
-    bucket_id = [b for b in range(len(buckets)) if buckets[b][0] > len(tokens_a) and  buckets[b][1] > len(tokens_b)]
-    if len(bucket_id) > 0:
-      bucket_id = min(bucket_id)
-    else:
-      bucket_id = len(buckets)-1
-      if data_utils.EOS_ID in tokens_a:
-        eos = tokens_a.index(data_utils.EOS_ID)
-        tokens_a = tokens_a[:eos]
-      tokens_a = tokens_a[:(buckets[bucket_id][0]-1)]
-      tokens_a.append(data_utils.EOS_ID)
-      if data_utils.EOS_ID in tokens_b:
-        eos = tokens_b.index(data_utils.EOS_ID)
-        tokens_b = tokens_b[:eos]
-      tokens_b = tokens_b[:(buckets[bucket_id][1]-1)]
-      tokens_b.append(data_utils.EOS_ID)
-      # print('fix_tokens_a',tokens_a, len(tokens_a))
-      # print('fix_tokens_b',tokens_b, len(tokens_b))
-    feed_data = {bucket_id: [(tokens_a, tokens_b)]}
-    encoder_inputs, decoder_inputs, target_weights = self.get_batch(feed_data, bucket_id)
-
-    # step
-    _, _, output_logits = self.step(session, encoder_inputs, decoder_inputs, target_weights,
-                        bucket_id, forward_only=True, force_dec_input=True)
-    
-    # p = log(P(b|a)) / N
-    p = 1
-    for t, logit in zip(tokens_b, output_logits):
-      # print(logit) # why logit[0]
-      p *= softmax(logit[0])[t]
-    p = np.log(p) / len(tokens_b)
-    return p
+    return self.log_prob(session, [(tokens_a, tokens_b)])[0]
 
 
   def logits2tokens(self, logits, rev_vocab, sent_max_length=None, reverse=False):
@@ -468,6 +704,182 @@ class Seq2SeqModel(object):
     return tokens, txt
 
 
+  def _pair_bucket(self, len_a, len_b):
+    """Smallest bucket fitting token lists of these lengths, else the largest."""
+    fitting = [i for i, (encoder_size, decoder_size) in enumerate(self.buckets)
+               if encoder_size > len_a and decoder_size > len_b]
+    return min(fitting) if fitting else len(self.buckets) - 1
+
+
+  def _pairs_batch(self, pairs, bucket_id=None):
+    """Batch (tokens_a, tokens_b) pairs in the smallest bucket fitting all.
+
+    Token lists end with EOS; those too long for the bucket (by default, the
+    largest) are cut to fit it, keeping their final EOS.
+
+    Returns:
+      A pair (bucket_id, (encoder_inputs, decoder_inputs, target_weights)).
+    """
+    if bucket_id is None:
+      bucket_id = self._pair_bucket(max(len(a) for a, _ in pairs),
+                                    max(len(b) for _, b in pairs))
+    encoder_size, decoder_size = self.buckets[bucket_id]
+
+    def fit(tokens, size):
+      return tokens if len(tokens) < size else tokens[:size - 2] + [data_utils.EOS_ID]
+    pairs = [(fit(a, encoder_size), fit(b, decoder_size)) for a, b in pairs]
+    return bucket_id, data_utils.get_batch(pairs, self.buckets[bucket_id], len(pairs),
+                                           range(len(pairs)))
+
+
+  def log_prob(self, session, pairs, batch_size=256):
+    """logProb of many pairs: log P(b|a) / len(b) for each.
+
+    Pairs are grouped by the smallest bucket that fits them and scored
+    batch_size at a time by the log_probs op of that bucket, which only
+    returns one number per pair, so thousands of pairs take a few steps.
+
+    Args:
+      session: tensorflow session to use.
+      pairs: list of (tokens_a, tokens_b) token-id lists, each ending with EOS.
+      batch_size: maximum number of pairs scored in one step.
+
+    Returns:
+      A numpy vector with the score of each pair.
+
+    Raises:
+      ValueError: if the model was built with decode_mode 'infer_greedy'.
+    """
+    if self.decode_mode == 'infer_greedy':
+      raise ValueError("log_prob needs the forced decoder, not infer_greedy.")
+    by_bucket = {}
+    for i, (a, b) in enumerate(pairs):
+      by_bucket.setdefault(self._pair_bucket(len(a), len(b)), []).append(i)
+    scores = np.zeros(len(pairs))
+    for bucket_id, indices in sorted(by_bucket.items()):
+      for start in xrange(0, len(indices), batch_size):
+        rows = indices[start:start + batch_size]
+        _, batch = self._pairs_batch([pairs[i] for i in rows], bucket_id)
+        scores[rows] = self._run_log_probs(session, bucket_id, *batch)
+    return scores
+
+
+  def _run_log_probs(self, session, bucket_id, encoder_inputs, decoder_inputs,
+                     target_weights):
+    """Fetch log_probs of a batch in its bucket, teacher-forced."""
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    input_feed = {}
+    if self.decode_mode is None:
+      input_feed[self.force_dec_input.name] = True
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+    for l in xrange(decoder_size):
+      input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+      input_feed[self.target_weights[l].name] = target_weights[l]
+    input_feed[self.decoder_inputs[decoder_size].name] = np.zeros(
+        [len(decoder_inputs[0])], dtype=np.int32)
+    return session.run(self.log_probs[bucket_id], input_feed)
+
+
+  def _response_tokens(self, output_logits, sent_max_length):
+    """logits2tokens of every row of a batch of greedy outputs."""
+    selected = np.stack([np.argmax(logits, axis=1) for logits in output_logits], axis=1)
+    responses = []
+    for tokens in selected.tolist():
+      if data_utils.EOS_ID in tokens:
+        tokens = tokens[:tokens.index(data_utils.EOS_ID)]
+      responses.append(tokens[:sent_max_length - 1] + [data_utils.EOS_ID])
+    return responses
+
+
+  def step_rf_batch(self, args, session, encoder_inputs, decoder_inputs, target_weights,
+                    bucket_id, max_turns=10):
+    """One policy-gradient step over a batch of dialogue episodes.
+
+    step_rf for every column of the batch at once, of which only the
+    encoder inputs are used: each turn decodes the
+    live episodes greedily in one step, and scores the rewards of all of
+    them with batched log_prob calls (one for ease of answering over
+    all dummy dialogs, one for semantic coherence) and array ops (information
+    flow). An episode ends as in step_rf, or after max_turns.
+
+    The responses to the initial inputs are then trained on in one update,
+    each example weighted by its advantage: the episode's mean reward, less
+    the batch mean, over the batch standard deviation. The advantages of a
+    batch sum to zero, so it needs at least two episodes.
+
+    Returns:
+      A triple (gradient norm, loss, mean reward): the loss is the unweighted
+      teacher-forced loss of the responses before the update, as step
+      reports it, not the advantage-weighted loss, which is about zero.
+    """
+    sent_max_length = args.buckets[-1][0]
+    batch_size = len(encoder_inputs[0])
+    if batch_size < 2:
+      raise ValueError("Advantages compare the episodes of a batch, got a batch of %d" % batch_size)
+    inputs = []
+    for tokens in np.stack(encoder_inputs)[::-1].T.tolist():
+      tokens = [t for t in tokens if t != data_utils.PAD_ID]
+      if data_utils.EOS_ID in tokens:
+        tokens = tokens[:tokens.index(data_utils.EOS_ID)]
+      inputs.append(tokens + [data_utils.EOS_ID])
+
+    turn_inputs = list(inputs)
+    seen = [set([tuple(tokens)]) for tokens in inputs]
+    live = np.ones(batch_size, dtype=bool)
+    rewards = [[] for _ in xrange(batch_size)]
+    enc_states = None
+    for turn in xrange(max_turns):
+      rows = np.nonzero(live)[0]
+      batch_bucket_id, batch = self._pairs_batch([(turn_inputs[r], []) for r in rows])
+      encoder_state, _, output_logits = self.step(session, batch[0], batch[1], batch[2],
+                                                  batch_bucket_id, forward_only=True,
+                                                  force_dec_input=False)
+      responses = self._response_tokens(output_logits, sent_max_length)
+      if turn == 0:
+        first_responses = responses
+
+      # r1: Ease of answering
+      if self.dummy_dialogs:
+        r1 = -self.log_prob(session, [(resp, d) for resp in responses
+                                            for d in self.dummy_dialogs])
+        r1 = r1.reshape(len(rows), -1).mean(axis=1)
+      else:
+        r1 = np.zeros(len(rows))
+
+      # r2: Information Flow, between consecutive encoder states of an episode
+      states = np.concatenate(nest.flatten(encoder_state), axis=1)
+      if enc_states is None:
+        enc_states = np.zeros((batch_size, states.shape[1]), dtype=states.dtype)
+        r2 = np.zeros(len(rows))
+      else:
+        prev = enc_states[rows]
+        cos = np.sum(prev * states, axis=1) / np.sum(np.abs(prev) * np.abs(states), axis=1)
+        r2 = -np.log(np.maximum(cos, 1e-12))  # Opposed states would give nan.
+      enc_states[rows] = states
+
+      # r3: Semantic Coherence
+      r3 = -self.log_prob(session, [(resp, turn_inputs[r]) for resp, r in zip(responses, rows)])
+
+      for r, reward, resp in zip(rows, 0.25*r1 + 0.25*r2 + 0.5*r3, responses):
+        rewards[r].append(reward)
+        if resp in self.dummy_dialogs or len(resp) <= 3 or tuple(resp) in seen[r]:
+          live[r] = False  # check if dialog ended
+        seen[r].add(tuple(resp))
+        turn_inputs[r] = resp
+      if not live.any():
+        break
+
+    episode_rewards = np.array([np.mean(r) for r in rewards])
+    advantages = (episode_rewards - np.mean(episode_rewards)) / (np.std(episode_rewards) + 1e-8)
+    update_bucket_id, batch = self._pairs_batch(list(zip(inputs, first_responses)))
+    step_loss = -np.mean(self._run_log_probs(session, update_bucket_id, *batch))
+    gradient_norm, _, _ = self.step(session, batch[0], batch[1], batch[2], update_bucket_id,
+                                    forward_only=False, force_dec_input=True,
+                                    example_weights=advantages)
+    return gradient_norm, step_loss, np.mean(episode_rewards)
+
+
   def discount_rewards(self, r, gamma=0.99):
     """ take 1D float array of rewards and compute discounted reward """
     discounted_r = np.zeros_like(r)
@@ -478,7 +890,7 @@ class Seq2SeqModel(object):
     return discounted_r
 
 
-  def get_batch(self, data, bucket_id):
+  def get_batch(self, data, bucket_id, batch_indices=None):
     """Get a random batch of data from the specified bucket, prepare for step.
 
     To feed data in step(..) it must be a list of batch-major vectors, while
@@ -487,53 +899,15 @@ class Seq2SeqModel(object):
 
     Args:
       data: a tuple of size len(self.buckets) in which each element contains
-        lists of pairs of input and output data that we use to create a batch.
+        lists of pairs of input and output data that we use to create a batch,
+        or is a bucket of data_utils.pad_data.
       bucket_id: integer, which bucket to get the batch for.
+      batch_indices: optional indices into data[bucket_id] of the examples to
+        batch, in order; by default batch_size random examples are drawn.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
       the constructed batch that has the proper format to call step(...) later.
     """
-    encoder_size, decoder_size = self.buckets[bucket_id]
-    encoder_inputs, decoder_inputs = [], []
-
-    # Get a random batch of encoder and decoder inputs from data,
-    # pad them if needed, reverse encoder inputs and add GO to decoder.
-    for _ in xrange(self.batch_size):
-      encoder_input, decoder_input = random.choice(data[bucket_id])
-
-      # Encoder inputs are padded and then reversed.
-      encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-      encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
-
-      # Decoder inputs get an extra "GO" symbol, and are padded then.
-      decoder_pad_size = decoder_size - len(decoder_input) - 1
-      decoder_inputs.append([data_utils.GO_ID] + decoder_input +
-                            [data_utils.PAD_ID] * decoder_pad_size)
-
-    # Now we create batch-major vectors from the data selected above.
-    batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
-
-    # Batch encoder inputs are just re-indexed encoder_inputs.
-    for length_idx in xrange(encoder_size):
-      batch_encoder_inputs.append(
-          np.array([encoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-    # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
-    for length_idx in xrange(decoder_size):
-      batch_decoder_inputs.append(
-          np.array([decoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-      # Create target_weights to be 0 for targets that are padding.
-      batch_weight = np.ones(self.batch_size, dtype=np.float32)
-      for batch_idx in xrange(self.batch_size):
-        # We set weight to 0 if the corresponding target is a PAD symbol.
-        # The corresponding target is decoder_input shifted by 1 forward.
-        if length_idx < decoder_size - 1:
-          target = decoder_inputs[batch_idx][length_idx + 1]
-        if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-          batch_weight[batch_idx] = 0.0
-      batch_weights.append(batch_weight)
-    return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+    return data_utils.get_batch(data[bucket_id], self.buckets[bucket_id],
+                                self.batch_size, batch_indices)
@@ -0,0 +1,293 @@
+"""Sequence-to-sequence model with attention as one graph for all lengths."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.util import nest
+from lib import seq2seq_bi
+from lib import seq2seq_dynamic
+from lib import seq2seq_model_bi
+from lib import sampled_softmax
+
+
+def checkpoint_variables(scope_name, checkpoint_scope):
+  """Variables under scope_name, keyed by their name in a checkpoint.
+
+  The dynamic graphs create their variables under the same names as
+  seq2seq_model_bi.Seq2SeqModel, so only the outer scope may differ, e.g.
+  when both models are built in one graph.
+
+  Returns:
+    A dict {checkpoint variable name: variable} for tf.train.Saver.
+  """
+  prefix = scope_name + "/"
+  return dict((checkpoint_scope + "/" + v.op.name[len(prefix):], v)
+              for v in tf.global_variables() if v.op.name.startswith(prefix))
+
+
+class Seq2SeqModel(seq2seq_model_bi.Seq2SeqModel):
+  """seq2seq_model_bi.Seq2SeqModel built once for every sequence length.
+
+  The bucketed model unrolls an encoder and, inside a cond, two decoders per
+  bucket. Here the encoder is a dynamic_rnn and the decoder a while_loop over
+  [max_time x batch_size] feeds (see seq2seq_dynamic), so graph size and
+  construction time do not depend on the buckets, which only group examples
+  of similar length into batches. step(), encode() and the rest of the
+  interface are the same, and both models read each other's checkpoints.
+  """
+
+  def __init__(self,
+               source_vocab_size,
+               target_vocab_size,
+               buckets,
+               size,
+               num_layers,
+               max_gradient_norm,
+               batch_size,
+               learning_rate,
+               learning_rate_decay_factor,
+               use_lstm=False,
+               num_samples=512,
+               predict_or_train=False,
+               scope_name='seq2seq',
+               checkpoint_scope='seq2seq',
+               decode_mode=None,
+               dtype=tf.float32,
+               cell_impl='basic',
+               negative_sampler='per_step',
+               unigram_counts=None):
+    """Create the model.
+
+    Args are those of seq2seq_model_bi.Seq2SeqModel, and
+      checkpoint_scope: scope the variables are saved and restored under.
+    The loss is computed in one call for all steps, so 'per_step' negatives
+    are already shared by the whole batch here.
+    """
+    if negative_sampler not in sampled_softmax.NEGATIVE_SAMPLERS:
+      raise ValueError("Unknown negative sampler %s, choose from %s"
+                       % (negative_sampler, sampled_softmax.NEGATIVE_SAMPLERS))
+    if decode_mode not in (None, 'infer_greedy', 'infer_forced'):
+      raise ValueError("Unknown decode_mode %s" % decode_mode)
+    self.decode_mode = decode_mode
+    self.cell_impl = cell_impl
+    self.scope_name = scope_name
+    with tf.variable_scope(self.scope_name):
+      self.source_vocab_size = source_vocab_size
+      self.target_vocab_size = target_vocab_size
+      self.buckets = buckets
+      self.batch_size = batch_size
+      self.learning_rate = tf.Variable(
+          float(learning_rate), trainable=False, dtype=dtype)
+      self.learning_rate_decay_op = self.learning_rate.assign(
+          self.learning_rate * learning_rate_decay_factor)
+      self.global_step = tf.Variable(0, trainable=False)
+      self.dummy_dialogs = []  # dull responses the RL reward penalises, see step_rf
+      self.shortlist = None  # shortlist.Shortlist to decode over, if any
+
+      # If we use sampled softmax, we need an output projection.
+      output_projection = None
+      softmax_loss_function = None
+      # Sampled softmax only makes sense if we sample less than vocabulary size.
+      if num_samples > 0 and num_samples < self.target_vocab_size:
+        w_t = tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=tf.float32)
+        w = tf.transpose(w_t)
+        b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=tf.float32)
+        output_projection = (w, b)
+
+        def sampled_loss(labels, inputs):
+          labels = tf.reshape(labels, [-1, 1])
+          # We need to compute the sampled_softmax_loss using 32bit floats to
+          # avoid numerical instabilities.
+          local_w_t = tf.cast(w_t, tf.float32)
+          local_b = tf.cast(b, tf.float32)
+          local_inputs = tf.cast(inputs, tf.float32)
+          return tf.cast(
+              tf.nn.sampled_softmax_loss(
+                  weights=local_w_t,
+                  biases=local_b,
+                  labels=labels,
+                  inputs=local_inputs,
+                  num_sampled=num_samples,
+                  num_classes=self.target_vocab_size),
+              dtype)
+        softmax_loss_function = sampled_loss
+
+      # Feeds for inputs, time-major.
+      self.encoder_inputs = tf.placeholder(tf.int32, shape=[None, None], name="encoder")
+      self.decoder_inputs = tf.placeholder(tf.int32, shape=[None, None], name="decoder")
+      self.target_weights = tf.placeholder(dtype, shape=[None, None], name="weight")
+
+      # Our targets are decoder inputs shifted by one, padded at the end.
+      targets = tf.concat([self.decoder_inputs[1:],
+                           tf.zeros_like(self.decoder_inputs[:1])], 0)
+      # Weighted positions are a prefix of each column.
+      decoder_lengths = tf.reduce_sum(
+          tf.cast(tf.greater(self.target_weights, 0), tf.int32), 0)
+
+      # for reinforcement learning
+      if decode_mode is None:
+        self.force_dec_input = tf.placeholder(tf.bool, name="force_dec_input")
+        feed_previous = tf.logical_not(self.force_dec_input)
+      else:
+        feed_previous = decode_mode == 'infer_greedy'
+      self.advantage = tf.placeholder(tf.float32, name="advantage")
+
+      with tf.variable_scope("google_mt_seq2seq"):
+        self.attention_states, self.encoder_state = seq2seq_dynamic.dynamic_encoder(
+            self.encoder_inputs, use_lstm,
+            num_encoder_symbols=source_vocab_size,
+            embedding_size=size,
+            num_layers=num_layers,
+            dtype=dtype,
+            cell_impl=cell_impl)
+        decoder_cell = seq2seq_bi.google_mt_decoder_cell(
+            use_lstm, size, num_layers, target_vocab_size, output_projection,
+            cell_impl=cell_impl)
+        outputs, _ = seq2seq_dynamic.dynamic_attention_decoder(
+            self.decoder_inputs,
+            decoder_lengths,
+            self.encoder_state,
+            self.attention_states,
+            decoder_cell,
+            target_vocab_size,
+            size,
+            feed_previous,
+            output_size=None if output_projection else target_vocab_size,
+            output_projection=output_projection,
+            dtype=dtype)
+
+      # Average log-perplexity per example as seq2seq.sequence_loss, over the
+      # flattened [max_time * batch_size] outputs.
+      output_size = outputs.get_shape()[2].value
+      flat_targets = tf.reshape(targets, [-1])
+      flat_outputs = tf.reshape(outputs, [-1, output_size])
+      if output_projection is not None and negative_sampler != 'per_step':
+        softmax_loss_function = sampled_softmax.shared_negatives_loss(
+            negative_sampler, w_t, b, [flat_targets], [self.target_weights],
+            num_samples, self.target_vocab_size, dtype, unigram_counts)
+      if softmax_loss_function is None:
+        crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=flat_targets, logits=flat_outputs)
+      else:
+        crossent = softmax_loss_function(flat_targets, flat_outputs)
+      crossent = tf.reshape(crossent, tf.shape(targets))
+      log_perps = (tf.reduce_sum(crossent * self.target_weights, 0) /
+                   (tf.reduce_sum(self.target_weights, 0) + 1e-12))
+      self.example_weights = tf.placeholder(dtype, shape=[None], name="example_weights")
+      self.loss = (tf.reduce_sum(log_perps * self.example_weights) /
+                   tf.cast(tf.shape(targets)[1], dtype))
+
+      # Logits, only fetched by forward-only steps.
+      self.logits = outputs
+      if output_projection is not None:
+        self.logits = tf.reshape(
+            seq2seq_model_bi.project(flat_outputs, output_projection),
+            tf.stack([tf.shape(outputs)[0], tf.shape(outputs)[1], target_vocab_size]))
+
+      # log P(b|a) / len(b) of each example under the full softmax, as the
+      # log_probs of the bucketed model.
+      if decode_mode != 'infer_greedy':
+        if softmax_loss_function is not None:
+          crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+              labels=targets, logits=self.logits)
+        weights = tf.cast(self.target_weights, crossent.dtype)
+        self.log_probs = -(tf.reduce_sum(crossent * weights, 0) /
+                           (tf.reduce_sum(weights, 0) + 1e-12))
+
+      # Single-step decoder for incremental decoding; encode() runs the
+      # encoder above and projects the attention keys of its outputs.
+      if predict_or_train:
+        self.initial_decoder_state = nest.flatten(self.encoder_state)
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          self.attention_memory = seq2seq_bi.google_mt_attention_memory(
+              self.attention_states, dtype=dtype)
+        self._build_decoder_step(use_lstm, size, num_layers, output_projection, dtype)
+
+      # Gradients and SGD update operation for training the model.
+      params = tf.trainable_variables()
+      if not predict_or_train and decode_mode is None:
+        opt = tf.train.GradientDescentOptimizer(self.learning_rate)
+        self.loss = tf.subtract(self.loss, self.advantage)
+        gradients = tf.gradients(self.loss, params)
+        clipped_gradients, self.gradient_norm = tf.clip_by_global_norm(
+            gradients, max_gradient_norm)
+        self.update = opt.apply_gradients(
+            zip(clipped_gradients, params), global_step=self.global_step)
+
+      self.checkpoint_variables = checkpoint_variables(self.scope_name, checkpoint_scope)
+      self.saver = tf.train.Saver(self.checkpoint_variables, max_to_keep=0)
+
+
+  def encode(self, session, encoder_inputs, bucket_id):
+    """Run the encoder once, for incremental decoding.
+
+    See seq2seq_model_bi.Seq2SeqModel.encode; bucket_id is not used, the
+    encoder runs over len(encoder_inputs) steps.
+    """
+    input_feed = {self.encoder_inputs.name: np.stack(encoder_inputs)}
+    outputs = session.run([self.attention_memory] + self.initial_decoder_state, input_feed)
+    return outputs[0], outputs[1:]
+
+
+  def step(self, session, encoder_inputs, decoder_inputs, target_weights,
+           bucket_id, forward_only, force_dec_input=False, advantage=None, ScheduledSampling=False,
+           example_weights=None):
+    """Run a step of the model feeding the given inputs.
+
+    See seq2seq_model_bi.Seq2SeqModel.step; the lengths are checked against
+    the bucket, and advantage[bucket_id] is subtracted from the loss.
+    """
+    # Check if the sizes match.
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    if len(encoder_inputs) != encoder_size:
+      raise ValueError("Encoder length must be equal to the one in bucket,"
+                       " %d != %d." % (len(encoder_inputs), encoder_size))
+    if len(decoder_inputs) != decoder_size:
+      raise ValueError("Decoder length must be equal to the one in bucket,"
+                       " %d != %d." % (len(decoder_inputs), decoder_size))
+    if len(target_weights) != decoder_size:
+      raise ValueError("Weights length must be equal to the one in bucket,"
+                       " %d != %d." % (len(target_weights), decoder_size))
+    # Scheduled sampling
+    if ScheduledSampling:
+      force_dec_input = np.random.rand() > 0.25
+    if self.decode_mode is not None and (
+        not forward_only or force_dec_input != (self.decode_mode == 'infer_forced')):
+      raise ValueError("A model built for %s only runs forward_only steps with"
+                       " force_dec_input=%s." % (self.decode_mode, self.decode_mode == 'infer_forced'))
+    input_feed = {
+      self.advantage.name:        advantage[bucket_id] if advantage else 0,
+      self.encoder_inputs.name:   np.stack(encoder_inputs),
+      self.decoder_inputs.name:   np.stack(decoder_inputs),
+      self.target_weights.name:   np.stack(target_weights),
+      self.example_weights.name:  (np.ones(len(encoder_inputs[0])) if example_weights is None
+                                   else example_weights),
+    }
+
+    if self.decode_mode is None:
+      input_feed[self.force_dec_input.name] = force_dec_input
+
+    if not forward_only: # update
+      _, gradient_norm, loss = session.run(
+          [self.update, self.gradient_norm, self.loss], input_feed)
+      return gradient_norm, loss, None  # Gradient norm, loss, no outputs.
+    encoder_state, loss, logits = session.run(
+        [self.encoder_state, self.loss, self.logits], input_feed)
+    return encoder_state, loss, list(logits)  # encoder_state, loss, outputs.
+
+
+  def _run_log_probs(self, session, bucket_id, encoder_inputs, decoder_inputs,
+                     target_weights):
+    """Fetch log_probs of a batch, teacher-forced; bucket_id is not used."""
+    input_feed = {
+      self.encoder_inputs.name:   np.stack(encoder_inputs),
+      self.decoder_inputs.name:   np.stack(decoder_inputs),
+      self.target_weights.name:   np.stack(target_weights),
+    }
+    if self.decode_mode is None:
+      input_feed[self.force_dec_input.name] = True
+    return session.run(self.log_probs, input_feed)
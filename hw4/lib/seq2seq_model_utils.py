@@ -4,45 +4,33 @@ from __future__ import print_function
 
 import numpy as np
 import tensorflow as tf
-from random import random
 from datetime import datetime
 from tensorflow.python.platform import gfile
 
 from lib import data_utils
+from lib.adaptive_softmax import load_cutoffs
+from lib.beam_search import Beam
+from lib.frozen_model import FrozenModel
+from lib import quantized_rows
+from lib.sampled_softmax import load_unigram_counts
+from lib.shortlist import load_shortlist
 from lib import seq2seq_model
 from lib import seq2seq_model_bi
+from lib import seq2seq_model_dynamic
 
 
-import heapq
-
 def create_model(session, args, predict_or_train=True):
   """Create translation model and initialize or load parameters in session."""
-  if not args.bi:
-    model = seq2seq_model.Seq2SeqModel(
-        source_vocab_size=args.vocab_size,
-        target_vocab_size=args.vocab_size,
-        buckets=args.buckets,
-        size=args.size,
-        num_layers=args.num_layers,
-        max_gradient_norm=args.max_gradient_norm,
-        batch_size=args.batch_size,
-        learning_rate=args.learning_rate,
-        learning_rate_decay_factor=args.learning_rate_decay_factor,
-        predict_or_train=predict_or_train,
-    )
-  else:
-    model = seq2seq_model_bi.Seq2SeqModel(
-        source_vocab_size=args.vocab_size,
-        target_vocab_size=args.vocab_size,
-        buckets=args.buckets,
-        size=args.size,
-        num_layers=args.num_layers,
-        max_gradient_norm=args.max_gradient_norm,
-        batch_size=args.batch_size,
-        learning_rate=args.learning_rate,
-        learning_rate_decay_factor=args.learning_rate_decay_factor,
-        predict_or_train=predict_or_train,
-    )
+  if predict_or_train and args.frozen_graph:
+    if args.shortlist:
+      raise ValueError("--shortlist needs the model, frozen graphs decode over the whole vocabulary")
+    model = FrozenModel(args.frozen_graph, args.batch_size)
+    if model.decode_mode != ('greedy' if args.beam_size == 1 else 'beam'):
+      raise ValueError("%s was exported for %s decoding, --beam_size %d does not match"
+                       % (args.frozen_graph, model.decode_mode, args.beam_size))
+    print("Loaded frozen %s graph from %s @ %s" % (model.decode_mode, args.frozen_graph, datetime.now()))
+    return model
+  model = build_model(args, predict_or_train)
 
   # for tensorboard
   if args.en_tfboard:
@@ -52,14 +40,102 @@ def create_model(session, args, predict_or_train=True):
   # if ckpt and gfile.Exists(ckpt.model_checkpoint_path):
   if ckpt and ckpt.model_checkpoint_path:
     print("Reading model parameters from %s @ %s" % (ckpt.model_checkpoint_path, datetime.now()))
-    model.saver.restore(session, ckpt.model_checkpoint_path)
+    if predict_or_train and args.dtype == 'float16':
+      restore_cast(session, model, ckpt.model_checkpoint_path)
+    else:
+      model.saver.restore(session, ckpt.model_checkpoint_path)
     print("Model reloaded @ %s" % (datetime.now()))
   else:
     print("Created model with fresh parameters.")
     session.run(tf.global_variables_initializer())
+  if predict_or_train:
+    model.shortlist = load_shortlist(args)
+  if predict_or_train and args.quantized:
+    quantized_rows.load(session, args.quantized)
+    print("Loaded int8 rows of %s from %s" % (", ".join(sorted(quantized_rows.quantized_names(args.quantized))),
+                                              args.quantized))
+  return model
+
+
+def build_model(args, predict_or_train=True):
+  """Build the model graph of args, without initialising or restoring it."""
+  dtype = tf.float16 if predict_or_train and args.dtype == 'float16' else tf.float32
+  # Quantised matrices are read from int8 rows instead of being restored.
+  custom_getter = None
+  if predict_or_train and args.quantized:
+    custom_getter = quantized_rows.quantized_getter(quantized_rows.quantized_names(args.quantized))
+  with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+    if dtype != tf.float32 and args.cell_impl != 'basic':
+      raise ValueError("--cell_impl %s kernels are float32 only, --dtype %s needs basic cells"
+                       % (args.cell_impl, args.dtype))
+    if not args.bi:
+      if dtype != tf.float32:
+        raise ValueError("--dtype %s needs the bidirectional model" % args.dtype)
+      if args.cell_impl != 'basic':
+        raise ValueError("--cell_impl %s needs the bidirectional model" % args.cell_impl)
+      if args.negative_sampler != 'per_step':
+        raise ValueError("--negative_sampler %s needs the bidirectional model" % args.negative_sampler)
+      if args.adaptive_softmax:
+        raise ValueError("--adaptive_softmax needs the bidirectional model")
+      if predict_or_train and args.beam_size > 1:
+        raise ValueError("--beam_size %d needs the bidirectional model, it decodes incrementally"
+                         % args.beam_size)
+      model = seq2seq_model.Seq2SeqModel(
+          source_vocab_size=args.vocab_size,
+          target_vocab_size=args.vocab_size,
+          buckets=args.buckets,
+          size=args.size,
+          num_layers=args.num_layers,
+          max_gradient_norm=args.max_gradient_norm,
+          batch_size=args.batch_size,
+          learning_rate=args.learning_rate,
+          learning_rate_decay_factor=args.learning_rate_decay_factor,
+          predict_or_train=predict_or_train,
+      )
+    else:
+      model_module = seq2seq_model_dynamic if args.dynamic else seq2seq_model_bi
+      output_layer = {}
+      if args.adaptive_softmax:
+        if args.dynamic:
+          raise ValueError("--adaptive_softmax needs the bucketed model, not --dynamic")
+        output_layer['adaptive_cutoffs'] = load_cutoffs(args)
+      # Negatives only matter to the training loss.
+      negative_sampler = 'per_step' if predict_or_train else args.negative_sampler
+      unigram_counts = load_unigram_counts(args) if negative_sampler == 'unigram' else None
+      model = model_module.Seq2SeqModel(
+          source_vocab_size=args.vocab_size,
+          target_vocab_size=args.vocab_size,
+          buckets=args.buckets,
+          size=args.size,
+          num_layers=args.num_layers,
+          max_gradient_norm=args.max_gradient_norm,
+          batch_size=args.batch_size,
+          learning_rate=args.learning_rate,
+          learning_rate_decay_factor=args.learning_rate_decay_factor,
+          predict_or_train=predict_or_train,
+          use_lstm=bool(args.use_lstm),
+          decode_mode=(args.decode_mode or None) if predict_or_train else None,
+          dtype=dtype,
+          cell_impl=args.cell_impl,
+          negative_sampler=negative_sampler,
+          unigram_counts=unigram_counts,
+          **output_layer
+      )
   return model
 
 
+def restore_cast(session, model, checkpoint_path):
+  """Restore a checkpoint into model variables of another dtype.
+
+  Each saved tensor is cast to the dtype of its variable, e.g. to load a
+  float32 checkpoint into a float16 model; tf.train.Saver needs them equal.
+  """
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  for name, variable in model.checkpoint_variables.items():
+    value = reader.get_tensor(name)
+    variable.load(value.astype(variable.dtype.base_dtype.as_numpy_dtype), session)
+
+
 def dict_lookup(rev_vocab, out):
     word = rev_vocab[out] if (out < len(rev_vocab)) else data_utils._UNK
     if isinstance(word, bytes):
@@ -73,6 +149,12 @@ def softmax(x):
     return prob
 
 
+def log_softmax(x):
+    """Row-wise log-softmax of a [batch_size x vocab_size] logits matrix."""
+    x = x - np.max(x, axis=1, keepdims=True)
+    return x - np.log(np.sum(np.exp(x), axis=1, keepdims=True))
+
+
 
 def cal_bleu(cands, ref, stopwords=['的', '嗎']):
     cands = [s['dec_inp'].split() for s in cands]
@@ -88,99 +170,232 @@ def cal_bleu(cands, ref, stopwords=['的', '嗎']):
     
 
 
-def get_predicted_sentence(args, input_sentence, vocab, rev_vocab, model, sess, debug=False, return_raw=False):
-    def model_step(enc_inp, dec_inp, dptr, target_weights, bucket_id, force_dec_input):
-      _, _, logits = model.step(sess, enc_inp, dec_inp, target_weights, bucket_id, forward_only=True, force_dec_input=force_dec_input, advantage=None, ScheduledSampling=False)
-      prob = softmax(logits[dptr][0])
-      # print("model_step @ %s" % (datetime.now()))
-      return prob
+def get_bucket_id(buckets, input_token_ids):
+    """Smallest bucket that fits the input; inputs too long for every bucket
+    are truncated to fit the largest one, keeping their final EOS."""
+    fitting = [b for b in range(len(buckets)) if buckets[b][0] > len(input_token_ids)]
+    if fitting:
+      return min(fitting), input_token_ids
+    bucket_id = len(buckets) - 1
+    return bucket_id, input_token_ids[:buckets[bucket_id][0] - 2] + [data_utils.EOS_ID]
+
+
+def _shortlist_columns(candidates, token_ids):
+    """Column of each token id in the sorted candidates, -1 where it is not one."""
+    columns = np.minimum(np.searchsorted(candidates, token_ids), len(candidates) - 1)
+    return np.where(candidates[columns] == token_ids, columns, -1)
+
+
+def greedy_decode(model, sess, bucket_id, inputs):
+    """Greedy decoding of a batch of inputs from one bucket in one step.
+
+    With a model.shortlist, the decoder is advanced one decode_step at a time
+    instead, choosing among the shortlist of the inputs only.
 
-    def greedy_dec(output_logits, rev_vocab):
-      selected_token_ids = [int(np.argmax(logit, axis=1)) for logit in output_logits]
+    Args:
+      inputs: list of input token-id lists, each ending with EOS.
+
+    Returns:
+      A list with the output token ids of each input, cut before EOS.
+    """
+    data = {bucket_id: [(input_token_ids, []) for input_token_ids in inputs]}
+    encoder_inputs, decoder_inputs, target_weights = model.get_batch(data, bucket_id, range(len(inputs)))
+    if getattr(model, 'shortlist', None) is None:
+      _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id, forward_only=True, force_dec_input=False, advantage=None, ScheduledSampling=False)
+      selected = np.argmax(np.stack(output_logits, axis=1), axis=2)
+    else:
+      candidates = model.shortlist.candidates(inputs)
+      attention_memory, dec_state = model.encode(sess, encoder_inputs, bucket_id)
+      dec_inp, selected = decoder_inputs[0], []  # GO
+      for dptr in range(len(decoder_inputs)):
+        logits, dec_state = model.decode_step(sess, dec_inp, dec_state, attention_memory,
+                                              first_step=(dptr == 0), shortlist=candidates)
+        dec_inp = candidates[np.argmax(logits, axis=1)]
+        selected.append(dec_inp)
+        if np.all(np.any(np.stack(selected) == data_utils.EOS_ID, axis=0)):
+          break
+      selected = np.stack(selected, axis=1)
+    outputs = []
+    for selected_token_ids in selected.tolist():
       if data_utils.EOS_ID in selected_token_ids:
         eos = selected_token_ids.index(data_utils.EOS_ID)
         selected_token_ids = selected_token_ids[:eos]
-      output_sentence = ' '.join([dict_lookup(rev_vocab, t) for t in selected_token_ids])
-      return output_sentence
+      outputs.append(selected_token_ids)
+    return outputs
 
-    input_token_ids = data_utils.sentence_to_token_ids(input_sentence, vocab)
-    input_token_ids.append(data_utils.EOS_ID)
-    # Which bucket does it belong to?
-    bucket_id = min([b for b in range(len(args.buckets)) if args.buckets[b][0] > len(input_token_ids)])
-    outputs = []
-    feed_data = {bucket_id: [(input_token_ids, outputs)]}
 
-    # Get a 1-element batch to feed the sentence to the model.
-    encoder_inputs, decoder_inputs, target_weights = model.get_batch(feed_data, bucket_id)
-    if debug: print("\n[get_batch]\n", encoder_inputs, decoder_inputs, target_weights)
+def beam_decode(args, model, sess, bucket_id, inputs, return_raw=False):
+    """Beam search for a batch of inputs from one bucket.
 
-    ### Original greedy decoding
-    if args.beam_size == 1:
-      _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id, forward_only=True, force_dec_input=False, advantage=None, ScheduledSampling=False)
-      return [{"dec_inp": greedy_dec(output_logits, rev_vocab), 'prob': 1}]
+    The live hypotheses of every input are stacked into one batch, so each
+    decoder position costs a single decode_step (two with anti-LM). With a
+    model.shortlist, they are extended with words of the shortlist of the
+    inputs only, normalised over it.
+
+    Args:
+      inputs: list of input token-id lists, each ending with EOS.
+
+    Returns:
+      A list with the Beam.results() hypotheses of each input.
+    """
+    data = {bucket_id: [(input_token_ids, []) for input_token_ids in inputs]}
+    encoder_inputs, decoder_inputs, _ = model.get_batch(data, bucket_id, range(len(inputs)))
+
+    # Run the encoder once; decode_step then advances every hypothesis by
+    # one token from its cached state.
+    attention_memory, dec_state = model.encode(sess, encoder_inputs, bucket_id)
+    if args.antilm:
+      dummy_encoder_inputs = [np.array([data_utils.PAD_ID], dtype=np.int32) for _ in range(len(encoder_inputs))]
+      dummy_attention_memory, dummy_dec_state = model.encode(sess, dummy_encoder_inputs, bucket_id)
+      dummy_dec_state = [np.repeat(s, len(inputs), axis=0) for s in dummy_dec_state]
+
+    # Beam scores are accumulated log-probabilities, one row per hypothesis;
+    # rows[r] is the input row r belongs to, rows of an input are contiguous.
+    beams = [Beam(args.beam_size, data_utils.EOS_ID, alpha=args.length_penalty) for _ in inputs]
+    rows = np.arange(len(inputs))
+    dec_inp = decoder_inputs[0]  # GO
+    candidates = None if getattr(model, 'shortlist', None) is None else model.shortlist.candidates(inputs)
 
-    # Get output logits for the sentence.
-    beams, new_beams, results = [(1, 0, {'eos': 0, 'dec_inp': decoder_inputs, 'prob': 1, 'prob_ts': 1, 'prob_t': 1})], [], [] # initialize beams as (log_prob, empty_string, eos)
-    dummy_encoder_inputs = [np.array([data_utils.PAD_ID]) for _ in range(len(encoder_inputs))]
-    
     for dptr in range(len(decoder_inputs)-1):
-      target_weights[dptr] = np.ones(1, dtype=np.float32)
-      if dptr > 0: 
-        # target_weights[dptr] = [1.]
-        beams, new_beams = new_beams[:args.beam_size], []
-      if debug: print("=====[beams]=====", beams)
-      heapq.heapify(beams)  # since we will remove something
-      for prob, _, cand in beams:
-        if cand['eos']: 
-          results += [(prob, 0, cand)]
+      logits, dec_state = model.decode_step(sess, dec_inp, dec_state, attention_memory[rows], first_step=(dptr == 0), shortlist=candidates)
+      all_prob_ts = log_softmax(logits)
+      if args.antilm:
+        # anti-lm: log P(T|S) - antilm * log P(T)
+        logits_t, dummy_dec_state = model.decode_step(sess, dec_inp, dummy_dec_state, np.repeat(dummy_attention_memory, len(rows), axis=0), first_step=(dptr == 0), shortlist=candidates)
+        all_prob_t = log_softmax(logits_t)
+        all_prob   = all_prob_ts - args.antilm * all_prob_t
+      else:
+        all_prob_t = np.zeros_like(all_prob_ts)
+        all_prob   = all_prob_ts
+
+      # suppress copy-cat (respond the same as input)
+      copy_ids = np.array([ids[dptr] if dptr < len(ids) else -1 for ids in inputs])[rows]
+      if candidates is not None:
+        copy_ids = _shortlist_columns(candidates, copy_ids)
+      copy_rows = np.nonzero(copy_ids >= 0)[0]
+      all_prob[copy_rows, copy_ids[copy_rows]] += np.log(0.01)
+
+      # for debug use
+      if return_raw: return all_prob, all_prob_ts, all_prob_t
+
+      gather, new_rows, start = [], [], 0
+      for i, beam in enumerate(beams):
+        if beam.done:
           continue
+        n_live = len(beam.tokens)
+        live = slice(start, start + n_live)
+        start += n_live
+        parents = beam.advance(all_prob[live], token_ids=candidates,
+                               prob_ts=all_prob_ts[live], prob_t=all_prob_t[live])
+        if not beam.done:
+          gather.extend(live.start + parents)
+          new_rows.extend([i] * len(parents))
+      if not gather:
+        break
 
-        # normal seq2seq
-        if debug: print(cand['prob'], " ".join([dict_lookup(rev_vocab, w[0]) for w in cand['dec_inp']]))
-
-        all_prob_ts = model_step(encoder_inputs, cand['dec_inp'], dptr, target_weights, bucket_id, force_dec_input=True)
-        if args.antilm:
-          # anti-lm
-          all_prob_t  = model_step(dummy_encoder_inputs, cand['dec_inp'], dptr, target_weights, bucket_id, force_dec_input=True)
-          # adjusted probability
-          all_prob    = all_prob_ts - args.antilm * all_prob_t #+ args.n_bonus * dptr + random() * 1e-50
-        else:
-          all_prob_t  = [0]*len(all_prob_ts)
-          all_prob    = all_prob_ts
-
-        # suppress copy-cat (respond the same as input)
-        if dptr < len(input_token_ids):
-          all_prob[input_token_ids[dptr]] = all_prob[input_token_ids[dptr]] * 0.01
-
-        # for debug use
-        if return_raw: return all_prob, all_prob_ts, all_prob_t
-        
-        # beam search  
-        for c in np.argsort(all_prob)[::-1][:args.beam_size]:
-          new_cand = {
-            'eos'     : (c == data_utils.EOS_ID),
-            'dec_inp' : [(np.array([c]) if i == (dptr+1) else k) for i, k in enumerate(cand['dec_inp'])],
-            'prob_ts' : cand['prob_ts'] * all_prob_ts[c],
-            'prob_t'  : cand['prob_t'] * all_prob_t[c],
-            'prob'    : cand['prob'] * all_prob[c],
-          }
-          new_cand = (new_cand['prob'], random(), new_cand) # stuff a random to prevent comparing new_cand
-          
-          try:
-            if (len(new_beams) < args.beam_size):
-              heapq.heappush(new_beams, new_cand)
-            elif (new_cand[0] > new_beams[0][0]):
-              heapq.heapreplace(new_beams, new_cand)
-          except Exception as e:
-            print("[Error]", e)
-            print("-----[new_beams]-----\n", new_beams)
-            print("-----[new_cand]-----\n", new_cand)
-    
-    results += new_beams  # flush last cands
-
-    # post-process results
-    res_cands = []
-    for prob, _, cand in sorted(results, reverse=True):
-      cand['dec_inp'] = " ".join([dict_lookup(rev_vocab, w[0]) for w in cand['dec_inp']])
-      res_cands.append(cand)
-    return res_cands[:args.beam_size]
+      gather, rows = np.array(gather), np.array(new_rows)
+      dec_state = [s[gather] for s in dec_state]
+      if args.antilm:
+        dummy_dec_state = [s[gather] for s in dummy_dec_state]
+      dec_inp = np.concatenate([beam.last_tokens() for beam in beams if not beam.done])
+
+    return [beam.results() for beam in beams]
+
+
+def greedy_cand(output_token_ids, rev_vocab):
+    return {"dec_inp": ' '.join([dict_lookup(rev_vocab, t) for t in output_token_ids]), 'prob': 1}
+
+
+def beam_cand(hyp, decoder_size, rev_vocab):
+    # GO + tokens, padded to the decoder length as fed to the model.
+    tokens = [data_utils.GO_ID] + list(hyp['tokens'])
+    tokens += [data_utils.PAD_ID] * (decoder_size - len(tokens))
+    return {
+      'eos'     : bool(hyp['tokens'][-1] == data_utils.EOS_ID),
+      'dec_inp' : " ".join([dict_lookup(rev_vocab, t) for t in tokens]),
+      'prob_ts' : hyp['prob_ts'],
+      'prob_t'  : hyp['prob_t'],
+      'prob'    : hyp['norm_score'],
+    }
+
+
+def greedy_decode_all(args, model, sess, inputs):
+    """greedy_decode of inputs of any length, args.batch_size at a time per bucket.
+
+    Returns:
+      A list with the output token ids of each input, cut before EOS.
+    """
+    by_bucket = {}
+    for i, input_token_ids in enumerate(inputs):
+      bucket_id, input_token_ids = get_bucket_id(args.buckets, input_token_ids)
+      by_bucket.setdefault(bucket_id, []).append((i, input_token_ids))
+    outputs = [None] * len(inputs)
+    for bucket_id, batch in sorted(by_bucket.items()):
+      for start in range(0, len(batch), args.batch_size):
+        rows = batch[start:start + args.batch_size]
+        for (i, _), output in zip(rows, greedy_decode(model, sess, bucket_id, [t for _, t in rows])):
+          outputs[i] = output
+    return outputs
+
+
+def evaluation_pairs(args, max_size=1000):
+    """Up to max_size (input, response) pairs of the dev set, for comparing models.
+
+    Random pairs of every bucket if the dev set has not been prepared.
+
+    Returns:
+      A pair (pairs, description of where they come from).
+    """
+    dev_path = data_utils.get_dialog_dev_set_path(args.data_dir) + ".ids%d.in" % args.vocab_size
+    if gfile.Exists(dev_path):
+      dev_set = data_utils.read_data(dev_path, args.buckets, max_size)
+      pairs = [(list(bucket[i][0]), list(bucket[i][1])) for bucket in dev_set for i in range(len(bucket))]
+      return pairs, "dev set %s" % dev_path
+    pairs = []
+    for _ in range(max_size):
+      encoder_size, decoder_size = args.buckets[np.random.randint(len(args.buckets))]
+      pairs.append((list(np.random.randint(4, args.vocab_size, np.random.randint(1, encoder_size - 1))) +
+                    [data_utils.EOS_ID],
+                    list(np.random.randint(4, args.vocab_size, np.random.randint(1, decoder_size - 2))) +
+                    [data_utils.EOS_ID]))
+    return pairs, "random pairs (no dev set at %s)" % dev_path
+
+
+def perplexity(log_probs, pairs):
+    """Per-token perplexity of pairs from their log_prob scores."""
+    lengths = np.array([len(response) for _, response in pairs])
+    return float(np.exp(-np.sum(log_probs * lengths) / np.sum(lengths)))
+
+
+def decode_batch(args, model, sess, bucket_id, inputs, rev_vocab):
+    """Candidates of each input of one bucket, greedy or beam by args.beam_size.
+
+    Returns:
+      A list with the get_predicted_sentence candidates of each input.
+    """
+    if args.beam_size == 1:
+      return [[greedy_cand(output_token_ids, rev_vocab)]
+              for output_token_ids in greedy_decode(model, sess, bucket_id, inputs)]
+    return [[beam_cand(hyp, args.buckets[bucket_id][1], rev_vocab) for hyp in hyps]
+            for hyps in beam_decode(args, model, sess, bucket_id, inputs)]
+
+
+def get_predicted_sentence(args, input_sentence, vocab, rev_vocab, model, sess, debug=False, return_raw=False, tokenizer=None):
+    # tokenizer: optional data_utils.Tokenizer of vocab, for repeated calls.
+    if tokenizer:
+      input_token_ids = tokenizer.encode(input_sentence)
+    else:
+      input_token_ids = data_utils.sentence_to_token_ids(input_sentence, vocab)
+    input_token_ids.append(data_utils.EOS_ID)
+    # Which bucket does it belong to?
+    bucket_id, input_token_ids = get_bucket_id(args.buckets, input_token_ids)
+    if debug: print("\n[input]\n", bucket_id, input_token_ids)
+
+    ### Original greedy decoding
+    if args.beam_size == 1:
+      output_token_ids = greedy_decode(model, sess, bucket_id, [input_token_ids])[0]
+      return [greedy_cand(output_token_ids, rev_vocab)]
+
+    hyps = beam_decode(args, model, sess, bucket_id, [input_token_ids], return_raw=return_raw)
+    if return_raw: return hyps
+    return [beam_cand(hyp, args.buckets[bucket_id][1], rev_vocab) for hyp in hyps[0]]
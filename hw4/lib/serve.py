@@ -0,0 +1,206 @@
+"""Chat over HTTP, batching concurrent requests into one decode per bucket.
+
+POST /chat with a JSON body {"sentence": "..."} answers with the candidates
+chat mode prints, {"responses": [{"dec_inp": ..., "prob": ...}, ...]}.
+GET /stats answers with the latency and throughput report.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import six
+import tensorflow as tf
+from six.moves import queue
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from lib import data_utils
+from lib.seq2seq_model_utils import create_model, get_bucket_id, decode_batch
+
+
+class _Request(object):
+
+  def __init__(self, token_ids, bucket_id):
+    self.token_ids = token_ids
+    self.bucket_id = bucket_id
+    self.arrival_time = time.time()
+    self.done = threading.Event()
+    self.responses = None
+    self.error = None
+
+
+class MicroBatcher(object):
+  """Decodes requests in batches on a single thread that owns the session.
+
+  Each collection takes the requests already waiting, which queued during
+  the previous decode, then waits for more until window seconds after it
+  started or max_batch requests; they are grouped by bucket and decoded
+  max_batch at a time.
+  """
+
+  def __init__(self, decode_fn, window=0.01, max_batch=32, history=10000):
+    """Create the batcher and start its thread.
+
+    Args:
+      decode_fn: function (bucket_id, inputs) returning the candidates of
+        each input, e.g. seq2seq_model_utils.decode_batch.
+      window: seconds a collection waits for requests to batch together.
+      max_batch: maximum number of inputs per collection and per decode.
+      history: number of recent latencies the percentiles are taken over.
+    """
+    self.decode_fn = decode_fn
+    self.window = window
+    self.max_batch = max_batch
+    self._requests = queue.Queue()
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=history)
+    self._start_time = time.time()
+    self._completed = 0
+    self._batches = 0
+    thread = threading.Thread(target=self._run)
+    thread.daemon = True
+    thread.start()
+
+  def submit(self, token_ids, bucket_id):
+    """Decode one input, blocking until its batch is done."""
+    request = _Request(token_ids, bucket_id)
+    self._requests.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.responses
+
+  def _collect(self):
+    requests = [self._requests.get()]
+    deadline = time.time() + self.window
+    # Requests that queued during the previous decode are batched at once.
+    while len(requests) < self.max_batch:
+      try:
+        requests.append(self._requests.get_nowait())
+      except queue.Empty:
+        break
+    while len(requests) < self.max_batch:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        requests.append(self._requests.get(timeout=timeout))
+      except queue.Empty:
+        break
+    return requests
+
+  def _run(self):
+    while True:
+      by_bucket = collections.defaultdict(list)
+      for request in self._collect():
+        by_bucket[request.bucket_id].append(request)
+      for bucket_id, requests in sorted(by_bucket.items()):
+        for start in range(0, len(requests), self.max_batch):
+          batch = requests[start:start + self.max_batch]
+          try:
+            responses = self.decode_fn(bucket_id, [r.token_ids for r in batch])
+          except Exception as e:  # pylint: disable=broad-except
+            responses = [None] * len(batch)
+            for request in batch:
+              request.error = e
+          finish_time = time.time()
+          with self._lock:
+            self._batches += 1
+            self._completed += len(batch)
+            self._latencies.extend(finish_time - r.arrival_time for r in batch)
+          for request, response in zip(batch, responses):
+            request.responses = response
+            request.done.set()
+
+  def stats(self):
+    """p50/p99 latency in ms, throughput in requests/sec, mean batch size."""
+    with self._lock:
+      latencies = np.array(self._latencies) * 1000
+      completed, batches = self._completed, self._batches
+    elapsed = time.time() - self._start_time
+    return {
+      'requests'         : completed,
+      'p50_ms'           : float(np.percentile(latencies, 50)) if completed else None,
+      'p99_ms'           : float(np.percentile(latencies, 99)) if completed else None,
+      'requests_per_sec' : completed / elapsed,
+      'mean_batch_size'  : completed / batches if batches else None,
+    }
+
+
+def _handler(args, tokenizer, batcher):
+
+  class ChatHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+      data = json.dumps(body).encode()
+      self.send_response(code)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if self.path == "/stats":
+        self._reply(200, batcher.stats())
+      else:
+        self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+      if self.path != "/chat":
+        return self._reply(404, {'error': 'unknown path %s' % self.path})
+      try:
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        sentence = body['sentence']
+      except (ValueError, KeyError, TypeError):
+        sentence = None
+      if not isinstance(sentence, six.string_types):
+        return self._reply(400, {'error': 'expected a JSON body {"sentence": "..."}'})
+      input_token_ids = tokenizer.encode(sentence)
+      input_token_ids.append(data_utils.EOS_ID)
+      bucket_id, input_token_ids = get_bucket_id(args.buckets, input_token_ids)
+      try:
+        responses = batcher.submit(input_token_ids, bucket_id)
+      except Exception as e:  # pylint: disable=broad-except
+        return self._reply(500, {'error': str(e)})
+      self._reply(200, {'responses': [{'dec_inp': r['dec_inp'], 'prob': float(r['prob'])}
+                                      for r in responses]})
+
+    def log_message(self, format, *args):
+      pass
+
+  return ChatHandler
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+def serve(args):
+  with tf.Session() as sess:
+    # Create model and load parameters.
+    model = create_model(sess, args, predict_or_train=True)
+
+    # Load vocabularies.
+    vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+    vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+    tokenizer = data_utils.Tokenizer(vocab)
+
+    batcher = MicroBatcher(
+        lambda bucket_id, inputs: decode_batch(args, model, sess, bucket_id, inputs, rev_vocab),
+        window=args.batch_window_ms / 1000., max_batch=args.serve_max_batch)
+    server = _ThreadingHTTPServer((args.serve_host, args.serve_port), _handler(args, tokenizer, batcher))
+    print("Serving on http://%s:%d (POST /chat, GET /stats)" % (args.serve_host, args.serve_port))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      print("[stats] %s" % json.dumps(batcher.stats()))
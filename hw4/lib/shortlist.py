@@ -0,0 +1,123 @@
+"""Decode-time vocabulary shortlists.
+
+Responses to an input are decoded over a shortlist of the target vocabulary
+instead of all of it: the n_frequent most frequent words, which are the
+first ids of vocab%d.in, and for every input token the words that followed
+it most often in the training pairs. The latter come from an alignment
+table, built from the training token ids once and cached in the data dir.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensorflow.python.platform import gfile
+
+from lib import data_utils
+
+
+def _merge_counts(keys, counts, new_keys):
+  keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+  counts = np.bincount(inverse, weights=np.concatenate([counts, np.ones(len(new_keys))]))
+  return keys, counts
+
+
+def build_alignment_table(ids_path, vocab_size, skip=0, top_k=100, min_count=2,
+                          reversed=False, chunk_pairs=100000):
+  """Target words co-occurring with each source word in most training pairs.
+
+  Args:
+    ids_path: path to the token-ids of the training pairs, source and target
+      on alternate lines; its binary format is written if missing.
+    vocab_size: size of the vocabulary.
+    skip: target ids below it, the most frequent words, are left out.
+    top_k: maximum number of target words kept per source word.
+    min_count: minimum number of pairs a source and target word share.
+    reversed: whether targets are on the even lines, as read_data reverses.
+
+  Returns:
+    A pair (offsets, targets): the target words of source word s are
+    targets[offsets[s]:offsets[s + 1]], those of most pairs first.
+  """
+  data_utils.token_ids_to_binary(ids_path)
+  tokens_path, offsets_path = data_utils._binary_paths(ids_path)  # pylint: disable=protected-access
+  tokens = np.load(tokens_path, mmap_mode="r")
+  line_offsets = np.load(offsets_path, mmap_mode="r")
+  n_pairs = (len(line_offsets) - 1) // 2
+  source_line, target_line = (1, 0) if reversed else (0, 1)
+
+  keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0)
+  for start in xrange(0, n_pairs, chunk_pairs):
+    print("  aligning pair %d of %d" % (start, n_pairs))
+    chunk = []
+    for p in xrange(start, min(n_pairs, start + chunk_pairs)):
+      s, t = 2 * p + source_line, 2 * p + target_line
+      source = np.unique(tokens[line_offsets[s]:line_offsets[s + 1]]).astype(np.int64)
+      target = np.unique(tokens[line_offsets[t]:line_offsets[t + 1]])
+      target = target[target >= skip]
+      chunk.append((source[:, None] * vocab_size + target[None, :]).ravel())
+    if chunk:
+      keys, counts = _merge_counts(keys, counts, np.concatenate(chunk))
+
+  keep = counts >= min_count
+  keys, counts = keys[keep], counts[keep]
+  sources, targets = keys // vocab_size, keys % vocab_size
+  order = np.lexsort((-counts, sources))  # By source word, most pairs first.
+  sources, targets = sources[order], targets[order]
+  rank = np.arange(len(sources)) - np.searchsorted(sources, sources)
+  sources, targets = sources[rank < top_k], targets[rank < top_k]
+  offsets = np.searchsorted(sources, np.arange(vocab_size + 1)).astype(np.int64)
+  return offsets, targets.astype(np.int32)
+
+
+class Shortlist(object):
+  """The words responses to inputs are decoded over."""
+
+  def __init__(self, n_frequent, offsets=None, targets=None, n_aligned=0):
+    """Create the shortlist.
+
+    Args:
+      n_frequent: number of most frequent words always included; at least
+        the special symbols of data_utils.
+      offsets, targets: alignment table of build_alignment_table, or None.
+      n_aligned: number of words of the table included per input token.
+    """
+    self.n_frequent = max(n_frequent, len(data_utils._START_VOCAB))
+    self.offsets = offsets
+    self.targets = targets
+    self.n_aligned = n_aligned
+
+  def candidates(self, inputs):
+    """Sorted int32 ids of the shortlist of any of the input token-id lists."""
+    ids = [np.arange(self.n_frequent)]
+    if self.targets is not None:
+      for token in set(t for input_token_ids in inputs for t in input_token_ids):
+        start = self.offsets[token]
+        ids.append(self.targets[start:min(start + self.n_aligned, self.offsets[token + 1])])
+    return np.unique(np.concatenate(ids)).astype(np.int32)
+
+
+def load_shortlist(args):
+  """The Shortlist of --shortlist, or None for the full vocabulary.
+
+  The alignment table is built from the training data the first time.
+  """
+  if not args.shortlist:
+    return None
+  path = os.path.join(args.data_dir, "shortlist%d_%d.npz" % (args.vocab_size, args.shortlist))
+  if not gfile.Exists(path):
+    train_ids = data_utils.get_dialog_train_set_path(args.data_dir) + ".ids%d.in" % args.vocab_size
+    if not gfile.Exists(train_ids):
+      print("No training data in %s, shortlists have only the %d most frequent words" %
+            (train_ids, args.shortlist))
+      return Shortlist(args.shortlist)
+    print("Building the shortlist alignment table %s" % path)
+    offsets, targets = build_alignment_table(train_ids, args.vocab_size, skip=args.shortlist,
+                                             reversed=bool(args.rev_model))
+    with open(path, "wb") as f:
+      np.savez(f, offsets=offsets, targets=targets)
+  with np.load(path) as table:
+    return Shortlist(args.shortlist, table["offsets"], table["targets"], args.shortlist_aligned)
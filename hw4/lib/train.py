@@ -1,12 +1,14 @@
-import sys, os, math, time, argparse, shutil, gzip
+import sys, os, math, time, argparse, shutil, gzip, random, multiprocessing
 import numpy as np
 import tensorflow as tf
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from six.moves import queue
 from six.moves import xrange  # pylint: disable=redefined-builtin
 from datetime import datetime
-from lib import seq2seq_model_utils, data_utils
+from lib import seq2seq_model_utils, data_utils, distributed
+from lib.prefetch import BatchPrefetcher, EpochSampler, load_sampler_state, save_sampler_state
 
 
 def setup_workpath(workspace):
@@ -31,89 +33,231 @@ def setup_workpath(workspace):
 def train(args):
     print("[%s] Preparing dialog data in %s" % (args.model_name, args.data_dir))
     setup_workpath(workspace=args.workspace)
-    train_data, dev_data, _ = data_utils.prepare_dialog_data(args.data_dir, args.vocab_size)
+    train_data, dev_data, _ = data_utils.prepare_dialog_data(args.data_dir, args.vocab_size, args.buckets,
+                                                              args.preprocess_workers)
 
-    if args.reinforce_learn:
+    if args.reinforce_learn and not args.bi:
       args.batch_size = 1  # We decode one sentence at a time.
 
+    if args.seed is not None:
+      random.seed(args.seed)
+      np.random.seed(args.seed)
+      tf.set_random_seed(args.seed)
+
+    # Read data into buckets and compute their sizes.
+    print("Reading development and training data (limit: %d)." % args.max_train_data_size)
+    dev_set = data_utils.read_data(dev_data, args.buckets, reversed=args.rev_model)
+    train_set = data_utils.read_data(train_data, args.buckets, args.max_train_data_size, reversed=args.rev_model)
+    dev_set = data_utils.pad_data(dev_set, args.buckets)
+    train_set = data_utils.pad_data(train_set, args.buckets)
+
+    sampler_state = None
+    if args.batch_sampler == 'epoch':
+      ckpt = tf.train.get_checkpoint_state(args.model_dir)
+      sampler_state = load_sampler_state(ckpt and ckpt.model_checkpoint_path, args.seed)
+      print("Epoch sampler with seed %d, resuming after %d batches" % (sampler_state["seed"], sampler_state["batches"]))
+
+    if args.workers:
+      # Workers are forked before any session exists in this process.
+      per_worker = train_distributed(args, train_set, dev_set, sampler_state)
+      for task, (steps, seconds) in enumerate(per_worker):
+        print("worker %d: %d steps, %.2f steps/sec" % (task, steps, steps / max(seconds, 1e-9)))
+      return per_worker
+
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_usage)
     with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
 
         # Create model.
         print("Creating %d layers of %d units." % (args.num_layers, args.size))
         model = seq2seq_model_utils.create_model(sess, args, predict_or_train=False)
+        return train_loop(args, sess, model, train_set, dev_set, sampler_state=sampler_state)
+
+
+def evaluate(args, sess, model, dev_set):
+    """Print the perplexity of every bucket of dev_set and of all of it."""
+    total_loss, total_pairs = 0.0, 0
+    for bucket_id in xrange(len(args.buckets)):
+      bucket_loss, n = 0.0, len(dev_set[bucket_id])
+      for start in xrange(0, n, args.batch_size):
+        batch_indices = list(xrange(start, min(start + args.batch_size, n)))
+        encoder_inputs, decoder_inputs, target_weights = model.get_batch(dev_set, bucket_id, batch_indices)
+        _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                    target_weights, bucket_id, forward_only=True, force_dec_input=True)
+        bucket_loss += eval_loss * len(batch_indices)
+      if not n:
+        print("  eval: empty bucket %d" % bucket_id)
+        continue
+      eval_ppx = math.exp(bucket_loss / n) if bucket_loss / n < 300 else float('inf')
+      print("  eval: bucket %d perplexity %.2f (%d pairs)" % (bucket_id, eval_ppx, n))
+      total_loss, total_pairs = total_loss + bucket_loss, total_pairs + n
+    if total_pairs:
+      eval_ppx = math.exp(total_loss / total_pairs) if total_loss / total_pairs < 300 else float('inf')
+      print("  eval: dev set perplexity %.2f (%d pairs)" % (eval_ppx, total_pairs))
+
+
+def train_loop(args, sess, model, train_set, dev_set, task=0, seed=None, sampler_state=None):
+    """Train model until args.max_steps global steps, or forever if it is 0.
+
+    Only the chief, task 0, saves checkpoints, decays the learning rate and
+    evaluates on dev_set, every args.steps_per_checkpoint of its steps.
+    Given a sampler_state of load_sampler_state, batches come from an
+    EpochSampler, sharded between args.workers tasks, and its state is
+    saved with the checkpoints.
+
+    Returns:
+      A pair (steps, seconds): the steps of this loop and the time spent in
+      them, except the first.
+    """
+    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(args.buckets))]
+    train_total_size = float(sum(train_bucket_sizes))
+
+    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
+    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
+    # the size if i-th training bucket, as used later.
+    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
+                           for i in xrange(len(train_bucket_sizes))]
+
+    # This is the training loop.
+    chief = task == 0
+    step_time, loss, reward = 0.0, 0.0, 0.0
+    current_step, total_time = 0, 0.0
+    previous_losses = []
+    checkpoint_path = os.path.join(args.model_dir, "model.ckpt")
+
+    # Load vocabularies.
+    vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
+    rev_vocab = data_utils.initialize_vocabulary(vocab_path)[1] if args.reinforce_learn else None
+
+    # Batches are assembled ahead of the steps. Each picks a bucket according
+    # to data distribution: a random number in [0, 1] and the corresponding
+    # interval in train_buckets_scale.
+    # With the epoch sampler, every pair is drawn once per epoch instead.
+    sampler, start = None, 0
+    if sampler_state is not None:
+      sampler = EpochSampler(train_bucket_sizes, args.batch_size, sampler_state["seed"],
+                             num_shards=max(args.workers, 1), shard=task)
+      start = sampler_state["batches"] // sampler.num_shards
+    prefetcher = BatchPrefetcher(model.get_batch, train_set, train_buckets_scale, args.batch_size,
+                                 capacity=args.prefetch_batches, num_threads=args.prefetch_threads,
+                                 seed=args.seed if seed is None else seed, sampler=sampler, start=start)
+    last_report = time.time(), prefetcher.position
+
+    def save_checkpoint():
+      path = model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+      if sampler is not None:
+        save_sampler_state(path, {"seed": sampler.seed, "batches": prefetcher.position * sampler.num_shards})
+
+    while not args.max_steps or sess.run(model.global_step) < args.max_steps:
+      # Get a batch and make a step.
+      start_time = time.time()
+      bucket_id, (encoder_inputs, decoder_inputs, target_weights) = prefetcher.get()
+
+      # print("[shape]", np.shape(encoder_inputs), np.shape(decoder_inputs), np.shape(target_weights))
+      if args.reinforce_learn and args.bi:
+        # batch_size episodes rolled out together, one update.
+        _, step_loss, step_reward = model.step_rf_batch(args, sess, encoder_inputs, decoder_inputs,
+                                                        target_weights, bucket_id,
+                                                        max_turns=args.rl_max_turns)
+        reward += step_reward / args.steps_per_checkpoint
+      elif args.reinforce_learn:
+        _, step_loss, _ = model.step_rf(args, sess, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, rev_vocab=rev_vocab)
+      else:
+        _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, forward_only=False, force_dec_input=True, ScheduledSampling=args.scheduled_sampling)
+
+      step_time += (time.time() - start_time) / args.steps_per_checkpoint
+      if current_step:
+        total_time += time.time() - start_time
+      loss += step_loss / args.steps_per_checkpoint
+      current_step += 1
+
+      # Once in a while, we save checkpoint, print statistics, and run evals.
+      if (current_step % args.steps_per_checkpoint == 0) and chief:# and (not args.reinforce_learn):
+        # Print statistics for the previous epoch.
+        perplexity = math.exp(loss) if loss < 300 else float('inf')
+        print ("global step %d learning rate %.4f step-time %.2f perplexity %.2f %s @ %s" %
+               (sess.run(model.global_step), sess.run(model.learning_rate), step_time, perplexity,
+                prefetcher.stats(), datetime.now()))
+        prefetcher.reset_stats()
+        if sampler is not None:
+          epochs = sampler.epochs(prefetcher.position) - sampler.epochs(last_report[1])
+          print("  %.4f epochs/sec" % (epochs / (time.time() - last_report[0])))
+          last_report = time.time(), prefetcher.position
+        if args.reinforce_learn and args.bi:
+          print("  mean episode reward %.4f" % reward)
+
+        # Decrease learning rate if no improvement was seen over last 3 times.
+        # The loss of policy-gradient steps is not what they minimise.
+        if (not args.reinforce_learn and len(previous_losses) > 2 and
+            loss > max(previous_losses[-3:])):
+          sess.run(model.learning_rate_decay_op)
+
+        previous_losses.append(loss)
+
+        # # Save checkpoint and zero timer and loss.
+        save_checkpoint()
+
+        # Run evals on the whole development set and print their perplexity.
+        evaluate(args, sess, model, dev_set)
+
+        sys.stdout.flush()
+      if current_step % args.steps_per_checkpoint == 0:
+        step_time, loss, reward = 0.0, 0.0, 0.0
+
+    prefetcher.stop()
+    if chief:
+      save_checkpoint()
+    return current_step, total_time
+
+
+def _train_worker(args, cluster, task, train_set, dev_set, sampler_state, results):
+    if args.seed is not None:
+      random.seed(args.seed + task)
+      np.random.seed(args.seed + task)
+    with tf.Graph().as_default():
+      sess, model, supervisor = distributed.replica_session(args, cluster, task)
+      try:
+        steps, seconds = train_loop(args, sess, model, train_set, dev_set, task=task,
+                                    seed=None if args.seed is None else args.seed + 1000 * task,
+                                    sampler_state=sampler_state)
+      finally:
+        supervisor.stop()
+    results.put((task, steps, seconds))
+
+
+def train_distributed(args, train_set, dev_set, sampler_state=None):
+    """Train with args.workers local worker processes and a parameter server.
+
+    The workers share sampler_state, each taking its shard of the batches.
 
-        # Read data into buckets and compute their sizes.
-        print("Reading development and training data (limit: %d)." % args.max_train_data_size)
-        dev_set = data_utils.read_data(dev_data, args.buckets, reversed=args.rev_model)
-        train_set = data_utils.read_data(train_data, args.buckets, args.max_train_data_size, reversed=args.rev_model)
-        train_bucket_sizes = [len(train_set[b]) for b in xrange(len(args.buckets))]
-        train_total_size = float(sum(train_bucket_sizes))
-
-        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
-        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                               for i in xrange(len(train_bucket_sizes))]
-
-        # This is the training loop.
-        step_time, loss = 0.0, 0.0
-        current_step = 0
-        previous_losses = []
-
-        # Load vocabularies.
-        vocab_path = os.path.join(args.data_dir, "vocab%d.in" % args.vocab_size)
-        vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
-
-        while True:
-          # Choose a bucket according to data distribution. We pick a random number
-          # in [0, 1] and use the corresponding interval in train_buckets_scale.
-          random_number_01 = np.random.random_sample()
-          bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                           if train_buckets_scale[i] > random_number_01])
-
-          # Get a batch and make a step.
-          start_time = time.time()
-          encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-              train_set, bucket_id)
-
-          # print("[shape]", np.shape(encoder_inputs), np.shape(decoder_inputs), np.shape(target_weights))
-          if args.reinforce_learn:
-            _, step_loss, _ = model.step_rf(args, sess, encoder_inputs, decoder_inputs,
-                                         target_weights, bucket_id, rev_vocab=rev_vocab)
-          else:
-            _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                         target_weights, bucket_id, forward_only=False, force_dec_input=True, ScheduledSampling=args.scheduled_sampling)
-
-          step_time += (time.time() - start_time) / args.steps_per_checkpoint
-          loss += step_loss / args.steps_per_checkpoint
-          current_step += 1
-
-          # Once in a while, we save checkpoint, print statistics, and run evals.
-          if (current_step % args.steps_per_checkpoint == 0):# and (not args.reinforce_learn):
-            # Print statistics for the previous epoch.
-            perplexity = math.exp(loss) if loss < 300 else float('inf')
-            print ("global step %d learning rate %.4f step-time %.2f perplexity %.2f @ %s" %
-                   (model.global_step.eval(), model.learning_rate.eval(), step_time, perplexity, datetime.now()))
-
-            # Decrease learning rate if no improvement was seen over last 3 times.
-            if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-              sess.run(model.learning_rate_decay_op)
-
-            previous_losses.append(loss)
-
-            # # Save checkpoint and zero timer and loss.
-            checkpoint_path = os.path.join(args.model_dir, "model.ckpt")
-            model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-            step_time, loss = 0.0, 0.0
-
-            # Run evals on development set and print their perplexity.
-            for bucket_id in xrange(len(args.buckets)):
-              encoder_inputs, decoder_inputs, target_weights = model.get_batch(dev_set, bucket_id)
-              _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs, 
-                                          target_weights, bucket_id, forward_only=True, force_dec_input=True)
-
-              eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
-              print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
-
-            sys.stdout.flush()
+    Returns:
+      A list with the (steps, seconds) of train_loop in each worker.
+    """
+    cluster = distributed.local_cluster(args.workers, args.ps_port)
+    ps = distributed.start_parameter_server(cluster)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_train_worker,
+                                       args=(args, cluster, task, train_set, dev_set, sampler_state, results))
+               for task in xrange(args.workers)]
+    try:
+      for worker in workers:
+        worker.start()
+      per_worker = {}
+      while len(per_worker) < len(workers):
+        try:
+          task, steps, seconds = results.get(timeout=1)
+          per_worker[task] = steps, seconds
+        except queue.Empty:
+          failed = [task for task, worker in enumerate(workers) if worker.exitcode]
+          if failed:
+            raise RuntimeError("Training worker %d exited with code %d" % (failed[0], workers[failed[0]].exitcode))
+      for worker in workers:
+        worker.join()
+    finally:
+      for worker in workers:
+        if worker.is_alive():
+          worker.terminate()
+      ps.terminate()
+      ps.join()
+    return [per_worker[task] for task in xrange(args.workers)]
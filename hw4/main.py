@@ -8,6 +8,10 @@ from lib.config import params_setup
 from lib.train import train
 from lib.predict import predict
 from lib.chat import chat
+from lib.serve import serve
+from lib.export import export
+from lib.quantize import quantize
+from lib.benchmark import benchmark
 # from lib.mert import mert
 
 
@@ -20,6 +24,14 @@ def main(_):
       predict(args)
     elif args.mode == 'chat':
       chat(args)
+    elif args.mode == 'serve':
+      serve(args)
+    elif args.mode == 'export':
+      export(args)
+    elif args.mode == 'quantize':
+      quantize(args)
+    elif args.mode == 'bench':
+      benchmark(args)
     # elif args.mode == 'mert':
     #   mert(args)
 